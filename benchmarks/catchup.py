@@ -0,0 +1,139 @@
+"""
+Benchmark of the two ways play_catchup brings a machine that is far behind
+up to date, on a synthetic history: streaming every record it is missing,
+or sending the leader's snapshot and only the records after it. Runs a
+leader and a follower in this process, connected by a socket pair, with
+their logs in a temporary directory:
+
+    python3 -m benchmarks.catchup [records] [users]
+"""
+import os
+import sys
+import time
+import random
+import socket
+import tempfile
+from threading import Condition, Lock, Thread
+import connections.consts as consts
+import connections.codec as codec
+import persistence.consts as persist_consts
+import server as server_module
+from connections.manager import ConnectionManager
+from persistence.log_writer import LogWriter
+from persistence.snapshot import Snapshotter
+from history import Undelivered
+import connections.schema as conn_schema
+from utils import print_info
+
+SUFFIX = 1000  # Records logged after the leader's snapshot
+
+
+def synthetic_history(count: int, users: int):
+    """
+    Creates users, then a mix of sends and notifs delivering them
+    """
+    rng = random.Random(7)
+    reqs = [conn_schema.CreateRequest(f"user{ix}") for ix in range(users)]
+    undelivered = {}
+    while len(reqs) < count:
+        recipient = f"user{rng.randrange(users)}"
+        if undelivered.get(recipient) and rng.random() < 0.4:
+            undelivered[recipient] -= 1
+            reqs.append(conn_schema.NotifRequest(recipient))
+        else:
+            author = f"user{rng.randrange(users)}"
+            undelivered[recipient] = undelivered.get(recipient, 0) + 1
+            reqs.append(conn_schema.SendRequest(author, recipient, f"message {len(reqs)} from {author}"))
+    return reqs
+
+
+def make_server(name: str):
+    """
+    A server with everything but its connections, rehydrated from its log
+    """
+    server = server_module.Server.__new__(server_module.Server)
+    server.name = name
+    server.identity = consts.MACHINE_MAP[name]
+    server.users = {}
+    server.undelivered = Undelivered()
+    server.applied = Condition()
+    server.alive = True
+    server.log_lock = Lock()
+    server.progress = 0
+    server.snapshotter = Snapshotter(name)
+    server.log_index = None
+    server.conman = ConnectionManager(server.identity)
+    server.rehydrate()
+    server.log_writer = LogWriter(
+        server.get_logfile(), durability=persist_consts.DURABILITY_BUFFERED, index=server.log_index)
+    return server
+
+
+def apply(server, reqs):
+    for req in reqs:
+        if server.handle_req(req, False).success:
+            server.update_log(req, wait=False)
+    server.log_writer.flush()
+
+
+def catch_up(leader, follower, use_snapshots: bool):
+    """
+    Runs play_catchup on both sides and applies what the follower
+    received. Returns (seconds, the follower's progress afterwards).
+    """
+    (leader_end, follower_end) = socket.socketpair()
+    leader.conman = ConnectionManager(leader.identity)
+    follower.conman = ConnectionManager(follower.identity)
+    progress = {leader.name: leader.get_progress(), follower.name: follower.get_progress()}
+    for (conman, other, end) in [(leader.conman, follower.name, leader_end), (follower.conman, leader.name, follower_end)]:
+        conman.internal_progress = dict(progress)
+        conman.internal_sockets[other] = end
+        conman.internal_codecs[other] = codec.BINARY
+    consts.CATCHUP_SNAPSHOT_GAP = 0 if use_snapshots else float("inf")
+
+    start = time.perf_counter()
+    stream = Thread(target=leader.conman.play_catchup, args=(
+        leader.get_reqs_by_progress, None, None, leader.get_catchup_snapshot))
+    stream.start()
+    follower.conman.play_catchup(None, None, None, None, follower.install_catchup_snapshot)
+    stream.join()
+    apply(follower, list(follower.conman.internal_requests.queue))
+    elapsed = time.perf_counter() - start
+    leader_end.close()
+    follower_end.close()
+    return (elapsed, follower.get_progress())
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            print_info(f"Building a history of {count} records for {users} users...")
+            history = synthetic_history(count, users)
+            leader = make_server("A")
+            apply(leader, history[:-SUFFIX])
+            leader.snapshotter.write(leader.snapshotter.capture(leader.progress, leader.users))
+            apply(leader, history[-SUFFIX:])
+            (_, rep) = leader.snapshotter.read_latest(leader.progress)
+            (_, packed) = leader.get_catchup_snapshot()
+            print_info(f"Snapshot at {leader.progress - SUFFIX}: {len(rep)} bytes, {len(packed)} compressed")
+            print(f"{'path':<10}{'seconds':>10}{'records/s':>14}")
+            for (name, follower_name, use_snapshots) in [("records", "B", False), ("snapshot", "C", True)]:
+                follower = make_server(follower_name)
+                (elapsed, progress) = catch_up(leader, follower, use_snapshots)
+                assert progress == leader.progress, f"{name} caught up to {progress}, not {leader.progress}"
+                assert sorted(follower.users) == sorted(leader.users)
+                print(f"{name:<10}{elapsed:>10.2f}{count / elapsed:>14.0f}")
+                follower.log_writer.close()
+                follower.log_index.close()
+            leader.log_writer.close()
+            leader.log_index.close()
+        finally:
+            os.chdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
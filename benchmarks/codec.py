@@ -0,0 +1,71 @@
+"""
+Microbenchmark of the wire codecs in connections/codec.py. For every
+message type, encodes and decodes the same message many times with the
+text and the binary codec and reports the cost per message:
+
+    python3 -m benchmarks.codec [iterations]
+"""
+import sys
+import schema as data_schema
+import connections.schema as conn_schema
+import connections.codec as codec
+from benchmarks.timing import best_of
+from utils import print_info
+
+
+def sample_messages():
+    """
+    (name, message, is_request) for one typical message of every type
+    """
+    chats = [data_schema.Chat(f"author{ix}", "reader", "how is it going? " * 4)
+             for ix in range(4)]
+    accounts = [data_schema.Account(f"user{ix}") for ix in range(4)]
+    return [
+        ("create", conn_schema.CreateRequest("alice"), True),
+        ("login", conn_schema.LoginRequest("alice"), True),
+        ("send", conn_schema.SendRequest("alice", "bob", "hello there, how are you doing today?"), True),
+        ("list", conn_schema.ListRequest("alice", "us", 2), True),
+        ("logs", conn_schema.LogsRequest("alice", "auth", 0), True),
+        ("notif", conn_schema.NotifRequest("alice"), True),
+        ("delete", conn_schema.DeleteRequest("alice"), True),
+        ("basic response", conn_schema.Response("alice", True, ""), False),
+        ("ping response", conn_schema.PingResponse(), False),
+        ("notif response", conn_schema.NotifResponse("bob", True, "", chats[0]), False),
+        ("list response", conn_schema.ListResponse("alice", True, "", accounts), False),
+        ("logs response", conn_schema.LogsResponse("alice", True, "", chats), False),
+    ]
+
+
+def measure(message, is_request, conn_codec, iterations):
+    """
+    Returns (encode, decode) microseconds per message, and the encoded size
+    """
+    encode = conn_codec.encode_request if is_request else conn_codec.encode_response
+    decode = conn_codec.decode_request if is_request else conn_codec.decode_response
+    data = encode(message)
+
+    def encode_all():
+        for _ in range(iterations):
+            encode(message)
+
+    def decode_all():
+        for _ in range(iterations):
+            decode(data)
+
+    return (best_of(encode_all) / iterations * 1e6,
+            best_of(decode_all) / iterations * 1e6,
+            len(data))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print_info(f"{iterations} iterations, best of 5, microseconds per message")
+    print(f"{'message':<16}{'codec':<8}{'encode':>8}{'decode':>8}{'bytes':>7}")
+    for (name, message, is_request) in sample_messages():
+        for conn_codec in [codec.TEXT, codec.BINARY]:
+            (enc, dec, size) = measure(message, is_request, conn_codec, iterations)
+            print(f"{name:<16}{conn_codec.name:<8}{enc:>8.2f}{dec:>8.2f}{size:>7}")
+
+
+if __name__ == "__main__":
+    main()
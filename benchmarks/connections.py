@@ -0,0 +1,111 @@
+"""
+Benchmark of the two ways a server can serve its sockets (see MANAGER in
+connections/consts.py): a thread per connection, or every connection on
+one event loop. For a growing number of connected clients, reports the
+server's memory and thread count, and the round trip latency of requests
+spread over all of the connections. The server runs in a child process
+with only its client port open, answering every request right away:
+
+    python3 -m benchmarks.connections [connections...]
+"""
+import sys
+import time
+import socket
+import multiprocessing
+import connections.consts as consts
+import connections.framing as framing
+from connections.manager import ConnectionManager
+from connections.async_manager import AsyncConnectionManager
+from connections.schema import Machine, LoginRequest, Response
+
+MANAGERS = {
+    consts.MANAGER_THREADS: ConnectionManager,
+    consts.MANAGER_ASYNCIO: AsyncConnectionManager,
+}
+PORT = 50090  # The first server's client port, the next one gets the one after
+REQUESTS = 2000  # Round trips timed at every connection count
+
+
+def serve(kind: str, port: int):
+    """
+    Runs in the child: a primary that answers every request
+    """
+    identity = Machine("bench", "127.0.0.1", 0, port, 0, 0, 0, [])
+    conman = MANAGERS[kind](identity)
+    conman.is_primary = True
+    conman.serve_clients()
+    while True:
+        (_, name, req) = conman.client_requests.get()
+        conman.send_response(name, Response(req.user_id, True, ""))
+
+
+def server_usage(pid: int):
+    """
+    Returns (resident memory in MB, thread count) of a process
+    """
+    usage = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            (key, _, value) = line.partition(":")
+            usage[key] = value.strip()
+    return (int(usage["VmRSS"].split()[0]) / 1024, int(usage["Threads"]))
+
+
+def connect(child, port: int):
+    while child.is_alive():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(("127.0.0.1", port))
+            framing.recv_message(sock)  # Whether this is the primary
+            return sock
+        except ConnectionRefusedError:
+            sock.close()
+            time.sleep(0.05)
+    raise Exception(f"Server on port {port} exited")
+
+
+def round_trips(socks):
+    """
+    Returns the latency of every request, in milliseconds
+    """
+    latencies = []
+    payload = LoginRequest("bench").marshal()
+    for ix in range(REQUESTS):
+        sock = socks[ix % len(socks)]
+        start = time.perf_counter()
+        framing.send_message(sock, payload)
+        framing.recv_frame(sock)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 4000]
+    context = multiprocessing.get_context("fork")
+    # Every server is started up front, so none of them inherits the
+    # memory this process used for the connections to another
+    children = {}
+    for (ix, kind) in enumerate(MANAGERS):
+        children[kind] = (context.Process(target=serve, args=(kind, PORT + ix), daemon=True), PORT + ix)
+        children[kind][0].start()
+    print(f"{'manager':<10}{'conns':>8}{'rss MB':>10}{'threads':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for (kind, (child, port)) in children.items():
+        socks = []
+        try:
+            for count in counts:
+                while len(socks) < count:
+                    socks.append(connect(child, port))
+                time.sleep(0.5)  # Let the server settle on the new connections
+                latencies = round_trips(socks)
+                (rss, threads) = server_usage(child.pid)
+                print(f"{kind:<10}{count:>8}{rss:>10.1f}{threads:>9}"
+                      f"{latencies[len(latencies) // 2]:>9.3f}{latencies[len(latencies) * 99 // 100]:>9.3f}")
+        finally:
+            for sock in socks:
+                sock.close()
+            child.terminate()
+            child.join()
+
+
+if __name__ == "__main__":
+    main()
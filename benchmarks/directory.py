@@ -0,0 +1,100 @@
+"""
+Benchmark of handle_list on a million users: filtering every account and
+slicing the page out of the result, versus the user directory
+(directory.py). Times one page for a few kinds of wildcard, keeping up the
+directory as users are created and deleted, and building it on rehydrate,
+and reports what the directory costs in memory:
+
+    python3 -m benchmarks.directory [users]
+"""
+import sys
+import random
+import tracemalloc
+from benchmarks.timing import best_of
+from directory import UserDirectory
+from schema import Account
+from server import ACCOUNT_PAGE_SIZE
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def make_ids(count: int):
+    rng = random.Random(11)
+    ids = set()
+    while len(ids) < count:
+        ids.add("".join(rng.choice(LETTERS) for _ in range(rng.randint(6, 12))))
+    return list(ids)
+
+
+def scan_page(users, wildcard: str, page: int):
+    """
+    What handle_list did before the directory
+    """
+    satisfying = filter(lambda user: wildcard in user.user_id, users.values())
+    return list(satisfying)[page * ACCOUNT_PAGE_SIZE: (page + 1) * ACCOUNT_PAGE_SIZE]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    ids = make_ids(count)
+    users = {user_id: Account(user_id) for user_id in ids}
+    tracemalloc.start()
+    directory = UserDirectory(ids)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    build = best_of(lambda: UserDirectory(ids), runs=1)
+    print(f"{count} users, directory built in {build:.2f}s, {size / 2 ** 20:.0f} MB "
+          f"({size / count:.0f} bytes per user)")
+
+    sample = ids[count // 3]
+    queries = [
+        ("everyone, first page", "", 0),
+        ("everyone, middle page", "", count // ACCOUNT_PAGE_SIZE // 2),
+        ("prefix of 3", "^" + sample[:3], 0),
+        ("substring of 4", sample[1:5], 0),
+        ("substring of 3, page 10", sample[2:5], 10),
+        ("substring of 1", sample[0], 0),
+    ]
+    print(f"{'query':<26}{'matches':>9}{'scan ms':>10}{'index ms':>10}")
+    for (name, wildcard, page) in queries:
+        if wildcard.startswith("^"):
+            # Lists before the directory had no prefixes
+            matches = sum(1 for user_id in ids if user_id.startswith(wildcard[1:]))
+            scanned = f"{'-':>10}"
+        else:
+            matches = sum(1 for user_id in ids if wildcard in user_id)
+            scanned = f"{best_of(lambda: scan_page(users, wildcard, page), runs=3) * 1000:>10.2f}"
+        index = best_of(lambda: directory.page(wildcard, ACCOUNT_PAGE_SIZE, page), runs=5)
+        print(f"{name:<26}{matches:>9}{scanned}{index * 1000:>10.3f}")
+
+    # Walking every page of a wildcard: the scan goes over every account
+    # for every page, the cursor picks up where the last page ended
+    wildcard = sample[0]
+    pages = [0]
+
+    def walk():
+        after = None
+        pages[0] = 0
+        while True:
+            (found, more) = directory.page(wildcard, ACCOUNT_PAGE_SIZE, 0, after)
+            pages[0] += 1
+            if not more:
+                return
+            after = found[-1]
+    walked = best_of(walk, runs=1)
+    per_scan = best_of(lambda: scan_page(users, wildcard, 0), runs=1)
+    print(f"all {pages[0]} pages of '{wildcard}': {walked:.2f}s by cursor, "
+          f"about {per_scan * pages[0]:.0f}s by scanning for every page")
+
+    fresh = [f"new{ix}" for ix in range(10000)]
+
+    def churn():
+        for user_id in fresh:
+            directory.add(user_id)
+        for user_id in fresh:
+            directory.remove(user_id)
+    print(f"create and delete: {best_of(churn, runs=3) / len(fresh) * 1e6:.1f}us per user")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Benchmark of failover: how long after the primary dies a backup notices
+and takes over, and how long until a client is served again. Starts A, B
+and C as child processes on localhost (consts.MACHINE_MAP is pointed at
+127.0.0.1 with every port moved by an offset, so a cluster already running
+on this machine is left alone, and below the range the kernel picks local
+ports from, so probing a port before it is listened on can never connect
+the probe to itself), each with its logs in a temporary
+directory of its own. One client sends chats to the primary, the primary is killed
+with SIGKILL after a number of them, and the client keeps sending until it
+has been served again. Prints one JSON object per run, then one with the
+medians over all runs:
+
+    python3 -m benchmarks.failover [runs] [kill_after] [manager]
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import tempfile
+import statistics
+import subprocess
+from threading import Thread
+import connections.consts as consts
+import connections.schema as conn_schema
+from connections.connector import ClientConnector
+
+PORT_OFFSET = -30000  # Added to every port in consts.MACHINE_MAP
+AFTER = 50  # Chats sent once the client is served again
+STARTUP_TIMEOUT = 30  # Seconds for the cluster to come up
+FAILOVER_TIMEOUT = 30  # Seconds for a backup to take over
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_localhost():
+    """
+    Points every machine at localhost, on ports that don't clash with
+    those of a real cluster
+    """
+    for machine in consts.MACHINE_MAP.values():
+        machine.host_ip = "127.0.0.1"
+        machine.internal_port += PORT_OFFSET
+        machine.client_port += PORT_OFFSET
+        machine.health_port += PORT_OFFSET
+        machine.notif_port += PORT_OFFSET
+
+
+def serve(name: str, manager: str):
+    """
+    Runs in a child: one machine of the cluster
+    """
+    use_localhost()
+    consts.MANAGER = manager
+    import server
+    server.create_server(name)
+
+
+class Node:
+    """
+    A machine of the cluster running in a child process, with the time
+    every line of its output arrived
+    """
+
+    def __init__(self, name: str, manager: str, directory: str):
+        self.name = name
+        self.lines = []  # (time.time() it arrived, line)
+        env = dict(os.environ, PYTHONPATH=ROOT, PYTHONUNBUFFERED="1")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.failover", "serve", name, manager],
+            cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.lines.append((time.time(), line))
+
+    def first_line(self, text: str, since: float):
+        """
+        When the first line containing text arrived after since, if one did
+        """
+        return next((when for (when, line) in list(self.lines) if when >= since and text in line), None)
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGKILL)
+        self.process.wait()
+
+
+class CountingConnector(ClientConnector):
+    """
+    A ClientConnector that counts what it sends and how often it looks for the primary
+    """
+
+    def __init__(self):
+        self.sends = 0
+        self.connects = 0
+        super().__init__()
+
+    def attempt_connection(self, reset_sock=None):
+        self.connects += 1
+        super().attempt_connection(reset_sock)
+
+    def send_to_primary(self, req):
+        # Called again for every resend, after finding the primary again
+        self.sends += 1
+        return super().send_to_primary(req)
+
+
+def wait_for_port(machine, nodes, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(node.process.poll() is not None for node in nodes):
+            raise Exception("A machine exited while starting")
+        try:
+            socket.create_connection((machine.host_ip, machine.client_port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"Machine {machine.name} didn't come up")
+
+
+def run_once(run: int, kill_after: int, manager: str) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        nodes = {}
+        for name in consts.MACHINE_MAP:
+            # A directory each, so the machines don't share a logs directory
+            os.mkdir(os.path.join(directory, name))
+            nodes[name] = Node(name, manager, os.path.join(directory, name))
+        try:
+            return measure(run, kill_after, manager, nodes)
+        finally:
+            for node in nodes.values():
+                node.kill()
+
+
+def measure(run: int, kill_after: int, manager: str, nodes) -> dict:
+    for machine in consts.MACHINE_MAP.values():
+        wait_for_port(machine, list(nodes.values()), STARTUP_TIMEOUT)
+    connector = CountingConnector()
+    primary = connector.primary_identity.name
+    for user_id in ["bench0", "bench1"]:
+        connector.send_request(conn_schema.CreateRequest(user_id))
+    (failed, retried, served_after) = (0, 0, 0)
+    (killed, first_success, stall) = (None, None, 0)
+    sent = 0
+    while served_after < AFTER:
+        if sent == kill_after:
+            nodes[primary].kill()
+            killed = time.time()
+            connects_before = connector.connects
+        if killed is not None and time.time() - killed > FAILOVER_TIMEOUT:
+            raise Exception("No backup took over")
+        sends_before = connector.sends
+        start = time.time()
+        resp = connector.send_request(conn_schema.SendRequest("bench0", "bench1", f"chat {sent}"))
+        sent += 1
+        if connector.sends > sends_before + 1:
+            retried += 1
+        if not resp.success:
+            failed += 1
+            continue
+        if killed is not None:
+            stall = max(stall, time.time() - start)
+            if first_success is None:
+                first_success = time.time()
+            served_after += 1
+    new_primary = connector.primary_identity.name
+    dead = [node.first_line(f"Machine {primary} is dead", killed)
+            for (name, node) in nodes.items() if name != primary]
+    dead = [when for when in dead if when is not None]
+    promoted = nodes[new_primary].first_line("is now primary", killed)
+    connector.kill()
+    return {
+        "run": run,
+        "manager": manager,
+        "killed": primary,
+        "new_primary": new_primary,
+        # Until the first backup took the primary for dead, and until the
+        # new primary took over
+        "detection_s": round(min(dead) - killed, 4) if dead else None,
+        "promotion_s": round(promoted - killed, 4) if promoted is not None else None,
+        # Until the client got its first answer from the new primary, and
+        # the longest a request took around the failover
+        "first_success_s": round(first_success - killed, 4),
+        "max_request_s": round(stall, 4),
+        "requests": sent,
+        "failed": failed,
+        "retried": retried,
+        "reconnects": connector.connects - connects_before,
+    }
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    kill_after = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    manager = sys.argv[3] if len(sys.argv) > 3 else consts.MANAGER
+    use_localhost()
+    results = []
+    for run in range(runs):
+        result = run_once(run, kill_after, manager)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+    summary = {"summary": True, "manager": manager, "runs": runs, "kill_after": kill_after}
+    for key in ["detection_s", "promotion_s", "first_success_s", "max_request_s"]:
+        values = [result[key] for result in results if result[key] is not None]
+        summary[f"median_{key}"] = statistics.median(values) if values else None
+    for key in ["failed", "retried"]:
+        summary[f"total_{key}"] = sum(result[key] for result in results)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of one popular recipient's message history: receiving chats by
+inserting at the front of a list versus appending to the message log
+(history.py), and answering logs by filtering the whole history and
+slicing the page out of the result versus the author index, for a few
+kinds of wildcard:
+
+    python3 -m benchmarks.history [chats]
+"""
+import sys
+import random
+from benchmarks.timing import best_of
+from history import MessageLog
+from schema import Chat
+from server import LOG_PAGE_SIZE
+
+AUTHORS = 2000
+
+
+def scan_page(msg_hist, wildcard: str, page: int):
+    """
+    What handle_logs did before the author index
+    """
+    satisfying = filter(lambda msg: wildcard in msg.author_id, msg_hist)
+    return list(satisfying)[page * LOG_PAGE_SIZE: (page + 1) * LOG_PAGE_SIZE]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rng = random.Random(13)
+    authors = [f"user{ix}" for ix in range(AUTHORS)]
+    chats = [Chat(rng.choice(authors), "popular", f"chat {ix}") for ix in range(count)]
+
+    def receive_list():
+        msg_log = []
+        for chat in chats:
+            msg_log.insert(0, chat)
+        received[0] = msg_log
+
+    def receive_log():
+        msg_log = MessageLog("popular")
+        for chat in chats:
+            msg_log.append(chat)
+        received[1] = msg_log
+    received = [None, None]
+    listed = best_of(receive_list, runs=1)
+    logged = best_of(receive_log, runs=1)
+    print(f"{count} chats received: {listed:.2f}s inserting at the front, {logged:.2f}s appending "
+          f"({listed / count * 1e6:.1f}us vs {logged / count * 1e6:.2f}us per chat)")
+
+    (msg_list, msg_log) = received
+    queries = [
+        ("everyone, first page", "", 0),
+        ("everyone, middle page", "", count // LOG_PAGE_SIZE // 2),
+        ("one author", "user1234", 0),
+        ("one author, page 10", "user1234", 10),
+        ("a few authors", "user12", 0),
+        ("every author", "user", 0),
+    ]
+    print(f"{'query':<24}{'matches':>9}{'scan ms':>10}{'index ms':>10}")
+    for (name, wildcard, page) in queries:
+        matches = sum(1 for chat in chats if wildcard in chat.author_id)
+        scanned = best_of(lambda: scan_page(msg_list, wildcard, page), runs=3)
+        index = best_of(lambda: msg_log.page(wildcard, LOG_PAGE_SIZE, page), runs=5)
+        print(f"{name:<24}{matches:>9}{scanned * 1000:>10.2f}{index * 1000:>10.3f}")
+
+    # Walking every page of one author: the scan goes over the whole
+    # history for every page, the cursor picks up where the last page ended
+    wildcard = "user1234"
+    pages = [0]
+
+    def walk():
+        before = None
+        pages[0] = 0
+        while True:
+            (found, more) = msg_log.page(wildcard, LOG_PAGE_SIZE, 0, before)
+            pages[0] += 1
+            if not more:
+                return
+            before = found[-1]
+    walked = best_of(walk, runs=3)
+    per_scan = best_of(lambda: scan_page(msg_list, wildcard, 0), runs=1)
+    print(f"all {pages[0]} pages of '{wildcard}': {walked * 1000:.2f}ms by cursor, "
+          f"about {per_scan * pages[0] * 1000:.0f}ms by scanning for every page")
+
+
+if __name__ == "__main__":
+    main()
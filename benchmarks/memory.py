@@ -0,0 +1,194 @@
+"""
+Benchmark of the memory taken by stored messages: every recipient keeping
+a list of dict-backed chat objects, each with its own copies of the author
+and recipient ids (as they come off the wire), versus message logs
+(history.py) with interned ids and array-backed columns, and those logs
+with the text index a log builds on its first search. Also compares a
+few objects made by the million, slotted versus dict-backed, and what
+keeping track of undelivered chats costs for a million accounts: a Queue
+per account holding a copy of every undelivered chat, versus positions
+into the message logs for only the accounts that have any:
+
+    python3 -m benchmarks.memory [messages] [accounts]
+"""
+import sys
+import random
+import tracemalloc
+from queue import Queue
+import connections.schema as conn_schema
+from history import MessageLog, Undelivered
+from schema import Account, Chat
+from search import TextIndex
+
+RECIPIENTS = 1000
+AUTHORS = 10_000
+OBJECTS = 100_000
+# Share of accounts with undelivered chats, and how many each has
+PENDING_SHARE = 0.02
+PENDING_CHATS = 5
+# A Queue per account takes a few KB: queues are measured for this many
+# accounts and scaled up, so that a million of them need not fit in memory
+QUEUE_SAMPLE = 100_000
+
+
+class PlainChat:
+    """
+    A chat as it was before it was slotted
+    """
+
+    def __init__(self, author_id, recipient_id, text):
+        self.author_id = author_id
+        self.recipient_id = recipient_id
+        self.text = text
+
+
+class Plain:
+    """
+    Takes any attributes, like the classes before they were slotted
+    """
+
+
+def traced(func):
+    """
+    Returns (what func made, bytes it left allocated)
+    """
+    tracemalloc.start()
+    made = func()
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (made, size)
+
+
+def copy(text: str) -> str:
+    # A string decoded off the wire is a new object every time
+    return text.encode().decode()
+
+
+def make_sends(count: int):
+    rng = random.Random(19)
+    recipients = [f"user{ix}" for ix in range(RECIPIENTS)]
+    authors = [f"user{ix}" for ix in range(AUTHORS)]
+    words = ["lunch", "friday", "hello", "meeting", "tomorrow", "ok", "thanks", "see", "you", "at"]
+    return [(rng.choice(authors), rng.choice(recipients), " ".join(rng.choices(words, k=rng.randint(2, 12))))
+            for _ in range(count)]
+
+
+def as_lists(sends):
+    msg_logs = {}
+    for (author_id, recipient_id, text) in sends:
+        msg_logs.setdefault(recipient_id, []).append(PlainChat(copy(author_id), copy(recipient_id), copy(text)))
+    return msg_logs
+
+
+def as_message_logs(sends):
+    msg_logs = {}
+    for (author_id, recipient_id, text) in sends:
+        if recipient_id not in msg_logs:
+            msg_logs[recipient_id] = MessageLog(recipient_id)
+        msg_logs[recipient_id].append(Chat(copy(author_id), copy(recipient_id), copy(text)))
+    return msg_logs
+
+
+def as_text_indexes(sends):
+    texts = {}
+    for (_, recipient_id, text) in sends:
+        texts.setdefault(recipient_id, []).append(text)
+    indexes = {}
+    for (recipient_id, received) in texts.items():
+        indexes[recipient_id] = TextIndex(received.__getitem__)
+        for (position, text) in enumerate(received):
+            indexes[recipient_id].add(position, text)
+    return indexes
+
+
+def per_object(make, fields):
+    """
+    Bytes per object for OBJECTS slotted objects, and for as many
+    dict-backed objects with the same attributes
+    """
+    (_, slotted) = traced(lambda: [make(ix) for ix in range(OBJECTS)])
+
+    def plain(ix):
+        obj = Plain()
+        obj.__dict__.update(fields(make(ix)))
+        return obj
+    (_, dicts) = traced(lambda: [plain(ix) for ix in range(OBJECTS)])
+    return (dicts / OBJECTS, slotted / OBJECTS)
+
+
+def undelivered_cost(accounts: int):
+    """
+    Bytes for tracking the undelivered chats of accounts users, both ways,
+    leaving out the accounts and message logs themselves (queues are
+    measured for QUEUE_SAMPLE of them)
+    """
+    rng = random.Random(23)
+    users = {f"user{ix}": Account(f"user{ix}") for ix in range(accounts)}
+    pending = rng.sample(sorted(users), int(accounts * PENDING_SHARE))
+    for user_id in pending:
+        for ix in range(PENDING_CHATS):
+            users[user_id].msg_log.append(Chat("mark", user_id, f"chat {ix}"))
+
+    sample = min(accounts, QUEUE_SAMPLE)
+    sampled = set(f"user{ix}" for ix in range(sample))
+
+    def queues():
+        msg_cache = {user_id: Queue() for user_id in sampled}
+        for user_id in sampled.intersection(pending):
+            for chat in users[user_id].msg_log.oldest(PENDING_CHATS):
+                # A second Chat, besides the one in the message log
+                msg_cache[user_id].put(Chat(copy(chat.author_id), copy(chat.recipient_id), copy(chat.text)))
+        return msg_cache
+
+    def positions():
+        undelivered = Undelivered()
+        for user_id in pending:
+            undelivered.add(user_id, len(users[user_id].msg_log) - PENDING_CHATS)
+        return undelivered
+    (_, queued) = traced(queues)
+    (_, positioned) = traced(positions)
+    return (queued * accounts / sample, positioned, len(pending))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000
+    sends = make_sends(count)
+    text_bytes = sum(len(text) for (_, _, text) in sends) / count
+    (_, listed) = traced(lambda: as_lists(sends))
+    (_, logged) = traced(lambda: as_message_logs(sends))
+    (_, indexed) = traced(lambda: as_text_indexes(sends))
+    print(f"{count} messages to {RECIPIENTS} users from {AUTHORS}, {text_bytes:.0f} bytes of text on average")
+    print(f"{'stored as':<40}{'MB':>8}{'bytes/message':>15}")
+    rows = [
+        ("lists of dict-backed chats", listed),
+        ("message logs", logged),
+        ("message logs, all searched once", logged + indexed),
+    ]
+    for (name, size) in rows:
+        print(f"{name:<40}{size / 2 ** 20:>8.1f}{size / count:>15.1f}")
+
+    def chat_fields(chat):
+        return {"author_id": chat.author_id, "recipient_id": chat.recipient_id, "text": chat.text}
+
+    def request_fields(req):
+        return {name: getattr(req, name) for cls in type(req).__mro__ for name in getattr(cls, "__slots__", ())}
+    objects = [
+        ("Chat", lambda ix: Chat("mark", "ream", "hi"), chat_fields),
+        ("Account", lambda ix: Account(f"user{ix}"), lambda account: {"user_id": account.user_id, "msg_log": account.msg_log}),
+        ("SendRequest", lambda ix: conn_schema.SendRequest("mark", "ream", "hi"), request_fields),
+        ("Response", lambda ix: conn_schema.Response("mark", True, ""), request_fields),
+    ]
+    print(f"{'object':<16}{'dict bytes':>12}{'slotted bytes':>15}")
+    for (name, make, fields) in objects:
+        (dicts, slotted) = per_object(make, fields)
+        print(f"{name:<16}{dicts:>12.0f}{slotted:>15.0f}")
+
+    (queued, positioned, pending) = undelivered_cost(accounts)
+    print(f"undelivered chats of {accounts} accounts, {pending} with {PENDING_CHATS} each: "
+          f"{queued / 2 ** 20:.0f} MB as queues, {positioned / 2 ** 20:.2f} MB as positions "
+          f"({queued / accounts:.0f} vs {positioned / accounts:.1f} bytes per account)")
+
+
+if __name__ == "__main__":
+    main()
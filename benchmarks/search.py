@@ -0,0 +1,71 @@
+"""
+Benchmark of search on one recipient's message history: testing the words
+of every message versus the text index (search.py). Reports what building
+the index on the first search costs, how much memory the index takes (which
+stops growing once it holds INDEX_POSTINGS postings), and the time for a
+page of a few queries:
+
+    python3 -m benchmarks.search [chats]
+"""
+import sys
+import random
+import tracemalloc
+from benchmarks.timing import best_of
+from history import MessageLog
+from schema import Chat
+from search import INDEX_BUDGET, INDEX_POSTINGS, TEXT_INDEXES, terms
+from server import SEARCH_PAGE_SIZE
+
+VOCABULARY = 20_000
+
+
+def make_texts(count: int):
+    rng = random.Random(17)
+    # Word frequencies roughly follow Zipf's law, as in real text
+    words = [f"word{ix}" for ix in range(VOCABULARY)]
+    weights = [1 / (ix + 1) for ix in range(VOCABULARY)]
+    return [" ".join(rng.choices(words, weights, k=rng.randint(3, 30))) for _ in range(count)]
+
+
+def scan_page(msg_log, query: str):
+    """
+    What finding a message took before search: going through every one
+    """
+    wanted = terms(query)
+    found = [chat for chat in msg_log if wanted & terms(chat.text)]
+    return found[:SEARCH_PAGE_SIZE]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    chats = [Chat("mark", "popular", text) for text in make_texts(count)]
+    msg_log = MessageLog("popular", chats)
+    # The index is built on the first search, and then kept
+    TEXT_INDEXES.discard(msg_log)
+    built = best_of(lambda: (TEXT_INDEXES.discard(msg_log), msg_log.search("word1", SEARCH_PAGE_SIZE)), runs=1)
+    TEXT_INDEXES.discard(msg_log)
+    tracemalloc.start()
+    msg_log.search("word1", SEARCH_PAGE_SIZE)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    index = TEXT_INDEXES.peek(msg_log)
+    print(f"{count} chats, first search builds the index in {built * 1000:.0f}ms "
+          f"({built / count * 1e6:.1f}us per chat), "
+          f"{len(index)} newest indexed in {index.size} postings (at most {INDEX_POSTINGS})")
+    print(f"index: {size / 2 ** 20:.1f} MB, all indexes together kept under {INDEX_BUDGET} postings")
+
+    queries = [
+        ("common word", "word1"),
+        ("rare word", f"word{VOCABULARY - 7}"),
+        ("two words", "word10 word200"),
+        ("five words", "word3 word40 word500 word6000 word7"),
+    ]
+    print(f"{'query':<16}{'scan ms':>10}{'index ms':>10}")
+    for (name, query) in queries:
+        scanned = best_of(lambda: scan_page(msg_log, query), runs=1)
+        found = best_of(lambda: msg_log.search(query, SEARCH_PAGE_SIZE), runs=5)
+        print(f"{name:<16}{scanned * 1000:>10.2f}{found * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import gc
+import time
+
+
+def best_of(func, runs=5):
+    """
+    Returns the fastest of a few runs of func, in seconds. The garbage
+    collector is paused while timing so that whatever else is alive in the
+    process doesn't skew comparisons.
+    """
+    best = None
+    for _ in range(runs):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
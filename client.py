@@ -1,22 +1,36 @@
 import pdb
+import sys
 import utils
 from connections.connector import ClientConnector
+import connections.consts as consts
 import connections.schema as conn_schema
 from concurrent import futures
 import time
 from threading import Thread
 
 
+def page_name(page: str) -> str:
+    """
+    How to show the page a list or logs asked for, "next" going on from
+    the last one
+    """
+    return "the next page" if page == "next" else f"page {page}"
+
+
 class Client:
     """
     A bare-bones client that connects to a given host and port
     """
 
-    def __init__(self):
-        self.connector = ClientConnector()
+    def __init__(self, read_from_backups=False):
+        self.connector = ClientConnector(read_from_backups=read_from_backups)
         ping_thread = Thread(target=self.ping_server)
         ping_thread.start()
         self.user_id = ""
+        # The wildcard of the last list, and the cursor that resumes it
+        self.list_query = None
+        # The same for the last logs
+        self.logs_query = None
 
     def is_logged_in(self):
         """
@@ -30,14 +44,13 @@ class Client:
         """
         Checks the primary regularly and relogs in if needed
         """
-        FREQUENCY = 1
-        time.sleep(FREQUENCY)
+        time.sleep(consts.HEARTBEAT_INTERVAL)
         while True:
             okay = self.connector.ping_server()
             if not okay:
                 self.connector.attempt_connection()
                 self.relogin()
-            time.sleep(FREQUENCY)
+            time.sleep(consts.HEARTBEAT_INTERVAL)
 
     def handle_create(self):
         """
@@ -140,21 +153,32 @@ class Client:
             utils.print_error(
                 "Error: wildcard cannot be longer than 8 characters")
             return
-        page = input("> Input a page to return: ")
-        page_int = None
-        try:
-            page_int = int(page)
-        except:
-            utils.print_error("Error: page must be an integer")
-            return
-        req = conn_schema.ListRequest(self.user_id, wildcard, page_int)
+        page = input("> Input a page to return (or 'next' to go on from the last list): ")
+        page_int = 0
+        cursor = ""
+        if page == "next":
+            if self.list_query is None or self.list_query[0] != wildcard:
+                utils.print_error("Error: no list with that filter to go on from")
+                return
+            if self.list_query[1] == "":
+                utils.print_error("Error: no more users matching '{}'".format(wildcard))
+                return
+            cursor = self.list_query[1]
+        else:
+            try:
+                page_int = int(page)
+            except:
+                utils.print_error("Error: page must be an integer")
+                return
+        req = conn_schema.ListRequest(self.user_id, wildcard, page_int, cursor=cursor)
         self.relogin()
         resp = self.connector.send_request(req)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
-        utils.print_info("{} users on page {} matching '{}'".format(
-            len(resp.accounts), page_int, wildcard))
+        self.list_query = (wildcard, resp.cursor)
+        utils.print_info("{} users on {} matching '{}'".format(
+            len(resp.accounts), page_name(page), wildcard))
         for account in resp.accounts:
             print(account.user_id)
 
@@ -206,6 +230,47 @@ class Client:
             utils.print_error(
                 "Error: wildcard cannot be longer than 8 characters")
             return
+        page = input("> Input a page to return (or 'next' to go on from the last logs): ")
+        page_int = 0
+        cursor = ""
+        if page == "next":
+            if self.logs_query is None or self.logs_query[0] != wildcard:
+                utils.print_error("Error: no logs with that filter to go on from")
+                return
+            if self.logs_query[1] == "":
+                utils.print_error("Error: no more messages matching '{}'".format(wildcard))
+                return
+            cursor = self.logs_query[1]
+        else:
+            try:
+                page_int = int(page)
+            except:
+                utils.print_error("Error: page must be an integer")
+                return
+        req = conn_schema.LogsRequest(self.user_id, wildcard, page_int, cursor=cursor)
+        self.relogin()
+        resp = self.connector.send_request(req)
+        if not resp.success:
+            utils.print_error("Error: {}".format(resp.error_message))
+            return
+        self.logs_query = (wildcard, resp.cursor)
+        utils.print_info("{} messages on {} matching '{}'".format(
+            len(resp.msgs), page_name(page), wildcard))
+        for msg in resp.msgs:
+            print(msg.pretty())
+
+    def handle_search(self):
+        if not self.is_logged_in():
+            utils.print_error("Error: You must be logged in to search messages")
+            return
+        query = input("> Input words to search for: ")
+        if len(query) > 280:
+            utils.print_error(
+                "Error: search cannot be longer than 280 characters")
+            return
+        if "@@" in query:
+            utils.print_error("Error: search cannot contain \"@@\"")
+            return
         page = input("> Input a page to return: ")
         page_int = None
         try:
@@ -213,14 +278,14 @@ class Client:
         except:
             utils.print_error("Error: page must be an integer")
             return
-        req = conn_schema.LogsRequest(self.user_id, wildcard, page_int)
+        req = conn_schema.SearchRequest(self.user_id, query, page_int)
         self.relogin()
         resp = self.connector.send_request(req)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
         utils.print_info("{} messages on page {} matching '{}'".format(
-            len(resp.msgs), page_int, wildcard))
+            len(resp.msgs), page_int, query))
         for msg in resp.msgs:
             print(msg.pretty())
 
@@ -245,6 +310,8 @@ class Client:
             return self.handle_send
         elif input_str == "logs":
             return self.handle_logs
+        elif input_str == "search":
+            return self.handle_search
         elif input_str == "fallover":
             return self.handle_fallover
         else:
@@ -266,5 +333,5 @@ class Client:
 
 if __name__ == "__main__":
     executor = futures.ThreadPoolExecutor()
-    client = Client()
+    client = Client(read_from_backups="--read-from-backups" in sys.argv)
     client.start()
@@ -0,0 +1,174 @@
+import asyncio
+import socket
+from threading import Thread
+import connections.consts as consts
+import connections.framing as framing
+from connections.heartbeat import PhiAccrualDetector
+from connections.manager import ConnectionManager
+from connections.schema import Machine, PingResponse
+
+
+class AsyncConnectionManager(ConnectionManager):
+    """
+    A ConnectionManager that serves every client, internal and health
+    socket from one asyncio event loop, on one thread, instead of a thread
+    per socket. The server uses it exactly like a ConnectionManager
+    (request_generator, send_response, broadcast_to_backups, ...).
+    Connected sockets stay blocking: the loop only watches them for
+    reading, and once one is readable does the single recv its FrameReader
+    needs, which can't block. So the backup senders, the ack loop and the
+    responder keep writing to them with sendall from their own threads.
+    Every recv on the loop lands in the same buffer, so idle connections
+    don't each hold one.
+    Catching up a machine that rejoins takes long and blocks, so that
+    still gets a thread of its own.
+    """
+
+    def __init__(self, identity: Machine):
+        super().__init__(identity)
+        self.loop = asyncio.new_event_loop()
+        self.chunk = bytearray(framing.RECV_SIZE)  # Only ever used on the loop
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def listen_on(self, port: int, sock=None):
+        """
+        Returns a listening socket for the given port, that the loop can
+        accept from without blocking
+        """
+        sock = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.identity.host_ip, port))
+        sock.listen()
+        sock.setblocking(False)
+        return sock
+
+    def watch(self, fd: int, on_readable):
+        """
+        Calls on_readable on the loop whenever fd is readable
+        """
+        def watch_on_loop():
+            # A socket closed by another thread can leave its fd behind,
+            # which a new socket may have been given since
+            self.loop.remove_reader(fd)
+            self.loop.add_reader(fd, on_readable)
+        self.loop.call_soon_threadsafe(watch_on_loop)
+
+    def watch_frames(self, sock, on_frame, on_close):
+        """
+        Calls on_frame on the loop with every frame that arrives on sock,
+        and on_close once it is closed or on_frame raises
+        """
+        fd = sock.fileno()
+
+        def readable():
+            try:
+                frames = framing.recv_available(sock, self.chunk)
+                if frames is None:
+                    raise Exception("Connection closed")
+                for frame in frames:
+                    on_frame(frame)
+            except Exception:
+                self.loop.remove_reader(fd)
+                on_close()
+        self.watch(fd, readable)
+
+    def watch_accepts(self, sock, on_accept):
+        """
+        Calls on_accept on the loop with every connection accepted on sock
+        """
+        def readable():
+            try:
+                (conn, _) = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception:
+                self.loop.remove_reader(sock.fileno())
+                return
+            conn.setblocking(True)
+            on_accept(conn)
+        self.watch(sock.fileno(), readable)
+
+    def consume(self, name: str, sock):
+        conn_codec = self.get_internal_codec(name)
+        self.watch_frames(sock, lambda frame: self.on_internal_frame(name, conn_codec, frame), sock.close)
+
+    def serve_rejoins(self):
+        self.rejoin_socket = self.listen_on(self.identity.internal_port)
+
+        def on_accept(conn):
+            accept_thread = Thread(target=self.accept_rejoin, args=(conn,), daemon=True)
+            accept_thread.start()
+        self.watch_accepts(self.rejoin_socket, on_accept)
+
+    def serve_health(self):
+        self.health_socket = self.listen_on(self.identity.health_port)
+        self.watch_accepts(self.health_socket, self.answer_health)
+
+    def answer_health(self, conn):
+        """
+        Answers every ping that arrives on conn, until it is closed
+        """
+        resp = PingResponse().marshal()
+        self.watch_frames(conn, lambda _: framing.send_message(conn, resp), conn.close)
+
+    def serve_probes(self):
+        asyncio.run_coroutine_threadsafe(self.probe_loop(), self.loop)
+
+    async def probe_loop(self):
+        """
+        Keeps a heartbeat going to every living sibling, see probe_health
+        """
+        while self.alive:
+            await asyncio.sleep(consts.HEARTBEAT_INTERVAL)
+            for sibling in list(self.living_siblings):
+                self.watch_sibling(sibling)
+            self.check_siblings()
+
+    def start_heartbeat(self, sibling: Machine, detector: PhiAccrualDetector):
+        asyncio.run_coroutine_threadsafe(self.heartbeat_channel(sibling, detector), self.loop)
+
+    async def heartbeat_channel(self, sibling: Machine, detector: PhiAccrualDetector):
+        """
+        The heartbeat to a sibling as a task on the loop, see heartbeat
+        """
+        ping = framing.frame(PingResponse().marshal().encode())
+        timeout = consts.HEARTBEAT_TIMEOUT
+        writer = None
+        while self.is_watching(sibling.name, detector):
+            started = self.loop.time()
+            try:
+                if writer is None:
+                    (reader, writer) = await asyncio.wait_for(
+                        asyncio.open_connection(sibling.host_ip, sibling.health_port), timeout)
+                writer.write(ping)
+                header = await asyncio.wait_for(reader.readexactly(framing.HEADER.size), timeout)
+                (length,) = framing.HEADER.unpack(header)
+                await asyncio.wait_for(reader.readexactly(length), timeout)
+                detector.heartbeat()
+            except Exception:
+                if writer is not None:
+                    writer.close()
+                    writer = None
+            await asyncio.sleep(max(consts.HEARTBEAT_INTERVAL - (self.loop.time() - started), 0))
+        if writer is not None:
+            writer.close()
+
+    def serve_clients(self):
+        self.external_socket = self.listen_on(self.identity.client_port)
+
+        def on_accept(conn):
+            name = self.greet_client(conn)
+            if name is not None:
+                self.serve_client(name)
+        self.watch_accepts(self.external_socket, on_accept)
+
+    def serve_client(self, name: str):
+        with self.client_lock:
+            conn = self.client_sockets[name]
+        self.watch_frames(conn, lambda frame: self.on_client_frame(name, conn, frame),
+                          lambda: self.drop_client(name, conn))
+
+    def kill(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        super().kill()
@@ -0,0 +1,412 @@
+import struct
+from itertools import accumulate
+from typing import List
+import schema as data_schema
+import connections.schema as conn_schema
+
+
+class TextCodec:
+    """
+    The original wire format: the "@@" separated strings from marshal and
+    unmarshal. Every peer speaks it, so it is the fallback.
+    """
+    name = "text"
+
+    def encode_request(self, req: conn_schema.Request) -> bytes:
+        return req.marshal().encode()
+
+    def encode_entry(self, req: conn_schema.Request, lsn: int, term: int) -> bytes:
+        return conn_schema.Request.marshal_entry(req, lsn, term).encode()
+
+    def decode_request(self, data) -> conn_schema.Request:
+        return conn_schema.Request.unmarshal(bytes(data).decode())
+
+    def encode_response(self, resp: conn_schema.Response) -> bytes:
+        return resp.marshal().encode()
+
+    def decode_response(self, data) -> conn_schema.Response:
+        return conn_schema.Response.unmarshal(bytes(data).decode())
+
+
+# Compact tags for request and response types, these must never be
+# renumbered. "blank" is the bare Request base class.
+REQUEST_TAGS = {
+    "blank": 0,
+    "create": 1,
+    "send": 2,
+    "delete": 3,
+    "notif": 4,
+    "login": 5,
+    "list": 6,
+    "logs": 7,
+    "fallover": 8,
+    "ack": 9,
+    "entry": 10,
+    # A notif delivering several chats at once
+    "notifs": 11,
+    "watermark": 12,
+    # A list with a cursor
+    "listfrom": 13,
+    # Logs with a cursor
+    "logsfrom": 14,
+    "search": 15,
+}
+RESPONSE_TAGS = {
+    "basic": 0,
+    "list": 1,
+    "logs": 2,
+    "notif": 3,
+    "ping": 4,
+    # A list answering a cursor, carrying the next one
+    "listcursor": 5,
+    # Logs answering a cursor, carrying the next one
+    "logscursor": 6,
+    "search": 7,
+}
+
+# Every binary message is a struct packed header (the type tag, then the
+# lengths of the variable fields and any integers) followed by all of the
+# string fields back to back as one utf-8 body. Lengths count characters,
+# so the body is decoded with a single call and then sliced, and the last
+# field has no length, it runs to the end of the body.
+# Lengths are 32 bit so that any field that fits in a frame fits here.
+USER_ONLY = struct.Struct(">B")  # tag | user_id
+SEND = struct.Struct(">BII")  # tag, len(user_id), len(recipient_id) | user_id, recipient_id, text
+PAGED = struct.Struct(">BIiQ")  # tag, len(user_id), page, min_progress | user_id, wildcard
+# tag, len(user_id), len(wildcard), page, min_progress | user_id, wildcard, cursor
+LIST_FROM = struct.Struct(">BIIiQ")
+ACK = struct.Struct(">BQ")  # tag, progress | user_id
+ENTRY = struct.Struct(">BQQ")  # tag, lsn, term | the replicated request, encoded
+NOTIFS = struct.Struct(">BI")  # tag, count | user_id
+WATERMARK = struct.Struct(">BQ")  # tag, watermark | user_id
+# tag, success, len(user_id), progress | user_id, error_message
+BASIC = struct.Struct(">B?IQ")
+# tag, success, len(user_id), len(error_message), len(author_id), len(recipient_id) | user_id, error_message, author_id, recipient_id, text
+NOTIF = struct.Struct(">B?IIII")
+# tag, success, len(user_id), len(error_message), count, progress | then
+# the lengths of every field of every item, then user_id, error_message
+# and every item's fields
+LISTING = struct.Struct(">B?IIIQ")
+ACCOUNT_FIELDS = 1  # user_id
+CHAT_FIELDS = 3  # author_id, recipient_id, text
+PAGE_LIMIT = 2 ** 31  # Pages must fit in the signed 32 bit page field
+
+
+def encode_user_only(req):
+    return USER_ONLY.pack(REQUEST_TAGS[req.type]) + req.user_id.encode()
+
+
+def encode_send(req):
+    return SEND.pack(REQUEST_TAGS["send"], len(req.user_id), len(req.recipient_id)) + \
+        f"{req.user_id}{req.recipient_id}{req.text}".encode()
+
+
+def checked_page(req) -> int:
+    """
+    The page of a list, logs or search request, which must fit in the
+    page field
+    """
+    page = int(req.page)
+    if not -PAGE_LIMIT <= page < PAGE_LIMIT:
+        raise ValueError(f"Page {req.page} is out of range")
+    return page
+
+
+def encode_paged(req):
+    return PAGED.pack(REQUEST_TAGS[req.type], len(req.user_id), checked_page(req), req.min_progress) + \
+        (req.user_id + req.wildcard).encode()
+
+
+def encode_search(req):
+    return PAGED.pack(REQUEST_TAGS["search"], len(req.user_id), checked_page(req), req.min_progress) + \
+        (req.user_id + req.query).encode()
+
+
+def decode_paged(data, request):
+    """
+    Also decodes search requests, whose query goes where the wildcard does
+    """
+    (_, a, page, min_progress) = PAGED.unpack_from(data)
+    body = data[PAGED.size:].decode()
+    return request(body[:a], body[a:], page, min_progress)
+
+
+def encode_list_request(req):
+    """
+    Also encodes logs requests, which carry the same fields
+    """
+    if req.cursor is None:
+        return encode_paged(req)
+    return LIST_FROM.pack(REQUEST_TAGS[f"{req.type}from"], len(req.user_id), len(req.wildcard), checked_page(req),
+                          req.min_progress) + (req.user_id + req.wildcard + req.cursor).encode()
+
+
+def decode_list_from(data, request=conn_schema.ListRequest):
+    (_, a, b, page, min_progress) = LIST_FROM.unpack_from(data)
+    body = data[LIST_FROM.size:].decode()
+    b += a
+    return request(body[:a], body[a:b], page, min_progress, body[b:])
+
+
+def encode_notif_request(req):
+    if req.count == 1:
+        return encode_user_only(req)
+    return NOTIFS.pack(REQUEST_TAGS["notifs"], req.count) + req.user_id.encode()
+
+
+def decode_notifs(data):
+    (_, count) = NOTIFS.unpack_from(data)
+    return conn_schema.NotifRequest(data[NOTIFS.size:].decode(), count)
+
+
+def encode_watermark(req):
+    return WATERMARK.pack(REQUEST_TAGS["watermark"], req.watermark) + req.user_id.encode()
+
+
+def decode_watermark(data):
+    (_, watermark) = WATERMARK.unpack_from(data)
+    return conn_schema.WatermarkRequest(data[WATERMARK.size:].decode(), watermark)
+
+
+def encode_ack(req):
+    return ACK.pack(REQUEST_TAGS["ack"], req.progress) + req.user_id.encode()
+
+
+def decode_ack(data):
+    (_, progress) = ACK.unpack_from(data)
+    return conn_schema.AckRequest(data[ACK.size:].decode(), progress)
+
+
+def encode_entry(req, lsn: int, term: int):
+    return ENTRY.pack(REQUEST_TAGS["entry"], lsn, term) + REQUEST_ENCODERS[req.type](req)
+
+
+def decode_entry(data):
+    (_, lsn, term) = ENTRY.unpack_from(data)
+    inner = data[ENTRY.size:]
+    req = REQUEST_DECODERS[inner[0]](inner)
+    (req.lsn, req.term) = (lsn, term)
+    return req
+
+
+def decode_send(data, unpack_from=SEND.unpack_from, size=SEND.size):
+    (_, a, b) = unpack_from(data)
+    body = data[size:].decode()
+    b += a
+    return conn_schema.SendRequest(body[:a], body[a:b], body[b:])
+
+
+# Dispatch tables from request type to encoder, and from tag to decoder
+REQUEST_ENCODERS = {
+    "blank": encode_user_only,
+    "create": encode_user_only,
+    "send": encode_send,
+    "delete": encode_user_only,
+    "notif": encode_notif_request,
+    "login": encode_user_only,
+    "list": encode_list_request,
+    "logs": encode_list_request,
+    "search": encode_search,
+    "fallover": encode_user_only,
+    "ack": encode_ack,
+    "watermark": encode_watermark,
+}
+REQUEST_DECODERS = {
+    REQUEST_TAGS["blank"]: lambda data: conn_schema.Request(data[1:].decode()),
+    REQUEST_TAGS["create"]: lambda data: conn_schema.CreateRequest(data[1:].decode()),
+    REQUEST_TAGS["send"]: decode_send,
+    REQUEST_TAGS["delete"]: lambda data: conn_schema.DeleteRequest(data[1:].decode()),
+    REQUEST_TAGS["notif"]: lambda data: conn_schema.NotifRequest(data[1:].decode()),
+    REQUEST_TAGS["login"]: lambda data: conn_schema.LoginRequest(data[1:].decode()),
+    REQUEST_TAGS["list"]: lambda data: decode_paged(data, conn_schema.ListRequest),
+    REQUEST_TAGS["logs"]: lambda data: decode_paged(data, conn_schema.LogsRequest),
+    REQUEST_TAGS["fallover"]: lambda data: conn_schema.FalloverRequest(data[1:].decode()),
+    REQUEST_TAGS["ack"]: decode_ack,
+    REQUEST_TAGS["entry"]: decode_entry,
+    REQUEST_TAGS["notifs"]: decode_notifs,
+    REQUEST_TAGS["watermark"]: decode_watermark,
+    REQUEST_TAGS["listfrom"]: decode_list_from,
+    REQUEST_TAGS["logsfrom"]: lambda data: decode_list_from(data, conn_schema.LogsRequest),
+    REQUEST_TAGS["search"]: lambda data: decode_paged(data, conn_schema.SearchRequest),
+}
+
+
+def encode_basic(resp):
+    return BASIC.pack(RESPONSE_TAGS[resp.type], resp.success, len(resp.user_id), resp.progress) + \
+        (resp.user_id + str(resp.error_message)).encode()
+
+
+def encode_notif(resp):
+    error_message = str(resp.error_message)
+    chat = resp.chat
+    return NOTIF.pack(RESPONSE_TAGS["notif"], resp.success, len(resp.user_id), len(error_message),
+                      len(chat.author_id), len(chat.recipient_id)) + \
+        (resp.user_id + error_message + chat.author_id + chat.recipient_id + chat.text).encode()
+
+
+def encode_listing(resp, fields: List[str], count: int, tag=None):
+    """
+    fields holds every field of every item, in order
+    """
+    error_message = str(resp.error_message)
+    lengths = [len(f) for f in fields]
+    return b"".join((
+        LISTING.pack(RESPONSE_TAGS[resp.type] if tag is None else tag, resp.success,
+                     len(resp.user_id), len(error_message), count, resp.progress),
+        struct.pack(f">{len(lengths)}I", *lengths),
+        (resp.user_id + error_message + "".join(fields)).encode(),
+    ))
+
+
+def encode_list(resp):
+    if resp.cursor is not None:
+        # The cursor goes last, as one more account
+        return encode_listing(resp, [a.user_id for a in resp.accounts] + [resp.cursor],
+                              len(resp.accounts) + 1, RESPONSE_TAGS["listcursor"])
+    return encode_listing(resp, [a.user_id for a in resp.accounts], len(resp.accounts))
+
+
+def chat_fields(msgs) -> List[str]:
+    fields = []
+    for c in msgs:
+        fields += (c.author_id, c.recipient_id, c.text)
+    return fields
+
+
+def encode_logs(resp):
+    fields = chat_fields(resp.msgs)
+    if resp.cursor is not None:
+        # The cursor goes last, as the author of one more chat
+        return encode_listing(resp, fields + [resp.cursor, "", ""], len(resp.msgs) + 1,
+                              RESPONSE_TAGS["logscursor"])
+    return encode_listing(resp, fields, len(resp.msgs))
+
+
+def encode_search_response(resp):
+    return encode_listing(resp, chat_fields(resp.msgs), len(resp.msgs))
+
+
+def decode_basic(data):
+    (tag, success, a, progress) = BASIC.unpack_from(data)
+    body = data[BASIC.size:].decode()
+    if tag == RESPONSE_TAGS["ping"]:
+        return conn_schema.PingResponse(body[:a])
+    resp = conn_schema.Response(body[:a], success, body[a:])
+    resp.progress = progress
+    return resp
+
+
+def decode_notif(data):
+    (_, success, a, b, c, d) = NOTIF.unpack_from(data)
+    body = data[NOTIF.size:].decode()
+    b += a
+    c += b
+    d += c
+    chat = data_schema.Chat(body[b:c], body[c:d], body[d:])
+    return conn_schema.NotifResponse(body[:a], success, body[a:b], chat)
+
+
+def decode_listing(data, fields_per_item: int):
+    """
+    Returns (user_id, success, error_message, fields, progress) where
+    fields holds every field of every item, in order
+    """
+    (_, success, a, b, count, progress) = LISTING.unpack_from(data)
+    total = count * fields_per_item
+    lengths = struct.unpack_from(f">{total}I", data, LISTING.size)
+    body = data[LISTING.size + 4 * total:].decode()
+    offsets = list(accumulate(lengths, initial=a + b))
+    fields = [body[start:end] for (start, end) in zip(offsets, offsets[1:])]
+    return (body[:a], success, body[a:a + b], fields, progress)
+
+
+def decode_list(data):
+    (user_id, success, error_message, fields, progress) = decode_listing(data, ACCOUNT_FIELDS)
+    resp = conn_schema.ListResponse(user_id, success, error_message,
+                                    list(map(data_schema.Account, fields)))
+    resp.progress = progress
+    return resp
+
+
+def decode_list_cursor(data):
+    (user_id, success, error_message, fields, progress) = decode_listing(data, ACCOUNT_FIELDS)
+    resp = conn_schema.ListResponse(user_id, success, error_message,
+                                    list(map(data_schema.Account, fields[:-1])), fields[-1])
+    resp.progress = progress
+    return resp
+
+
+def decode_logs(data, response=conn_schema.LogsResponse):
+    (user_id, success, error_message, fields, progress) = decode_listing(data, CHAT_FIELDS)
+    msgs = list(map(data_schema.Chat, fields[0::3], fields[1::3], fields[2::3]))
+    resp = response(user_id, success, error_message, msgs)
+    resp.progress = progress
+    return resp
+
+
+def decode_logs_cursor(data):
+    resp = decode_logs(data)
+    resp.cursor = resp.msgs.pop().author_id
+    return resp
+
+
+RESPONSE_ENCODERS = {
+    "basic": encode_basic,
+    "list": encode_list,
+    "logs": encode_logs,
+    "search": encode_search_response,
+    "notif": encode_notif,
+    "ping": encode_basic,
+}
+RESPONSE_DECODERS = {
+    RESPONSE_TAGS["basic"]: decode_basic,
+    RESPONSE_TAGS["list"]: decode_list,
+    RESPONSE_TAGS["logs"]: decode_logs,
+    RESPONSE_TAGS["notif"]: decode_notif,
+    RESPONSE_TAGS["ping"]: decode_basic,
+    RESPONSE_TAGS["listcursor"]: decode_list_cursor,
+    RESPONSE_TAGS["logscursor"]: decode_logs_cursor,
+    RESPONSE_TAGS["search"]: lambda data: decode_logs(data, conn_schema.SearchResponse),
+}
+
+
+class BinaryCodec:
+    """
+    A compact binary wire format. Every message is a struct packed header
+    (type tag, field lengths) followed by the fields as one utf-8 body.
+    Decoding unpacks the header in place, looks the tag up in a dispatch
+    table and slices the fields out of the body, without splitting strings
+    or walking an if chain. Fields may contain "@@", "##" and "||".
+    """
+    name = "binary"
+
+    def encode_request(self, req: conn_schema.Request) -> bytes:
+        return REQUEST_ENCODERS[req.type](req)
+
+    def encode_entry(self, req: conn_schema.Request, lsn: int, term: int) -> bytes:
+        return encode_entry(req, lsn, term)
+
+    def decode_request(self, data: bytes) -> conn_schema.Request:
+        return REQUEST_DECODERS[data[0]](data)
+
+    def encode_response(self, resp: conn_schema.Response) -> bytes:
+        return RESPONSE_ENCODERS[resp.type](resp)
+
+    def decode_response(self, data: bytes) -> conn_schema.Response:
+        return RESPONSE_DECODERS[data[0]](data)
+
+
+TEXT = TextCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in [BINARY, TEXT]}
+
+
+def negotiate(offered: List[str]) -> str:
+    """
+    Picks the first codec the other side offered that this side speaks,
+    falling back to text
+    """
+    for name in offered:
+        if name in CODECS:
+            return name
+    return TEXT.name
@@ -6,7 +6,9 @@ from queue import Queue
 from threading import Thread
 import connections.consts as consts
 import connections.errors as errors
-from connections.schema import Machine, Request, Response, PingResponse
+import connections.framing as framing
+import connections.codec as codec
+from connections.schema import READ_REQUEST_TYPES, Machine, Request, Response, PingResponse, NotifAckResponse, CodecRequest
 from utils import print_msg_box
 
 LEXOGRAPHIC = [consts.MACHINE_A, consts.MACHINE_B, consts.MACHINE_C]
@@ -17,12 +19,22 @@ class ClientConnector():
     On the client side, handles the dirty work of connecting to the server and
     doing things like sending/receiving requests, sending keep alives, and
     adapting when the primary goes down.
+    With read_from_backups, list and logs go to a backup instead (see
+    send_read), spreading reads over the machines.
     """
 
-    def __init__(self, attempt_conn=None):
+    def __init__(self, attempt_conn=None, read_from_backups=False):
         self.iconn = None  # Interactive connection, for sending requests and getting responses
         self.sconn = None  # Subscription connection, for receiving notifs only
+        self.rconn = None  # Read connection, to a backup, for list and logs
+        self.hconn = None  # Health connection, to the primary, for pings only
+        self.health_identity = None  # Who hconn is connected to
         self.primary_identity = None
+        self.read_identity = None
+        self.codec = codec.TEXT  # Codec negotiated on iconn
+        self.read_codec = codec.TEXT  # Codec negotiated on rconn
+        self.read_from_backups = read_from_backups
+        self.progress = 0  # Newest log progress seen in a response
         self.ix = 0
 
         # Loop through the servers in lexographic order and try to connect
@@ -43,69 +55,174 @@ class ClientConnector():
                 self.iconn = reset_sock if reset_sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.iconn.connect((self.primary_identity.host_ip,
                                     self.primary_identity.client_port))
-                data = self.iconn.recv(2048)
-                resp = Response.unmarshal(data.decode())
+                resp = Response.unmarshal(framing.recv_message(self.iconn))
                 if not resp.success:
                     raise ValueError("Server is not primary")
                     self.iconn = None
+                self.negotiate_codec()
             except Exception as e:
                 self.iconn = None
             self.ix = (self.ix + 1) % len(LEXOGRAPHIC)
 
-    def ping_server(self):
+    def negotiate_codec(self, conn=None):
         """
-        Makes sure the server is still there
+        Offers the server every codec this client speaks and returns the
+        one it picks. Servers that don't know about codecs answer with
+        an error, in which case we stay on text.
+        Without conn, this is about iconn, which switches to the codec.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        try:
-            sock.connect((self.primary_identity.host_ip,
-                         self.primary_identity.health_port))
-            ping = PingResponse()
-            sock.send(ping.marshal().encode())
-            sock.recv(2048)
-            sock.close()
-            return True
-        except:
-            return False
+        if conn is None:
+            self.codec = codec.TEXT
+        req = CodecRequest("", consts.CODECS)
+        framing.send_message(conn if conn else self.iconn, req.marshal())
+        data = framing.recv_message(conn if conn else self.iconn)
+        if not data:
+            raise Exception("Server closed connection")
+        resp = Response.unmarshal(data)
+        picked = codec.TEXT
+        if resp.success and resp.type == "codec" and resp.codec in codec.CODECS:
+            picked = codec.CODECS[resp.codec]
+        if conn is None:
+            self.codec = picked
+        return picked
+
+    def connect_for_reads(self, reset_sock=None):
+        """
+        Connects rconn to the first machine that answers and isn't the
+        primary. reset_sock is for testing purposes only.
+        """
+        for identity in LEXOGRAPHIC:
+            if identity == self.primary_identity:
+                continue
+            sock = reset_sock if reset_sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                # A backup that stops answering mustn't hang the client
+                sock.settimeout(consts.READ_TIMEOUT)
+                sock.connect((identity.host_ip, identity.client_port))
+                resp = Response.unmarshal(framing.recv_message(sock))
+                if resp.success:
+                    raise ValueError("Server is the primary")
+                self.read_codec = self.negotiate_codec(sock)
+                (self.rconn, self.read_identity) = (sock, identity)
+                return
+            except Exception:
+                sock.close()
+        raise Exception("No backup to read from")
+
+    def ping_server(self, sock=None):
+        """
+        Makes sure the server is still there. Pings go over one connection
+        to the primary's health port, kept open between calls; if that has
+        broken, or the primary has changed, a new one is made and tried
+        once before giving up. sock is for testing purposes only.
+        """
+        for _ in range(2):
+            try:
+                if self.hconn is None or self.health_identity != self.primary_identity:
+                    self.close_health()
+                    self.hconn = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock = None
+                    self.health_identity = self.primary_identity
+                    self.hconn.settimeout(consts.HEARTBEAT_TIMEOUT)
+                    self.hconn.connect((self.primary_identity.host_ip,
+                                        self.primary_identity.health_port))
+                framing.send_message(self.hconn, PingResponse().marshal())
+                if framing.recv_frame(self.hconn) is None:
+                    raise Exception("Server closed connection")
+                return True
+            except:
+                self.close_health()
+        return False
+
+    def close_health(self):
+        if self.hconn:
+            self.hconn.close()
+        self.hconn = None
 
     def send_request(self, req: Request):
         """
         Sends a request to the server.
         NOTE: Hangs, does not return until a response has been sent
         """
+        if self.read_from_backups and req.type in READ_REQUEST_TYPES:
+            return self.send_read(req)
+        return self.send_to_primary(req)
+
+    def send_read(self, req: Request, min_progress=None):
+        """
+        Sends a read to a backup. The backup answers once it has applied
+        min_progress records, by default the newest progress this client
+        has seen, so that the client always reads its own writes. If no
+        backup can answer within READ_TIMEOUT, or the backup fails the read,
+        it goes to the primary.
+        """
+        req.min_progress = self.progress if min_progress is None else min_progress
+        try:
+            if not self.rconn:
+                self.connect_for_reads()
+            framing.send_frame(self.rconn, self.read_codec.encode_request(req))
+            data = framing.recv_frame(self.rconn)
+            if not data:
+                raise Exception("Server closed connection")
+            response = self.read_codec.decode_response(data)
+            if response.type in READ_REQUEST_TYPES:
+                self.progress = max(self.progress, response.progress)
+                return response
+            # The backup is too far behind, or no longer a backup
+        except Exception as e:
+            if self.rconn:
+                self.rconn.close()
+            self.rconn = None
+        return self.send_to_primary(req)
+
+    def send_to_primary(self, req: Request):
+        """
+        Sends a request to the primary, finding it again if it went down
+        NOTE: Hangs, does not return until a response has been sent
+        """
+        # Encoding errors are about the request, not the connection, so they
+        # are raised rather than retried
+        payload = self.codec.encode_request(req)
         try:
-            self.iconn.send(req.marshal().encode())
-            data = self.iconn.recv(2048)
+            framing.send_frame(self.iconn, payload)
+            data = framing.recv_frame(self.iconn)
             if not data:
                 raise Exception("Server closed connection")
-            response = Response.unmarshal(data.decode())
+            response = self.codec.decode_response(data)
             if response == None:
                 raise Exception("Bad response")
+            self.progress = max(self.progress, response.progress)
             return response
         except Exception as e:
             self.iconn.close()
             self.iconn = None
             self.attempt_connection()
-            return self.send_request(req)
+            return self.send_to_primary(req)
 
     def watch_chats(self, conn):
         """
         Will do receives on this connection until it dies, expecting
-        all data received to be of the form of NotifResponse
+        all data received to be notifs (one chat or a batch) or pings
         """
         try:
             while True:
-                data = conn.recv(2048)
+                data = framing.recv_message(conn)
                 if not data or len(data) <= 0:
                     raise Exception("Server closed connection")
-                resp = Response.unmarshal(data.decode())
-                if resp.type not in ["notif", "ping"] or not resp.success:
+                resp = Response.unmarshal(data)
+                if resp.type not in ["notif", "notifs", "ping"] or not resp.success:
                     raise Exception("Bad response")
                 if resp.type == "notif":
                     print_msg_box(resp.chat)
+                if resp.type == "notifs":
+                    for chat in resp.msgs:
+                        print_msg_box(chat)
+                    # Every batch so far is shown, and the window is free again
+                    ack = NotifAckResponse(resp.user_id, resp.seq, consts.NOTIF_CREDIT)
+                    framing.send_message(conn, ack.marshal())
+                    continue
                 ping = PingResponse()
-                conn.send(ping.marshal().encode())
+                framing.send_message(conn, ping.marshal())
         except Exception as e:
             conn.close()
 
@@ -122,9 +239,8 @@ class ClientConnector():
             self.sconn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sconn.connect((self.primary_identity.host_ip,
                                 self.primary_identity.notif_port))
-            self.sconn.send(user_id.encode())
-            data = self.sconn.recv(2048)
-            resp = Response.unmarshal(data.decode())
+            framing.send_message(self.sconn, f"{user_id}@@{consts.NOTIF_CREDIT}")
+            resp = Response.unmarshal(framing.recv_message(self.sconn))
             if not resp.success:
                 raise Exception("Subscription failed")
             watcher = Thread(target=self.watch_chats, args=(self.sconn,))
@@ -136,5 +252,8 @@ class ClientConnector():
     def kill(self):
         if self.iconn:
             self.iconn.close()
+        if self.rconn:
+            self.rconn.close()
         if self.sconn:
             self.sconn.close()
+        self.close_health()
@@ -34,6 +34,91 @@ MACHINE_C = Machine(
     connections=["A", "B"],
 )
 
+# Wire codecs this machine can speak, in order of preference. The text
+# format must stay in the list, it is the fallback for older peers.
+CODECS = ["binary", "text"]
+
+# How many records the primary lets queue up for one backup before giving
+# up on it. The request loop never waits on a backup, so a backup this far
+# behind is dropped instead of slowing everyone down.
+REPLICATION_QUEUE_SIZE = 10000
+
+# The most records a backup sender writes with one sendall
+REPLICATION_BATCH = 256
+
+# Catch up streams records in batches of this many, one sendall each
+CATCHUP_BATCH = 512
+
+# How many catch up batches may be on their way before the leader waits
+# for the machine catching up to ack one
+CATCHUP_WINDOW = 8
+
+# A machine at least this many records behind is caught up by sending it
+# the leader's newest snapshot and the records after it, instead of every
+# record it is missing
+CATCHUP_SNAPSHOT_GAP = 100000
+
+# When the primary answers a client that changed something
+# - "primary": once the primary has logged the request
+# - "quorum": once a majority of all machines (the primary included) have
+# - "all": once every living machine has
+COMMIT_PRIMARY = "primary"
+COMMIT_QUORUM = "quorum"
+COMMIT_ALL = "all"
+COMMIT_LEVELS = [COMMIT_PRIMARY, COMMIT_QUORUM, COMMIT_ALL]
+COMMIT_LEVEL = COMMIT_PRIMARY
+
+# Commit levels for particular request types, overriding COMMIT_LEVEL.
+# e.g. {"create": COMMIT_ALL}
+COMMIT_LEVEL_OVERRIDES = {}
+
+# Seconds the primary waits for backups to ack before telling the client
+# its request could not be replicated
+COMMIT_TIMEOUT = 5
+
+# Seconds a backup waits to have applied the progress a read asks for
+# (min_progress) before telling the client it is too far behind
+READ_WAIT = 1
+# Seconds a client waits for a backup to answer a read before sending it
+# to the primary instead, longer than READ_WAIT so that a backup that is
+# behind gets to say so
+READ_TIMEOUT = READ_WAIT + 2
+
+# Seconds a notif subscriber can go without hearing from the server before
+# it gets a ping, and seconds it has to answer a notif or a ping before it
+# is dropped
+NOTIF_CHECK_IN = 3
+NOTIF_TIMEOUT = 10
+
+# Most chats a client's subscription takes without acking them, the server
+# delivers in batches that fit in it
+NOTIF_CREDIT = 64
+# Most credit the server grants a subscriber, whatever it advertises, so
+# that no batch outgrows what a client's socket buffer takes
+NOTIF_MAX_CREDIT = 256
+
+# Machines keep a connection open to each sibling's health port (and
+# clients to the primary's) and ping over it every HEARTBEAT_INTERVAL
+# seconds. A machine is taken for dead once the phi accrual failure
+# detector's suspicion of it passes HEARTBEAT_PHI (at phi 8 it is wrong
+# about one time in 10^8), judging from the gaps between its last
+# HEARTBEAT_WINDOW answers, with a standard deviation of at least
+# HEARTBEAT_MIN_STD seconds. See connections/heartbeat.py
+HEARTBEAT_INTERVAL = 0.25
+HEARTBEAT_PHI = 8
+HEARTBEAT_WINDOW = 100
+HEARTBEAT_MIN_STD = 0.1
+# Seconds a ping over a heartbeat connection may take to be answered
+# before the connection is given up and made again
+HEARTBEAT_TIMEOUT = 1
+
+# How a server serves its sockets
+# - "threads": a thread for every socket (connections/manager.py)
+# - "asyncio": every socket on one event loop (connections/async_manager.py)
+MANAGER_THREADS = "threads"
+MANAGER_ASYNCIO = "asyncio"
+MANAGER = MANAGER_ASYNCIO
+
 # Create a mapping from machine name to information about it
 MACHINE_MAP = {
     "A": MACHINE_A,
@@ -49,16 +134,30 @@ def get_other_machines(name: str) -> list[str]:
     return [MACHINE_MAP[key] for key in MACHINE_MAP if key != name]
 
 
-def should_i_be_primary(name: str, living_siblings) -> bool:
+def primary_rank(name: str, rejoined=()):
+    """
+    Machines that never went down rank lexicographically, ahead of the ones
+    that rejoined a running cluster, which rank in the order they rejoined
+    """
+    return (rejoined.index(name) if name in rejoined else -1, name)
+
+
+def get_primary(names, rejoined=()):
+    """
+    The name of the machine that should be primary among the given names
+    """
+    return min(names, key=lambda name: primary_rank(name, rejoined), default=None)
+
+
+def should_i_be_primary(name: str, living_siblings, rejoined=()) -> bool:
     """
     A helper function that determines whether or not a machine should be
     the primary machine for a given set of siblings
     NOTE: This basically just enforces lexicographically ordering, i.e.
     at any given time the machine with the earliest name will see itself
-    as the primary machine. (correctly)
+    as the primary machine. (correctly) The exception are machines that
+    rejoined, see primary_rank, so that a machine coming back doesn't take
+    over from the primary that caught it up.
     """
     other_names = [sib.name for sib in living_siblings]
-    for other in other_names:
-        if other < name:
-            return False
-    return True
+    return get_primary([name] + other_names, rejoined) == name
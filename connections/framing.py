@@ -0,0 +1,160 @@
+import struct
+import threading
+import weakref
+
+# Every message on every socket is sent as a frame: a 4 byte big-endian
+# length followed by that many bytes of payload
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+
+class FrameReader:
+    """
+    Pulls frames out of a socket. A single recv can hold several frames, or
+    only part of one, so whatever is left over after a frame is kept for the
+    next call. The receive buffer is allocated on the first recv and reused
+    for every recv after that.
+    NOTE: Doesn't hold on to the socket, so that the registry below can
+    drop the reader as soon as the socket is gone.
+    """
+
+    def __init__(self) -> None:
+        self.chunk = None  # Where every recv lands
+        self.buffer = bytearray()  # Received but not yet returned
+        self.pos = 0  # Where the next frame starts in buffer
+        self.lock = threading.Lock()  # Held while reading a frame
+        self.send_lock = threading.Lock()  # Held while sending a frame
+
+    def fill(self, sock, chunk=None):
+        """
+        Does one recv. Returns False if the other side closed the socket.
+        chunk is where the recv lands, the reader's own buffer by default.
+        """
+        if self.pos > 0:
+            # Drop what has already been handed out before growing the buffer
+            del self.buffer[:self.pos]
+            self.pos = 0
+        if chunk is None:
+            if self.chunk is None:
+                self.chunk = bytearray(RECV_SIZE)
+            chunk = self.chunk
+        received = sock.recv_into(chunk)
+        if not received:
+            return False
+        self.buffer += memoryview(chunk)[:received]
+        return True
+
+    def next_frame(self):
+        """
+        Returns the next complete frame in the buffer, or None if there
+        isn't one yet
+        """
+        available = len(self.buffer) - self.pos
+        if available < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self.buffer, self.pos)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes is too big")
+        if available < HEADER.size + length:
+            return None
+        start = self.pos + HEADER.size
+        self.pos = start + length
+        return bytes(self.buffer[start:self.pos])
+
+    def recv_frame(self, sock):
+        """
+        Blocks until a whole frame has arrived and returns its payload.
+        Returns None if the socket was closed.
+        """
+        with self.lock:
+            while True:
+                frame = self.next_frame()
+                if frame is not None:
+                    return frame
+                if not self.fill(sock):
+                    return None
+
+    def recv_available(self, sock, chunk=None):
+        """
+        Does exactly one recv and returns every frame that completed, for
+        a socket known to be readable (so the recv doesn't block). Returns
+        None if the socket was closed. A caller reading many sockets from
+        one thread can pass the chunk every recv lands in, so that idle
+        sockets don't each hold a receive buffer.
+        """
+        with self.lock:
+            if not self.fill(sock, chunk):
+                return None
+            frames = []
+            frame = self.next_frame()
+            while frame is not None:
+                frames.append(frame)
+                frame = self.next_frame()
+            return frames
+
+
+# Each socket gets exactly one reader, so that bytes buffered while
+# reading one frame are still there for whoever reads the next one, and
+# so that frames sent from different threads never interleave. Entries
+# go away with their socket.
+readers_lock = threading.Lock()
+readers = weakref.WeakKeyDictionary()
+
+
+def reader_for(sock) -> FrameReader:
+    with readers_lock:
+        reader = readers.get(sock)
+        if reader is None:
+            reader = FrameReader()
+            readers[sock] = reader
+        return reader
+
+
+def frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload: bytes):
+    """
+    Sends one frame. sendall makes sure big payloads go out completely, and
+    the socket's send lock keeps concurrent senders from interleaving.
+    """
+    data = frame(payload)
+    with reader_for(sock).send_lock:
+        sock.sendall(data)
+
+
+def send_frames(sock, payloads):
+    """
+    Sends several frames with a single sendall, for pipelining
+    """
+    data = b"".join(frame(payload) for payload in payloads)
+    with reader_for(sock).send_lock:
+        sock.sendall(data)
+
+
+def recv_frame(sock):
+    """
+    Receives one frame. Returns None if the socket was closed.
+    """
+    return reader_for(sock).recv_frame(sock)
+
+
+def recv_available(sock, chunk=None):
+    """
+    Receives whatever frames one recv completes, see FrameReader.recv_available
+    """
+    return reader_for(sock).recv_available(sock, chunk)
+
+
+def send_message(sock, message: str):
+    send_frame(sock, message.encode())
+
+
+def recv_message(sock) -> str:
+    """
+    Receives one frame as a string. Returns "" if the socket was closed.
+    """
+    data = recv_frame(sock)
+    return data.decode() if data is not None else ""
@@ -0,0 +1,58 @@
+import math
+import time
+from collections import deque
+import connections.consts as consts
+
+
+class PhiAccrualDetector:
+    """
+    The phi accrual failure detector (Hayashibara et al.) for one machine.
+    Instead of calling a machine dead after a fixed time without hearing
+    from it, it learns how far apart its heartbeats arrive and gives a
+    suspicion level, phi, that grows the longer the current gap is compared
+    to what it has seen: phi = -log10(chance that a heartbeat still comes
+    this late), taking the gaps to be normally distributed. A machine that
+    answers steadily is suspected quickly once it stops, one that is
+    jittery gets more slack.
+    """
+
+    def __init__(self, interval: float, window=consts.HEARTBEAT_WINDOW, min_std=consts.HEARTBEAT_MIN_STD, now=None):
+        """
+        @param interval: How often heartbeats are sent, what the gaps are
+        taken to be until some have arrived
+        """
+        self.window = window
+        self.min_std = min_std
+        self.gaps = deque()  # The last window gaps between heartbeats
+        self.total = 0.0  # Sum of gaps
+        self.squares = 0.0  # Sum of the squares of gaps
+        self.last = time.monotonic() if now is None else now
+        self.add_gap(interval)
+
+    def add_gap(self, gap: float):
+        self.gaps.append(gap)
+        self.total += gap
+        self.squares += gap * gap
+        if len(self.gaps) > self.window:
+            old = self.gaps.popleft()
+            self.total -= old
+            self.squares -= old * old
+
+    def heartbeat(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.add_gap(now - self.last)
+        self.last = now
+
+    def phi(self, now=None) -> float:
+        now = time.monotonic() if now is None else now
+        mean = self.total / len(self.gaps)
+        variance = max(self.squares / len(self.gaps) - mean * mean, 0)
+        std = max(math.sqrt(variance), self.min_std)
+        # Chance that the next heartbeat arrives later than now
+        later = 0.5 * math.erfc((now - self.last - mean) / (std * math.sqrt(2)))
+        if later <= 0:
+            return math.inf
+        return -math.log10(later)
+
+    def is_suspected(self, now=None) -> bool:
+        return self.phi(now) > consts.HEARTBEAT_PHI
@@ -1,13 +1,19 @@
+import json
 import time
 import socket
 import threading
 import pdb
-from typing import Mapping
+from typing import List, Mapping
 from queue import Queue
 from threading import Thread
 import connections.consts as consts
 import connections.errors as errors
-from connections.schema import UNIMPORTANT_REQUEST_TYPES, Machine, Request, Response, TakeoverRequest, NotifResponse, PingResponse
+import connections.framing as framing
+import connections.codec as codec
+from connections.replication import BackupSender
+from connections.heartbeat import PhiAccrualDetector
+from connections.schema import UNIMPORTANT_REQUEST_TYPES, READ_REQUEST_TYPES, Machine, Request, Response, TakeoverRequest, NotifResponse, PingResponse, CodecResponse, AckRequest
+from persistence.errors import CompactedRangeException
 from utils import print_error, print_info
 
 
@@ -27,53 +33,138 @@ class ConnectionManager:
         self.internal_sockets: Mapping[str, any] = {}
         self.internal_progress: Mapping[str, int] = {}
         self.internal_requests: "Queue[Request]" = Queue()
+        self.internal_codecs: Mapping[str, any] = {}  # Codec negotiated with each machine
+        self.senders_lock = threading.Lock()
+        self.senders: Mapping[str, BackupSender] = {}  # Replication to each backup, when primary
+        self.replicated = threading.Condition()  # Notified on acks and when backups go away
+        self.ack_lock = threading.Condition()
+        # Machines that rejoined a running cluster, in the order they did,
+        # they rank after all others for becoming primary (see consts.primary_rank)
+        self.rejoined: List[str] = []
+        # Goes up every time a machine takes over as primary. Replicated
+        # records carry the term of the primary that sent them, so records
+        # from a primary that has since been replaced are refused.
+        self.term = 0
+        self.resync_lock = threading.Lock()
+        self.resyncing = False  # Is this machine being caught up again (see resync)?
+        # Set by initialize, kept for catching up machines that rejoin later
+        self.get_reqs_by_progress = None
+        self.get_prefix = None
+        self.get_snapshot = None
+        self.at_log_position = None
+        self.install_prefix = None
+        self.install_snapshot = None
+        self.ack_progress = 0  # Records this machine has logged, to ack to the primary
         self.client_lock = threading.Lock()
         self.client_sockets: Mapping[str, any] = {}
         self.client_requests: "Queue[(str, Request)]" = Queue()
+        # Reads (see READ_REQUEST_TYPES) from clients of this machine while
+        # it is a backup, with the name of the client
+        self.read_requests: "Queue[(str, Request)]" = Queue()
+        self.client_codecs: Mapping[str, any] = {}  # Codec negotiated with each client
         self.external_socket = None
         self.health_socket = None
+        self.rejoin_socket = None
+        # Failure detector of every sibling being watched, fed by the
+        # heartbeats over a connection kept open to it (see heartbeat)
+        self.detectors: Mapping[str, PhiAccrualDetector] = {}
+        self.detectors_lock = threading.Lock()
 
-    def initialize(self, progress: int, get_reqs_by_progress):
+    def initialize(self, progress: int, get_reqs_by_progress, get_prefix=None, install_prefix=None,
+                   get_snapshot=None, install_snapshot=None, at_log_position=None):
         """
         Does the work of initializing the connection manager
         @param progress: The progress of this machine (size of log)
         @param get_reqs_by_progress: A function that returns a list of requests
         that have been processed by this machine by progress count (can pass in lower and upper bound)
+        @param get_prefix: A function that returns (horizon, records, pending),
+        the compacted part of this machine's log (see SegmentedLog.prefix)
+        @param install_prefix: A function that takes (records, horizon, pending)
+        and makes them this machine's log and state, if its log is empty
+        @param get_snapshot: A function that returns (progress, compressed
+        snapshot) for this machine's newest snapshot, or None
+        @param install_snapshot: A function that takes (compressed snapshot,
+        progress) and makes it this machine's state, throwing its log away
+        @param at_log_position: A function that takes a function and calls it
+        with this machine's progress, while nothing can be logged
         """
         self.internal_progress[self.identity.name] = progress
-        # First it should establish connections to all other internal machines
-        listen_thread = Thread(target=self.listen_internally)
-        connect_thread = Thread(
-            target=self.handle_internal_connections, args=(progress, ))
-        listen_thread.start()
-        connect_thread.start()
-        listen_thread.join()
-        connect_thread.join()
-
-        # Now that we've gotten the other machines and names we need to
-        # play catch up so we have persistent progress
-        self.play_catchup(get_reqs_by_progress)
+        (self.get_reqs_by_progress, self.get_prefix, self.get_snapshot, self.at_log_position) = \
+            (get_reqs_by_progress, get_prefix, get_snapshot, at_log_position)
+        (self.install_prefix, self.install_snapshot) = (install_prefix, install_snapshot)
+        running = self.find_running_siblings()
+        if running:
+            # The others are already serving, so join them instead of
+            # waiting for everyone to start together
+            self.rejoin(progress, running, install_prefix, install_snapshot)
+        else:
+            # First it should establish connections to all other internal machines
+            listen_thread = Thread(target=self.listen_internally)
+            connect_thread = Thread(
+                target=self.handle_internal_connections, args=(progress, ))
+            listen_thread.start()
+            connect_thread.start()
+            listen_thread.join()
+            connect_thread.join()
+
+            # Now that we've gotten the other machines and names we need to
+            # play catch up so we have persistent progress
+            self.play_catchup(get_reqs_by_progress, get_prefix, install_prefix,
+                              get_snapshot, install_snapshot)
 
         # At this point we assume that self.internal_sockets is populated
         # with sockets to all other internal machines
         for (name, sock) in self.internal_sockets.items():
-            # Be sure to consume with the internal flag set to True
-            consumer_thread = Thread(
-                target=self.consume_internally,
-                args=(sock,)
-            )
-            consumer_thread.start()
+            self.consume(name, sock)
+        # Acks what this machine logs back to the primary
+        ack_thread = Thread(target=self.ack_loop, daemon=True)
+        ack_thread.start()
+
+        # From now on machines that restart can join back in
+        self.serve_rejoins()
 
         # Once all the servers are up we start doing health checks
+        if not running:
+            self.serve_health()
+        self.serve_probes()
+
+        # Now we can setup another server socket to listen for connections from clients
+        self.serve_clients()
+
+    # How sockets get served once this machine is up. Each socket gets a
+    # thread of its own, see connections/async_manager.py for serving
+    # them all from one event loop instead.
+
+    def consume(self, name: str, sock):
+        """
+        Starts taking in what the machine with the given name sends
+        """
+        consumer_thread = Thread(
+            target=self.consume_internally,
+            args=(sock, self.get_internal_codec(name), name)
+        )
+        consumer_thread.start()
+
+    def serve_rejoins(self):
+        rejoin_listen_thread = Thread(target=self.listen_rejoins, daemon=True)
+        rejoin_listen_thread.start()
+
+    def serve_health(self):
         health_listen_thread = Thread(target=self.listen_health)
         health_listen_thread.start()
+
+    def serve_probes(self):
         health_probe_thread = Thread(target=self.probe_health)
         health_probe_thread.start()
 
-        # Now we can setup another server socket to listen for connections from clients
+    def serve_clients(self):
         client_listen_thread = Thread(target=self.listen_externally)
         client_listen_thread.start()
 
+    def serve_client(self, name: str):
+        client_thread = Thread(target=self.handle_client, args=(name,))
+        client_thread.start()
+
     def listen_internally(self, sock=None):
         """
         Listens for incoming internal connections. Adds a connection to the socket
@@ -92,12 +183,7 @@ class ConnectionManager:
             while listens_completed < self.identity.num_listens:
                 # Accept the connection
                 conn, _ = sock.accept()
-                # Get the name of the machine that connected
-                payload = conn.recv(2048).decode()
-                (name, raw_other_progress) = payload.split("@@")
-                self.internal_progress[name] = int(raw_other_progress)
-                conn.send(
-                    str(self.internal_progress[self.identity.name]).encode())
+                name = self.greet_sibling(conn)
                 # Add the connection to the map
                 with self.internal_lock:
                     self.internal_sockets[name] = conn
@@ -106,6 +192,109 @@ class ConnectionManager:
         except Exception as e:
             sock.close()
 
+    def greet_sibling(self, conn) -> str:
+        """
+        Answers the greeting a machine sends once it has connected (see
+        connect_internally) and returns its name
+        """
+        payload = framing.recv_message(conn)
+        parts = payload.split("@@")
+        (name, raw_other_progress) = parts[:2]
+        self.internal_progress[name] = int(raw_other_progress)
+        reply = str(self.internal_progress[self.identity.name])
+        self.internal_codecs[name] = codec.TEXT
+        if len(parts) > 2:
+            # The other machine offered codecs, so pick one
+            codec_name = codec.negotiate(parts[2].split(","))
+            self.internal_codecs[name] = codec.CODECS[codec_name]
+            reply += f"@@{codec_name}"
+        if len(parts) > 3 and parts[3] == "rejoin":
+            self.mark_rejoined(name)
+            reply += f"@@{','.join(self.rejoined)}"
+        framing.send_message(conn, reply)
+        return name
+
+    def listen_rejoins(self, sock=None):
+        """
+        Once the machines are up, listens on the internal port for machines
+        that restarted and want back in (see rejoin). Repeats indefinitely.
+        """
+        if not sock:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.rejoin_socket = sock
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.identity.host_ip, self.identity.internal_port))
+        sock.listen()
+        try:
+            while self.alive:
+                conn, _ = sock.accept()
+                accept_thread = Thread(target=self.accept_rejoin, args=(conn,), daemon=True)
+                accept_thread.start()
+        except Exception:
+            sock.close()
+
+    def accept_rejoin(self, conn):
+        """
+        Takes a machine that restarted back in. The primary catches it up
+        before treating it as a backup, the others take it back right away.
+        """
+        try:
+            name = self.greet_sibling(conn)
+        except Exception:
+            conn.close()
+            return
+        print_info(f"Machine {name} is rejoining")
+        # Whatever was going to the machine before it went down is stale
+        self.forget_sibling(name)
+        with self.internal_lock:
+            self.internal_sockets[name] = conn
+        if self.is_primary:
+            if not self.catch_up_rejoiner(name, self.internal_progress[name]):
+                return
+        else:
+            self.add_sibling(name)
+        self.consume(name, conn)
+
+    def catch_up_rejoiner(self, name: str, prog: int) -> bool:
+        """
+        The primary's side of rejoin. Replication to the machine starts
+        paused at the primary's current position, so everything logged
+        while the machine is caught up queues behind the catch up stream
+        and nothing is missed or sent twice. The machine is only taken back
+        (for health checks) once it has received the stream. It counts for
+        commit levels once it acks having logged records, like any backup
+        (see count_acks), not because it acked the stream.
+        """
+        def start_replicating(position: int):
+            sender = BackupSender(name, self.internal_sockets[name],
+                                  on_failure=self.drop_backup, paused=True)
+            with self.senders_lock:
+                self.senders[name] = sender
+            return (position, sender)
+
+        if self.at_log_position is not None:
+            (position, sender) = self.at_log_position(start_replicating)
+        else:
+            (position, sender) = start_replicating(self.internal_progress[self.identity.name])
+        if not self.stream_catchup(name, prog, position, self.get_reqs_by_progress,
+                                   self.get_prefix, self.get_snapshot):
+            return False
+        self.add_sibling(name)
+        sender.resume()
+        return True
+
+    def mark_rejoined(self, name: str):
+        if name in self.rejoined:
+            self.rejoined.remove(name)
+        self.rejoined.append(name)
+
+    def add_sibling(self, name: str):
+        """
+        Starts treating a machine as alive again
+        """
+        if all(sib.name != name for sib in self.living_siblings):
+            self.living_siblings = self.living_siblings + [consts.MACHINE_MAP[name]]
+
     def listen_externally(self, sock=None):
         """
         Listens for incoming external connections. Adds a connection to the socket
@@ -125,32 +314,41 @@ class ConnectionManager:
             while self.alive:
                 # Accept the connection
                 conn, _ = self.external_socket.accept()
-                if self.is_primary:
-                    resp = Response("", True, "I am the primary")
-                    try:
-                        conn.send(resp.marshal().encode())
-                    except:
-                        continue
-                if not self.is_primary:
-                    resp = Response("", False, "I am not the primary")
-                    try:
-                        conn.send(resp.marshal().encode())
-                    finally:
-                        continue
-                name = conn.getpeername()
-                name = str(name[1])
-                with self.client_lock:
-                    self.client_sockets[name] = conn
-                client_thread = Thread(
-                    target=self.handle_client, args=(name,))
-                client_thread.start()
+                name = self.greet_client(conn)
+                if name is not None:
+                    self.serve_client(name)
             self.external_socket.close()
         except Exception as e:
             self.external_socket.close()
 
+    def greet_client(self, conn):
+        """
+        Tells a client that just connected whether this is the primary and
+        keeps its socket. Returns the name of the client, None if it is
+        already gone.
+        """
+        # Clients only send writes to the primary, but backups
+        # serve reads, so they keep the connection either way
+        if self.is_primary:
+            resp = Response("", True, "I am the primary")
+        else:
+            resp = Response("", False, "I am not the primary")
+        try:
+            framing.send_message(conn, resp.marshal())
+            name = conn.getpeername()
+        except:
+            conn.close()
+            return None
+        name = str(name[1])
+        with self.client_lock:
+            self.client_sockets[name] = conn
+        return name
+
     def listen_health(self, sock=None):
         """
-        Listens for incoming health checks, responds with PingResponse
+        Listens for incoming health checks. Siblings and clients keep their
+        connection open and ping over it, so every one is answered in its
+        own thread until it closes.
         """
         if sock == None:
             self.health_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -164,46 +362,168 @@ class ConnectionManager:
         try:
             while self.alive:
                 conn, _ = self.health_socket.accept()
-                conn.recv(2048)
-                resp = PingResponse()
-                conn.send(resp.marshal().encode())
-                conn.close()
+                Thread(target=self.answer_health, args=(conn,), daemon=True).start()
         except:
             self.health_socket.close()
 
-    def probe_health(self, sock_arg=None):
+    def answer_health(self, conn):
         """
-        Sends a health check to every sibling regularly
+        Answers every ping on a health check connection with PingResponse
+        """
+        resp = PingResponse().marshal()
+        try:
+            while self.alive and framing.recv_frame(conn) is not None:
+                framing.send_message(conn, resp)
+        except Exception:
+            pass
+        conn.close()
+
+    def probe_health(self):
+        """
+        Keeps a heartbeat going to every living sibling, and every
+        HEARTBEAT_INTERVAL takes the ones it has stopped hearing from
+        for dead
         """
-        FREQUENCY = 1  # seconds
-        time.sleep(FREQUENCY)
         while self.alive:
-            for sibling in self.living_siblings:
-                sock = sock_arg if sock_arg else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(FREQUENCY)
-                try:
-                    sock.connect((sibling.host_ip, sibling.health_port))
-                    ping = PingResponse()
-                    sock.send(ping.marshal().encode())
-                    sock.recv(2048)
-                    sock.close()
-                except:
-                    print_error(f"Machine {sibling.name} is dead")
-                    self.living_siblings.remove(sibling)
-            old_primary_status = self.is_primary
-            self.is_primary = consts.should_i_be_primary(
-                self.identity.name, self.living_siblings)
-            if self.is_primary and not old_primary_status:
-                print_info(f"Machine {self.identity.name} is now primary!")
-                # Self-trigger an internal request to free control
-                takeover_req = TakeoverRequest()
-                self.internal_requests.put(takeover_req)
-            if (sock_arg):
-                # For testing purposes
-                break
-            time.sleep(FREQUENCY)
+            time.sleep(consts.HEARTBEAT_INTERVAL)
+            for sibling in list(self.living_siblings):
+                self.watch_sibling(sibling)
+            self.check_siblings()
+
+    def watch_sibling(self, sibling: Machine):
+        """
+        Starts a heartbeat to a sibling, unless there is one already.
+        Siblings that come back (see add_sibling) get a fresh one.
+        """
+        with self.detectors_lock:
+            if sibling.name in self.detectors:
+                return
+            detector = PhiAccrualDetector(consts.HEARTBEAT_INTERVAL)
+            self.detectors[sibling.name] = detector
+        self.start_heartbeat(sibling, detector)
 
-    def connect_internally(self, name: str, progress: int, sock=None):
+    def start_heartbeat(self, sibling: Machine, detector: PhiAccrualDetector):
+        Thread(target=self.heartbeat, args=(sibling, detector), daemon=True).start()
+
+    def is_watching(self, name: str, detector: PhiAccrualDetector) -> bool:
+        """
+        Whether the heartbeat feeding detector should keep going
+        """
+        return self.alive and self.detectors.get(name) is detector
+
+    def heartbeat(self, sibling: Machine, detector: PhiAccrualDetector, sock=None):
+        """
+        Pings a sibling every HEARTBEAT_INTERVAL over one connection to its
+        health port, made again whenever it fails, and tells detector about
+        every answer. Stops once the sibling is taken for dead.
+        """
+        ping = PingResponse().marshal()
+        conn = None
+        while self.is_watching(sibling.name, detector):
+            started = time.monotonic()
+            try:
+                if conn is None:
+                    conn = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock = None
+                    conn.settimeout(consts.HEARTBEAT_TIMEOUT)
+                    conn.connect((sibling.host_ip, sibling.health_port))
+                framing.send_message(conn, ping)
+                if framing.recv_frame(conn) is None:
+                    raise Exception("Connection closed")
+                detector.heartbeat()
+            except Exception:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            time.sleep(max(consts.HEARTBEAT_INTERVAL - (time.monotonic() - started), 0))
+        if conn is not None:
+            conn.close()
+
+    def check_siblings(self, now=None):
+        """
+        Takes every sibling its failure detector suspects for dead, then
+        takes over as primary if this machine should be it now
+        """
+        for sibling in list(self.living_siblings):
+            detector = self.detectors.get(sibling.name)
+            if detector is not None and detector.is_suspected(now):
+                self.mark_dead(sibling)
+        self.update_role()
+
+    def mark_dead(self, sibling: Machine):
+        print_error(f"Machine {sibling.name} is dead")
+        self.living_siblings = [sib for sib in self.living_siblings if sib.name != sibling.name]
+        self.stop_watching(sibling.name)
+        self.stop_sender(sibling.name)
+
+    def stop_watching(self, name: str):
+        """
+        Stops the heartbeat to a machine
+        """
+        with self.detectors_lock:
+            self.detectors.pop(name, None)
+
+    def update_role(self):
+        """
+        Called after every check of the siblings. Takes over as primary
+        if this machine should be it now.
+        """
+        old_primary_status = self.is_primary
+        self.is_primary = consts.should_i_be_primary(
+            self.identity.name, self.living_siblings, self.rejoined)
+        if self.is_primary and not old_primary_status:
+            self.term += 1
+            print_info(f"Machine {self.identity.name} is now primary! (term {self.term})")
+            # Self-trigger an internal request to free control
+            takeover_req = TakeoverRequest()
+            self.internal_requests.put(takeover_req)
+
+    def is_healthy(self, sibling: Machine, timeout: float, sock=None) -> bool:
+        """
+        Does one health check on a sibling
+        """
+        sock = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((sibling.host_ip, sibling.health_port))
+            ping = PingResponse()
+            framing.send_message(sock, ping.marshal())
+            if framing.recv_frame(sock) is None:
+                raise Exception("Connection closed")
+            sock.close()
+            return True
+        except:
+            sock.close()
+            return False
+
+    def find_running_siblings(self):
+        """
+        Machines only answer health checks once they are up and serving,
+        so the siblings that answer are a cluster this machine rejoins
+        """
+        return [sib for sib in self.living_siblings if self.is_healthy(sib, 1)]
+
+    def rejoin(self, progress: int, running, install_prefix=None, install_snapshot=None):
+        """
+        Joins siblings that are already serving: connects to each of them,
+        then gets caught up by the primary, which keeps serving meanwhile.
+        A machine that rejoins ranks after the others for becoming primary,
+        so it doesn't take over from the primary that just caught it up.
+        """
+        print_info(
+            f"Machine {self.identity.name} is rejoining {', '.join(sib.name for sib in running)}")
+        # Answer health checks right away, otherwise the primary takes this
+        # machine for dead while it is still catching up
+        self.serve_health()
+        self.mark_rejoined(self.identity.name)
+        for sibling in running:
+            self.connect_internally(sibling.name, progress, rejoin=True)
+        self.living_siblings = list(running)
+        primary = consts.get_primary(
+            [sib.name for sib in running], self.rejoined)
+        self.receive_catchup(primary, install_prefix, install_snapshot)
+
+    def connect_internally(self, name: str, progress: int, sock=None, rejoin=False):
         """
         Connects to the machine with the given name
         NOTE: Can/is expected to sometimes throw errors
@@ -217,19 +537,29 @@ class ConnectionManager:
         # Setup the socket
         sock = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((identity.host_ip, identity.internal_port))
-        # Send the name of this machine
-        payload = f"{self.identity.name}@@{progress}"
-        sock.send(payload.encode())
-        # Receive the progress of the other machine
-        other_progress = int(sock.recv(2048).decode())
-        self.internal_progress[name] = other_progress
+        # Send the name of this machine, its progress and the codecs it speaks
+        payload = f"{self.identity.name}@@{progress}@@{','.join(consts.CODECS)}"
+        if rejoin:
+            payload += "@@rejoin"
+        framing.send_message(sock, payload)
+        # Receive the progress of the other machine (and the codec it picked,
+        # and when rejoining, which machines rejoined before)
+        parts = framing.recv_message(sock).split("@@")
+        self.internal_progress[name] = int(parts[0])
+        self.internal_codecs[name] = codec.CODECS[parts[1]] if len(parts) > 1 else codec.TEXT
+        if len(parts) > 2 and parts[2]:
+            self.rejoined = parts[2].split(",")
         # Add the connection to the map
         self.internal_sockets[name] = sock
 
-    def consume_internally(self, conn):
+    def get_internal_codec(self, name: str):
+        return self.internal_codecs.get(name, codec.TEXT)
+
+    def consume_internally(self, conn, conn_codec=codec.TEXT, name=""):
         """
         Once a connection is established, open a thread that continuously
-        listens for incoming requests
+        listens for incoming requests. Acks from backups are taken care of
+        here, they never reach the request loop.
         """
         try:
             # NOTE: The use of timeout here is to ensure that we can
@@ -238,14 +568,23 @@ class ConnectionManager:
             # of listening forever.
             while True:
                 # Get the message
-                msg = conn.recv(2048).decode()
+                msg = framing.recv_frame(conn)
                 if not msg or len(msg) <= 0:
                     raise Exception("Connection closed")
-                req_obj = Request.unmarshal(msg)
-                self.internal_requests.put(req_obj)
+                self.on_internal_frame(name, conn_codec, msg)
         except Exception:
             conn.close()
 
+    def on_internal_frame(self, name: str, conn_codec, msg: bytes):
+        """
+        Handles one frame from another machine
+        """
+        req_obj = conn_codec.decode_request(msg)
+        if req_obj.type == "ack":
+            self.record_ack(name or req_obj.user_id, req_obj.progress)
+            return
+        self.internal_requests.put(req_obj)
+
     def handle_internal_connections(self, progress: int):
         """
         Handles the connections to other machines
@@ -262,13 +601,30 @@ class ConnectionManager:
                         f"Failed to connect to {name}, retrying in 1 second")
                     time.sleep(1)
 
-    def play_catchup(self, get_reqs_by_progress):
+    def play_catchup(self, get_reqs_by_progress, get_prefix=None, install_prefix=None,
+                     get_snapshot=None, install_snapshot=None):
         """
         Should be called after self.internal_progress has been populated.
         First figures out which machine has the most progress. Then, it
         requests all of the requests from that machine that are greater
-        than the current progress OR broadcasts these requests to the
-        machines that need them.
+        than the current progress OR streams these requests to the
+        machines that need them, all of them at once.
+        The leader first sends a header,
+        "catchup@@<records>@@<horizon>@@<batch>@@<format>@@<term>@@<pending>".
+        If horizon > 0 the next frame holds everything up to horizon as a
+        whole, which the machine takes on in place of its own log. That is
+        either the leader's compacted records (format "records", for a
+        machine with an empty log) or the leader's newest snapshot
+        (format "snapshot", for a machine too far behind, see
+        CATCHUP_SNAPSHOT_GAP). Then come the records, <batch> of them per
+        sendall, each carrying its position in the leader's log (its LSN),
+        so the machine picks up at exactly the record after its progress.
+        The machine acks every batch it has received, and the leader never
+        has more than CATCHUP_WINDOW batches unacked. These acks are only
+        flow control: the records are applied later by the request loop,
+        which during startup isn't even running yet. That a machine has
+        applied and logged them is what it acks over replication (see
+        acknowledge), and only that counts for commit levels.
         """
         progress_leader = self.identity.name
         for (name, prog) in self.internal_progress.items():
@@ -280,14 +636,18 @@ class ConnectionManager:
         if progress_leader == self.identity.name:
             # We are the progress leader! Yay!
             my_progress = self.internal_progress[self.identity.name]
+            streams = []
             for (name, prog) in self.internal_progress.items():
-                if name == self.identity.name:
+                if name == self.identity.name or prog == my_progress:
+                    # A machine that isn't behind doesn't wait for a
+                    # header (see below), it would read it as a request
                     continue
-                reqs = get_reqs_by_progress(prog, my_progress)
-                conn = self.internal_sockets[name]
-                for req in reqs:
-                    conn.send(req.marshal().encode())
-                    conn.recv(2048)  # Receive a ping
+                stream = Thread(target=self.stream_catchup, args=(
+                    name, prog, my_progress, get_reqs_by_progress, get_prefix, get_snapshot))
+                stream.start()
+                streams.append(stream)
+            for stream in streams:
+                stream.join()
             return
         else:
             # We need to catch up! No!
@@ -295,16 +655,180 @@ class ConnectionManager:
                 self.internal_progress[self.identity.name]
             if delta == 0:
                 return
-            conn = self.internal_sockets[progress_leader]
-            for _ in range(delta):
-                # Get the message
-                msg = conn.recv(2048).decode()
-                if not msg or len(msg) <= 0:
-                    raise Exception("Can't catch up, connection closed")
-                req_obj = Request.unmarshal(msg)
-                self.internal_requests.put(req_obj)
-                resp = PingResponse()
-                conn.send(resp.marshal().encode())
+            self.receive_catchup(progress_leader, install_prefix, install_snapshot)
+
+    def receive_catchup(self, leader: str, install_prefix=None, install_snapshot=None):
+        """
+        The side of catch up that is behind, see play_catchup. Received
+        records go on the internal queue like any from the primary, and a
+        batch is acked once it is queued, not once it is applied.
+        """
+        started = time.time()
+        conn = self.internal_sockets[leader]
+        conn_codec = self.get_internal_codec(leader)
+        header = framing.recv_message(conn)
+        if not header:
+            raise Exception("Can't catch up, connection closed")
+        (_, raw_count, raw_horizon, raw_batch, base_format, raw_term, raw_pending) = header.split("@@", 6)
+        self.observe_term(int(raw_term))
+        if int(raw_horizon) > 0:
+            data = framing.recv_frame(conn)
+            if data is None:
+                raise Exception("Can't catch up, connection closed")
+            if base_format == "snapshot":
+                install_snapshot(data, int(raw_horizon))
+            else:
+                install_prefix(data, int(raw_horizon), json.loads(raw_pending))
+        (count, batch) = (int(raw_count), int(raw_batch))
+        for received in range(1, count + 1):
+            # Get the message
+            msg = framing.recv_frame(conn)
+            if not msg or len(msg) <= 0:
+                raise Exception("Can't catch up, connection closed")
+            self.internal_requests.put(conn_codec.decode_request(msg))
+            if received % batch == 0 or received == count:
+                framing.send_message(conn, PingResponse().marshal())
+        print_info(
+            f"Caught up from machine {leader}: {count} records in {time.time() - started:.2f}s")
+
+    def stream_catchup(self, name: str, prog: int, my_progress: int, get_reqs_by_progress,
+                       get_prefix=None, get_snapshot=None):
+        """
+        The leader's side of catch up for one machine, see play_catchup.
+        Records are read from the log a batch at a time, so a machine that
+        is far behind never has its whole range in memory.
+        Returns False if the machine couldn't be caught up, it is forgotten.
+        """
+        started = time.time()
+        batch = consts.CATCHUP_BATCH
+        base = None  # (format, horizon, data, pending) sent ahead of the records
+
+        def snapshot_base():
+            snapshot = get_snapshot() if get_snapshot is not None else None
+            if snapshot is None or snapshot[0] <= prog:
+                return None
+            return ("snapshot", snapshot[0], snapshot[1], {})
+
+        try:
+            if prog == 0 and get_prefix is not None:
+                prefix = get_prefix()
+                if prefix[0] > 0:
+                    base = ("records", *prefix)
+            if my_progress - prog >= consts.CATCHUP_SNAPSHOT_GAP:
+                # Far enough behind that sending our state beats sending
+                # our history
+                base = snapshot_base() or base
+            start = base[1] if base else prog
+            # Read the first batch before saying anything, so a range that
+            # can't be read anymore is noticed before the header goes out
+            try:
+                reqs = get_reqs_by_progress(start, min(start + batch, my_progress))
+            except CompactedRangeException:
+                # Our log no longer holds the records this machine is
+                # missing one by one, our snapshot is the only way
+                base = snapshot_base()
+                if base is None:
+                    raise
+                start = base[1]
+                reqs = get_reqs_by_progress(start, min(start + batch, my_progress))
+        except CompactedRangeException as e:
+            print_error(
+                f"Can't catch up machine {name}: {e.message}")
+            print_error(
+                f"Delete machine {name}'s logs and snapshots and restart it to bring it back")
+            self.forget_sibling(name)
+            return False
+        conn = self.internal_sockets[name]
+        conn_codec = self.get_internal_codec(name)
+        (base_format, horizon, data, pending) = base if base else ("records", 0, b"", {})
+        try:
+            framing.send_message(
+                conn, f"catchup@@{my_progress - start}@@{horizon}@@{batch}@@{base_format}@@{self.term}@@{json.dumps(pending)}")
+            if horizon > 0:
+                framing.send_frame(conn, data)
+            unacked = 0
+            low = start
+            while low < my_progress:
+                high = min(low + batch, my_progress)
+                if reqs is None:
+                    reqs = get_reqs_by_progress(low, high)
+                framing.send_frames(conn, [conn_codec.encode_entry(req, lsn, self.term)
+                                           for (lsn, req) in enumerate(reqs, low + 1)])
+                unacked += 1
+                if unacked >= consts.CATCHUP_WINDOW:
+                    # Wait for the machine to get through a batch
+                    if framing.recv_frame(conn) is None:
+                        raise Exception("Connection closed")
+                    unacked -= 1
+                (low, reqs) = (high, None)
+            while unacked > 0:
+                if framing.recv_frame(conn) is None:
+                    raise Exception("Connection closed")
+                unacked -= 1
+        except Exception as e:
+            print_error(f"Failed to catch up machine {name}: {e}")
+            self.forget_sibling(name)
+            return False
+        shipped = f"a {len(data)} byte snapshot and " if base_format == "snapshot" and horizon else ""
+        print_info(
+            f"Caught up machine {name}: {shipped}{my_progress - start} records in {time.time() - started:.2f}s")
+        return True
+
+    def observe_term(self, term: int) -> bool:
+        """
+        Called with the term of every record a backup gets. Returns False
+        if it comes from an older term than one this machine has seen.
+        """
+        if term < self.term:
+            return False
+        self.term = term
+        return True
+
+    def resync(self, progress: int):
+        """
+        Called by a backup that found records missing from what the primary
+        replicated. Reconnects to the primary as a machine that rejoins, so
+        the primary streams it everything after progress and replicates to
+        it from there (see catch_up_rejoiner). Records already queued that
+        turn out to be duplicates are skipped by the request loop.
+        """
+        with self.resync_lock:
+            if self.resyncing:
+                return
+            self.resyncing = True
+        resync_thread = Thread(target=self.resync_from, args=(progress,), daemon=True)
+        resync_thread.start()
+
+    def resync_from(self, progress: int):
+        try:
+            primary = consts.get_primary(
+                [sib.name for sib in self.living_siblings], self.rejoined)
+            if primary is None:
+                return
+            print_info(f"Catching up from machine {primary} again, from {progress}")
+            sock = self.internal_sockets.get(primary)
+            if sock is not None:
+                sock.close()
+            self.connect_internally(primary, progress, rejoin=True)
+            self.receive_catchup(primary, self.install_prefix, self.install_snapshot)
+            self.consume(primary, self.internal_sockets[primary])
+        except Exception as e:
+            print_error(f"Failed to catch up again: {e}")
+        finally:
+            with self.resync_lock:
+                self.resyncing = False
+
+    def forget_sibling(self, name: str):
+        """
+        Closes the connection to a machine and stops treating it as alive
+        """
+        sock = self.internal_sockets.get(name)
+        if sock is not None:
+            sock.close()
+        self.living_siblings = [
+            sib for sib in self.living_siblings if sib.name != name]
+        self.stop_watching(name)
+        self.stop_sender(name)
 
     def handle_client(self, name):
         """
@@ -314,41 +838,226 @@ class ConnectionManager:
             conn = self.client_sockets[name]
         while True:
             try:
-                msg = conn.recv(2048).decode()
+                msg = framing.recv_frame(conn)
                 if not msg or len(msg) <= 0:
                     raise Exception("Connection closed")
-                req_obj = Request.unmarshal(msg)
-                # If this machine is not the primary, respond with an appropriate error
-                if not self.is_primary:
-                    resp = Response("", False, "Error: Not primary")
-                    conn.send(resp.marshal().encode())
-                    continue
-                self.client_requests.put((True, name, req_obj))
+                self.on_client_frame(name, conn, msg)
             except socket.timeout:
                 continue
             except Exception as e:
-                conn.close()
-                with self.client_lock:
-                    del self.client_sockets[name]
+                self.drop_client(name, conn)
                 return
 
-    def broadcast_to_backups(self, req: Request):
+    def on_client_frame(self, name: str, conn, msg: bytes):
+        """
+        Handles one frame from a client. Raises if the frame can't be
+        understood, the client is dropped then.
+        """
+        conn_codec = self.client_codecs.get(name, codec.TEXT)
+        req_obj = conn_codec.decode_request(msg)
+        if req_obj.type == "codec":
+            # The client is offering codecs, pick one and switch to it
+            codec_name = codec.negotiate(req_obj.codecs)
+            resp = CodecResponse("", True, "", codec_name)
+            framing.send_message(conn, resp.marshal())
+            with self.client_lock:
+                self.client_codecs[name] = codec.CODECS[codec_name]
+            return
+        if not self.is_primary and req_obj.type in READ_REQUEST_TYPES:
+            # Backups serve reads next to their request loop
+            self.read_requests.put((name, req_obj))
+            return
+        # If this machine is not the primary, respond with an appropriate error
+        if not self.is_primary:
+            resp = Response("", False, "Error: Not primary")
+            framing.send_frame(conn, conn_codec.encode_response(resp))
+            return
+        self.client_requests.put((True, name, req_obj))
+
+    def drop_client(self, name: str, conn):
+        conn.close()
+        with self.client_lock:
+            self.client_sockets.pop(name, None)
+            self.client_codecs.pop(name, None)
+
+    def broadcast_to_backups(self, req: Request, position: int = 0):
         """
-        Takes care of state-updates.
+        Takes care of state-updates. Only hands the request to each backup's
+        sender (see connections/replication.py), it never waits on a socket.
+        @param position: The primary's progress once req is logged, which is
+        what the backup acks once it has logged req too
         NOTE: We let this be called on any kind of request, but notice
         that we only have to actually do stuff on account changes or messages
         NOTE: If this machine does not have `is_primary` we'll do nothing
+        NOTE: Calls must be made in log order, the server makes them while
+        holding its log lock
+        NOTE: Logged requests go out as entries carrying position (their
+        LSN) and this machine's term, see Server.in_sequence
         """
         if not self.is_primary:
             return
+        lsn = position
         if req.type == "fallover":
             # Fallover doesn't go in the logs but we still want to
-            # broadcast it to the backups, so we need this if statement
-            pass
+            # broadcast it to the backups, so we need this if statement.
+            # It isn't sequenced, it has no position of its own
+            lsn = 0
         elif req.type in UNIMPORTANT_REQUEST_TYPES:
             return
-        for sibling in self.living_siblings:
-            self.internal_sockets[sibling.name].send(req.marshal().encode())
+        names = [sib.name for sib in self.living_siblings]
+        with self.senders_lock:
+            # Machines still being caught up after rejoining get every
+            # record too, see catch_up_rejoiner
+            names += [name for (name, sender) in self.senders.items()
+                      if sender.is_paused() and name not in names]
+        # Encode once per codec in use, not once per backup
+        encoded: Mapping[str, bytes] = {}
+        for name in names:
+            conn_codec = self.get_internal_codec(name)
+            if conn_codec.name not in encoded:
+                encoded[conn_codec.name] = conn_codec.encode_entry(req, lsn, self.term) if lsn \
+                    else conn_codec.encode_request(req)
+            sender = self.sender_for(name)
+            if sender is not None:
+                sender.enqueue(position, encoded[conn_codec.name])
+
+    def sender_for(self, name: str):
+        """
+        Returns the sender replicating to the given machine, starting it
+        the first time around
+        """
+        with self.senders_lock:
+            sender = self.senders.get(name)
+            if sender is None or not sender.alive:
+                if name not in self.internal_sockets:
+                    return None
+                sender = BackupSender(
+                    name, self.internal_sockets[name], on_failure=self.drop_backup)
+                self.senders[name] = sender
+            return sender
+
+    def stop_sender(self, name: str):
+        with self.senders_lock:
+            sender = self.senders.pop(name, None)
+        if sender is not None:
+            sender.stop()
+        with self.replicated:
+            self.replicated.notify_all()
+
+    def drop_backup(self, name: str):
+        """
+        Called when a backup can't be replicated to, either because its
+        socket failed or because it fell too far behind. It is treated like
+        a dead machine from then on.
+        """
+        print_error(
+            f"Machine {name} can't keep up with replication, dropping it")
+        with self.senders_lock:
+            self.senders.pop(name, None)
+        self.forget_sibling(name)
+        with self.replicated:
+            self.replicated.notify_all()
+
+    def flush_backups(self, timeout=None):
+        """
+        Waits until every backup sender has written out what it was handed
+        """
+        with self.senders_lock:
+            senders = list(self.senders.values())
+        for sender in senders:
+            sender.flush(timeout)
+
+    def record_ack(self, name: str, progress: int):
+        with self.senders_lock:
+            sender = self.senders.get(name)
+        if sender is not None:
+            sender.ack(progress)
+        with self.replicated:
+            self.replicated.notify_all()
+
+    def acks_needed(self, level: str) -> int:
+        """
+        How many backups must ack a record before it is committed at the
+        given level
+        """
+        if level == consts.COMMIT_ALL:
+            return len(self.living_siblings)
+        if level == consts.COMMIT_QUORUM:
+            # A majority of every machine there is, this one included
+            return len(consts.MACHINE_MAP) // 2
+        return 0
+
+    def count_acks(self, position: int) -> int:
+        living = {sib.name for sib in self.living_siblings}
+        with self.senders_lock:
+            return sum(1 for (name, sender) in self.senders.items()
+                       if name in living and sender.acked >= position)
+
+    def wait_for_replication(self, position: int, level: str, timeout=consts.COMMIT_TIMEOUT) -> bool:
+        """
+        Blocks until enough backups have acked position for the given
+        commit level. Returns False if that didn't happen within timeout.
+        NOTE: Backups that die while we wait stop counting, so "all" means
+        all machines that are still alive.
+        """
+        if not self.is_primary or level == consts.COMMIT_PRIMARY:
+            return True
+        deadline = time.time() + timeout
+        with self.replicated:
+            while self.count_acks(position) < self.acks_needed(level):
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.alive:
+                    return False
+                self.replicated.wait(remaining)
+        return True
+
+    def replication_status(self) -> Mapping[str, dict]:
+        """
+        How far along replication is to each backup. lag counts records
+        handed to the backup's sender that it hasn't acked yet.
+        """
+        with self.senders_lock:
+            senders = list(self.senders.values())
+        return {sender.name: sender.status() for sender in senders}
+
+    def acknowledge(self, progress: int):
+        """
+        Called by the server as the records it logs get committed. The ack
+        loop passes the newest progress on to the primary, so a burst of
+        commits costs one ack.
+        """
+        with self.ack_lock:
+            if progress > self.ack_progress:
+                self.ack_progress = progress
+                self.ack_lock.notify_all()
+
+    def ack_loop(self):
+        """
+        Sends the primary an ack whenever this machine has logged more
+        """
+        acked = 0
+        while self.alive:
+            with self.ack_lock:
+                while self.alive and self.ack_progress <= acked:
+                    self.ack_lock.wait()
+                progress = self.ack_progress
+            if not self.alive:
+                return
+            if self.is_primary:
+                acked = progress
+                continue
+            primary = consts.get_primary(
+                [sib.name for sib in self.living_siblings] + [self.identity.name], self.rejoined)
+            if primary == self.identity.name or primary not in self.internal_sockets:
+                acked = progress
+                continue
+            ack = AckRequest(self.identity.name, progress)
+            try:
+                framing.send_frame(self.internal_sockets[primary],
+                                   self.get_internal_codec(primary).encode_request(ack))
+            except Exception:
+                pass  # The health checks take care of a dead primary
+            acked = progress
 
     def send_response(self, client_name, resp: Response):
         """
@@ -357,7 +1066,9 @@ class ConnectionManager:
         if client_name not in self.client_sockets:
             print_error(f"Client {client_name} is not connected")
             return
-        self.client_sockets[client_name].send(resp.marshal().encode())
+        conn_codec = self.client_codecs.get(client_name, codec.TEXT)
+        framing.send_frame(
+            self.client_sockets[client_name], conn_codec.encode_response(resp))
 
     def be_the_primary(self):
         """
@@ -397,6 +1108,16 @@ class ConnectionManager:
         Kills the connection manager
         """
         self.alive = False
+        self.read_requests.put(None)
+        with self.ack_lock:
+            self.ack_lock.notify_all()
+        with self.replicated:
+            self.replicated.notify_all()
+        with self.senders_lock:
+            senders = list(self.senders.values())
+            self.senders = {}
+        for sender in senders:
+            sender.stop()
         for sock in list(self.internal_sockets.values()) + list(self.client_sockets.values()):
             # Helps prevent the weird "address is already in use" error
             try:
@@ -409,3 +1130,5 @@ class ConnectionManager:
             self.external_socket.close()
         if self.health_socket:
             self.health_socket.close()
+        if self.rejoin_socket:
+            self.rejoin_socket.close()
@@ -0,0 +1,380 @@
+import os
+import time
+import heapq
+import socket
+import selectors
+import threading
+from collections import deque
+from typing import Mapping
+from threading import Thread
+import connections.consts as consts
+import connections.framing as framing
+from connections.schema import Machine, Response, NotifResponse, NotifBatchResponse, PingResponse
+
+
+def granted_credit(credit: int) -> int:
+    """
+    The credit a subscriber gets for what it advertised
+    """
+    return min(max(credit, 1), consts.NOTIF_MAX_CREDIT)
+
+
+class Subscriber:
+    """
+    A client subscribed to instant delivery of its user's chats
+    """
+
+    def __init__(self, sock) -> None:
+        self.sock = sock
+        self.user_id = None  # Set once the client has said who it is
+        # Clients that advertise credit get batches (NotifBatchResponse) and
+        # answer with cumulative acks. Older clients get one NotifResponse
+        # at a time and answer each one before the next.
+        self.batched = False
+        self.credit = 1  # Most chats the client takes without answering
+        self.unacked = deque()  # (seq, number of chats) of unanswered batches
+        self.in_flight = 0  # Chats in unacked
+        self.seq = 0  # Of the last batch sent
+        self.pinged = False  # Sent a ping the client hasn't answered yet
+        self.deadline = None  # When to ping, or when waiting, when to give up
+        self.alive = True
+        # Framed bytes the socket didn't take yet. The socket is non-blocking,
+        # so a client that stops reading only ever fills its own outbox.
+        self.outbox = bytearray()
+        self.handler = None  # What the selector calls with the events
+
+    def waiting(self) -> bool:
+        """
+        Whether something was sent that the client hasn't answered
+        """
+        return self.user_id is None or self.pinged or self.in_flight > 0
+
+    def room(self) -> int:
+        """
+        How many chats can be sent right now
+        """
+        if not self.batched:
+            return 0 if self.waiting() else 1
+        return max(self.credit - self.in_flight, 0)
+
+
+class NotifDispatcher:
+    """
+    Delivers chats to every subscribed client from one thread. A selector
+    watches the listening socket, every subscriber's socket and a pipe
+    that wake writes to, so the thread sleeps until a client answers, a
+    chat is queued for a subscriber, or a timer is due.
+    A subscriber says how many chats it takes without answering (its
+    credit), and gets whatever is queued for it in batches that fit in
+    that window. One ack answers every batch up to a point and grants the
+    credit again, so a send to a subscriber never has more than its window
+    in front of it. Subscriber sockets are non-blocking: what a socket
+    doesn't take right away waits in the subscriber's outbox, and the
+    selector watches the socket for writing until the outbox is empty, so
+    a client that stops reading never holds up the others. A subscriber with nothing to deliver for NOTIF_CHECK_IN
+    seconds is pinged, and one that doesn't answer within NOTIF_TIMEOUT is
+    dropped. Those are timers on a heap, not a thread per subscriber.
+    """
+
+    def __init__(self, identity: Machine, next_chats, mark_delivered, serving=lambda: True):
+        """
+        @param next_chats: A function that takes a user_id and a limit and
+        returns up to that many of the oldest chats still undelivered to
+        them (taking them off their queue)
+        @param mark_delivered: A function that takes the batches about to be
+        delivered, as (user_id, number of chats), and returns once they are
+        logged
+        @param serving: A function that says whether this machine delivers
+        chats, only the primary does, since deliveries are logged
+        """
+        self.identity = identity
+        self.next_chats = next_chats
+        self.mark_delivered = mark_delivered
+        self.serving = serving
+        self.alive = True
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()  # Guards ready and signaled
+        self.ready = set()  # Users that may have something to deliver
+        self.signaled = False  # Is there a byte in the wake pipe?
+        (self.wake_reader, self.wake_writer) = os.pipe()
+        os.set_blocking(self.wake_reader, False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, self.on_wake)
+        self.subscribers: Mapping[str, Subscriber] = {}
+        self.timers = []  # Heap of (when, tiebreak, subscriber)
+        self.timer_count = 0
+        self.chunk = bytearray(framing.RECV_SIZE)  # Where every recv lands
+        self.listen_socket = None
+        self.thread = None
+
+    def start(self, sock=None):
+        """
+        Starts listening on the notif port, and the thread that does the
+        delivering. sock is for testing purposes only.
+        """
+        if sock is not False:
+            self.listen(sock)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def listen(self, sock=None):
+        self.listen_socket = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.identity.host_ip, self.identity.notif_port))
+        self.listen_socket.listen()
+        self.listen_socket.setblocking(False)
+        self.selector.register(self.listen_socket, selectors.EVENT_READ,
+                               lambda _: self.on_accept(self.listen_socket))
+
+    def wake(self, user_id: str):
+        """
+        Called when a chat is queued for user_id, from any thread
+        """
+        with self.lock:
+            self.ready.add(user_id)
+            if self.signaled:
+                return
+            self.signaled = True
+        os.write(self.wake_writer, b"x")
+
+    def is_subscribed(self, user_id: str) -> bool:
+        return user_id in self.subscribers
+
+    def run(self):
+        try:
+            while self.alive:
+                self.run_once()
+        except OSError:
+            pass  # Stopped
+
+    def run_once(self, timeout=None):
+        """
+        Waits for something to happen (at most until the next timer, or
+        timeout) and handles it
+        """
+        if self.timers:
+            until_timer = max(self.timers[0][0] - time.time(), 0)
+            timeout = until_timer if timeout is None else min(timeout, until_timer)
+        for (key, events) in self.selector.select(timeout):
+            key.data(events)
+        self.fire_timers()
+        self.deliver_ready()
+
+    def on_accept(self, sock):
+        try:
+            (conn, _) = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self.add_subscriber(conn)
+
+    def add_subscriber(self, conn):
+        """
+        Watches a newly connected client, which first says who it is
+        """
+        conn.setblocking(False)
+        subscriber = Subscriber(conn)
+        subscriber.handler = lambda events: self.on_ready(subscriber, events)
+        self.selector.register(conn, selectors.EVENT_READ, subscriber.handler)
+        # Gone if it doesn't say who it is in time
+        self.set_timer(subscriber, time.time() + consts.NOTIF_TIMEOUT)
+
+    def on_wake(self, _):
+        try:
+            os.read(self.wake_reader, 4096)
+        except BlockingIOError:
+            pass
+        with self.lock:
+            self.signaled = False
+
+    def on_ready(self, subscriber: Subscriber, events: int):
+        if events & selectors.EVENT_WRITE:
+            self.flush(subscriber)
+        if events & selectors.EVENT_READ and subscriber.alive:
+            self.on_readable(subscriber)
+
+    def on_readable(self, subscriber: Subscriber):
+        try:
+            frames = framing.recv_available(subscriber.sock, self.chunk)
+            if frames is None:
+                raise Exception("Client closed connection")
+            for frame in frames:
+                if subscriber.user_id is None:
+                    self.subscribe(subscriber, frame.decode())
+                    continue
+                resp = Response.unmarshal(frame.decode())
+                if not resp.success:
+                    raise Exception("Client not there")
+                self.on_answer(subscriber, resp)
+        except (BlockingIOError, InterruptedError):
+            pass  # Nothing to read after all
+        except Exception:
+            self.drop(subscriber)
+
+    def subscribe(self, subscriber: Subscriber, greeting: str):
+        """
+        Takes a client's first frame, the user it wants chats for and the
+        credit it advertises ("<user_id>@@<credit>", older clients send just
+        the user_id). Only one client at a time can be subscribed to a user,
+        and only on the primary. Credit is capped at NOTIF_MAX_CREDIT.
+        """
+        (user_id, _, credit) = greeting.partition("@@")
+        if credit and not credit.isdigit():
+            self.write(subscriber, Response(user_id, False, "Invalid credit"))
+            raise Exception("Invalid credit")
+        if not self.serving():
+            self.write(subscriber, Response(user_id, False, "Not the primary"))
+            raise Exception("Not the primary")
+        if user_id in self.subscribers:
+            self.write(subscriber, Response(user_id, False, "Already logged in"))
+            raise Exception("Already logged in")
+        if credit:
+            subscriber.batched = True
+            subscriber.credit = granted_credit(int(credit))
+        subscriber.user_id = user_id
+        self.subscribers[user_id] = subscriber
+        self.write(subscriber, Response(user_id, True, ""))
+        # Whatever was queued while the user was away goes out now
+        self.mark_ready(user_id)
+
+    def on_answer(self, subscriber: Subscriber, resp: Response):
+        """
+        The client answered a ping, a notif, or (with an ack) batches
+        """
+        subscriber.pinged = False
+        if resp.type == "notifack":
+            subscriber.credit = granted_credit(resp.credit)
+            while subscriber.unacked and subscriber.unacked[0][0] <= resp.seq:
+                subscriber.in_flight -= subscriber.unacked.popleft()[1]
+        elif not subscriber.batched:
+            # Older clients answer every notif with a ping
+            subscriber.unacked.clear()
+            subscriber.in_flight = 0
+        if subscriber.waiting():
+            # Still waiting on something, but the client is making progress
+            self.set_timer(subscriber, time.time() + consts.NOTIF_TIMEOUT)
+        self.mark_ready(subscriber.user_id)
+
+    def mark_ready(self, user_id: str):
+        with self.lock:
+            self.ready.add(user_id)
+
+    def set_timer(self, subscriber: Subscriber, when: float):
+        subscriber.deadline = when
+        self.timer_count += 1
+        heapq.heappush(self.timers, (when, self.timer_count, subscriber))
+
+    def fire_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (when, _, subscriber) = heapq.heappop(self.timers)
+            if not subscriber.alive or subscriber.deadline != when:
+                continue  # Replaced by a newer timer
+            if subscriber.waiting():
+                # If the ping fails we assume the client has died and we stop
+                self.drop(subscriber)
+                continue
+            subscriber.pinged = self.send(subscriber, PingResponse())
+
+    def deliver_ready(self):
+        """
+        Sends every ready subscriber what is queued for it, as much as its
+        credit allows. The batches are logged (and so replicated) first, one
+        record per batch, all of them together. A backup never delivers
+        anything, its log only takes what the primary replicates.
+        """
+        with self.lock:
+            (ready, self.ready) = (self.ready, set())
+        if not self.serving():
+            return
+        deliveries = []
+        for user_id in ready:
+            subscriber = self.subscribers.get(user_id)
+            if subscriber is None or subscriber.room() == 0:
+                continue
+            chats = self.next_chats(user_id, subscriber.room())
+            if chats:
+                deliveries.append((subscriber, chats))
+            elif not subscriber.waiting():
+                # Nothing to deliver, check in on the client later
+                self.set_timer(subscriber, time.time() + consts.NOTIF_CHECK_IN)
+        if not deliveries:
+            return
+        self.mark_delivered([(subscriber.user_id, len(chats)) for (subscriber, chats) in deliveries])
+        for (subscriber, chats) in deliveries:
+            user_id = subscriber.user_id
+            if subscriber.batched:
+                resp = NotifBatchResponse(user_id, True, "", subscriber.seq + 1, chats)
+            else:
+                resp = NotifResponse(user_id, True, "", chats[0])
+            if self.send(subscriber, resp):
+                subscriber.seq += 1
+                subscriber.unacked.append((subscriber.seq, len(chats)))
+                subscriber.in_flight += len(chats)
+
+    def send(self, subscriber: Subscriber, resp: Response) -> bool:
+        """
+        Sends notifs or a ping. The client has NOTIF_TIMEOUT to answer,
+        counted from the first thing it hasn't answered.
+        """
+        was_waiting = subscriber.waiting()
+        if not self.write(subscriber, resp):
+            return False
+        if not was_waiting:
+            self.set_timer(subscriber, time.time() + consts.NOTIF_TIMEOUT)
+        return True
+
+    def write(self, subscriber: Subscriber, resp: Response) -> bool:
+        """
+        Queues a response behind whatever the subscriber's socket hasn't
+        taken yet and sends as much as it takes now. Returns False if the
+        subscriber was dropped.
+        """
+        subscriber.outbox += framing.frame(resp.marshal().encode())
+        return self.flush(subscriber)
+
+    def flush(self, subscriber: Subscriber) -> bool:
+        """
+        Sends what the socket takes without blocking, and has the selector
+        watch it for writing for as long as something is left
+        """
+        try:
+            while subscriber.outbox:
+                sent = subscriber.sock.send(subscriber.outbox)
+                del subscriber.outbox[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except Exception:
+            self.drop(subscriber)
+            return False
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.outbox else 0)
+        if events != self.selector.get_key(subscriber.sock).events:
+            self.selector.modify(subscriber.sock, events, subscriber.handler)
+        return True
+
+    def drop(self, subscriber: Subscriber):
+        """
+        The client has stopped listening. Forgets it so that other clients
+        can subscribe to this user.
+        """
+        if not subscriber.alive:
+            return
+        subscriber.alive = False
+        try:
+            self.selector.unregister(subscriber.sock)
+        except (KeyError, ValueError):
+            pass
+        subscriber.sock.close()
+        if subscriber.user_id is not None and self.subscribers.get(subscriber.user_id) is subscriber:
+            del self.subscribers[subscriber.user_id]
+
+    def stop(self):
+        self.alive = False
+        os.write(self.wake_writer, b"x")
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        for subscriber in list(self.subscribers.values()):
+            subscriber.sock.close()
+        if self.listen_socket:
+            self.listen_socket.close()
+        self.selector.close()
+        os.close(self.wake_reader)
+        os.close(self.wake_writer)
@@ -0,0 +1,191 @@
+import time
+import threading
+from bisect import bisect_left
+from queue import Queue, Full, Empty
+from threading import Thread
+import connections.consts as consts
+import connections.framing as framing
+
+
+class BackupSender:
+    """
+    Replicates to one backup. The primary hands it records tagged with their
+    log position and goes on with its next request. A thread of its own
+    sends them, pipelined: whatever has queued up since the last send goes
+    out in one sendall, without waiting for the backup in between.
+    The backup acks positions as it logs them (see ConnectionManager.ack_loop),
+    which is what tells the primary how far behind the backup is.
+    A sender started paused queues records without sending them until
+    resume, for a backup that is still being caught up.
+    """
+
+    def __init__(self, name: str, sock, on_failure=None, queue_size=consts.REPLICATION_QUEUE_SIZE,
+                 paused=False):
+        self.name = name
+        self.sock = sock
+        self.on_failure = on_failure  # Called with the name if the backup can't keep up
+        self.queue: "Queue[(int, bytes)]" = Queue(maxsize=queue_size)
+        self.alive = True
+        self.lock = threading.Condition()  # Guards the positions below
+        self.enqueued = 0  # Position of the newest record handed to this sender
+        self.sent = 0  # Position of the newest record written to the socket
+        self.acked = 0  # Newest position the backup says it has logged
+        self.acked_at = time.time()  # When acked last moved
+        self.resumed = threading.Event()
+        if not paused:
+            self.resumed.set()
+        self.thread = Thread(target=self.send_loop, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, position: int, payload: bytes) -> bool:
+        """
+        Never blocks. Returns False if the queue is full, i.e. the backup
+        has fallen too far behind to keep replicating to it.
+        """
+        if not self.alive:
+            return False
+        try:
+            self.queue.put_nowait((position, payload))
+        except Full:
+            self.fail()
+            return False
+        with self.lock:
+            self.enqueued = max(self.enqueued, position)
+        return True
+
+    def send_loop(self):
+        self.resumed.wait()
+        while self.alive:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < consts.REPLICATION_BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    self.alive = False
+                    break
+                batch.append(item)
+            try:
+                framing.send_frames(self.sock, [payload for (_, payload) in batch])
+            except Exception:
+                self.fail()
+                return
+            with self.lock:
+                self.sent = max(self.sent, batch[-1][0])
+                self.lock.notify_all()
+
+    def is_paused(self) -> bool:
+        return not self.resumed.is_set()
+
+    def resume(self):
+        self.resumed.set()
+
+    def ack(self, position: int):
+        with self.lock:
+            if position > self.acked:
+                self.acked = position
+                self.acked_at = time.time()
+            self.lock.notify_all()
+
+    def lag(self) -> int:
+        """
+        How many positions the backup is behind what it was handed
+        """
+        with self.lock:
+            return max(self.enqueued - self.acked, 0)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "acked": self.acked,
+                "lag": max(self.enqueued - self.acked, 0),
+                "queued": self.queue.qsize(),
+                "since_ack": round(time.time() - self.acked_at, 3),
+                "paused": self.is_paused(),
+            }
+
+    def flush(self, timeout=None) -> bool:
+        """
+        Waits until everything enqueued so far has been written to the
+        socket. Returns False on timeout or if the sender died.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.alive and self.sent < self.enqueued:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+            return self.sent >= self.enqueued
+
+    def fail(self):
+        if not self.alive:
+            return
+        self.stop()
+        if self.on_failure is not None:
+            self.on_failure(self.name)
+
+    def stop(self):
+        self.alive = False
+        self.resumed.set()
+        with self.lock:
+            self.lock.notify_all()
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+
+class LatencyHistogram:
+    """
+    Counts latencies into fixed buckets, cheap enough to record every
+    response. Used to compare commit levels.
+    """
+    # Upper bounds of the buckets in milliseconds, the last bucket is open
+    BOUNDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        ms = seconds * 1000
+        with self.lock:
+            self.counts[bisect_left(self.BOUNDS, ms)] += 1
+            self.total += ms
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Upper bound (ms) of the bucket holding the given fraction of
+        latencies, inf if it is in the open bucket
+        """
+        with self.lock:
+            counts = list(self.counts)
+        target = fraction * sum(counts)
+        seen = 0
+        for (i, count) in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else float("inf")
+        return 0.0
+
+    def summary(self) -> dict:
+        with self.lock:
+            count = sum(self.counts)
+            mean = self.total / count if count else 0.0
+            buckets = {(f"<={b}" if i < len(self.BOUNDS) else f">{self.BOUNDS[-1]}"): c
+                       for (i, (b, c)) in enumerate(zip(self.BOUNDS + [self.BOUNDS[-1]], self.counts)) if c}
+        return {
+            "count": count,
+            "mean_ms": mean,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "buckets": buckets,
+        }
@@ -42,28 +42,49 @@ class Machine:
         self.connections = connections
 
 
-IMPORTANT_REQUEST_TYPES = ["create", "send", "delete", "notif"]
-UNIMPORTANT_REQUEST_TYPES = ["login", "list", "logs", "fallover"]
+IMPORTANT_REQUEST_TYPES = ["create", "send", "delete", "notif", "watermark"]
+UNIMPORTANT_REQUEST_TYPES = ["login", "list", "logs", "search", "fallover"]
 REQUEST_TYPES = IMPORTANT_REQUEST_TYPES + UNIMPORTANT_REQUEST_TYPES
+# Requests that only read state, which backups serve too
+READ_REQUEST_TYPES = ["list", "logs", "search"]
 
 
 class Request:
     """
-    A base class for all requests from client -> server
+    A base class for all requests from client -> server. Requests and
+    responses are slotted (no dict per object), so every subclass lists the
+    attributes it adds in __slots__.
     """
+    __slots__ = ("user_id", "type", "lsn", "term")
 
     def __init__(self, user_id):
         self.user_id = user_id
         self.type = "blank"
+        # Set on records replicated by the primary (see codec encode_entry):
+        # the record's position in the primary's log, and the primary's term
+        self.lsn = 0
+        self.term = 0
 
     def marshal(self):
         return f"{self.user_id}@@{self.type}"
 
+    @staticmethod
+    def marshal_entry(req, lsn: int, term: int):
+        """
+        A replicated record, "<user_id>@@entry@@<lsn>@@<term>@@<request>"
+        """
+        return f"{req.user_id}@@entry@@{lsn}@@{term}@@{req.marshal()}"
+
     @staticmethod
     def unmarshal(rep):
         parts = rep.split("@@")
         user_id = parts[0]
         req_type = parts[1]
+        if req_type == "entry":
+            (_, _, lsn, term, inner) = rep.split("@@", 4)
+            req = Request.unmarshal(inner)
+            (req.lsn, req.term) = (int(lsn), int(term))
+            return req
         if req_type == "login":
             return LoginRequest(user_id)
         elif req_type == "create":
@@ -71,26 +92,44 @@ class Request:
         elif req_type == "list":
             wildcard = parts[2]
             page = int(parts[3])
-            return ListRequest(user_id, wildcard, page)
+            min_progress = int(parts[4]) if len(parts) > 4 else 0
+            cursor = parts[5] if len(parts) > 5 else None
+            return ListRequest(user_id, wildcard, page, min_progress, cursor)
         elif req_type == "logs":
             wildcard = parts[2]
             page = int(parts[3])
-            return LogsRequest(user_id, wildcard, page)
+            min_progress = int(parts[4]) if len(parts) > 4 else 0
+            cursor = parts[5] if len(parts) > 5 else None
+            return LogsRequest(user_id, wildcard, page, min_progress, cursor)
+        elif req_type == "search":
+            query = parts[2]
+            page = int(parts[3])
+            min_progress = int(parts[4]) if len(parts) > 4 else 0
+            return SearchRequest(user_id, query, page, min_progress)
         elif req_type == "send":
             recipient_id = parts[2]
             text = parts[3]
             return SendRequest(user_id, recipient_id, text)
         elif req_type == "notif":
-            return NotifRequest(user_id)
+            count = int(parts[2]) if len(parts) > 2 else 1
+            return NotifRequest(user_id, count)
+        elif req_type == "watermark":
+            return WatermarkRequest(user_id, int(parts[2]))
         elif req_type == "delete":
             return DeleteRequest(user_id)
         elif req_type == "fallover":
             return FalloverRequest(user_id)
+        elif req_type == "codec":
+            return CodecRequest(user_id, parts[2].split(","))
+        elif req_type == "ack":
+            return AckRequest(user_id, int(parts[2]))
         else:
             return Request(user_id)
 
 
 class CreateRequest(Request):
+    __slots__ = ()
+
     def __init__(self, user_id):
         super().__init__(user_id)
         self.type = "create"
@@ -100,6 +139,8 @@ class CreateRequest(Request):
 
 
 class FalloverRequest(Request):
+    __slots__ = ()
+
     def __init__(self, user_id):
         super().__init__(user_id)
         self.type = "fallover"
@@ -109,6 +150,8 @@ class FalloverRequest(Request):
 
 
 class LoginRequest(Request):
+    __slots__ = ()
+
     def __init__(self, user_id):
         super().__init__(user_id)
         self.type = "login"
@@ -119,50 +162,103 @@ class LoginRequest(Request):
 
 class ListRequest(Request):
     """
-    A request to list all users that match a wildcard
+    A request to list all users that match a wildcard.
+    A backup only serves it once it has applied min_progress records, so
+    a client can read its own writes from any machine.
+    With a cursor (from the previous ListResponse, "" to start) the pages
+    are counted from where it left off, and the response carries the
+    cursor for what comes next. None for clients that only use pages.
     """
+    __slots__ = ("wildcard", "page", "min_progress", "cursor")
 
-    def __init__(self, user_id, wildcard, page):
+    def __init__(self, user_id, wildcard, page, min_progress=0, cursor=None):
         super().__init__(user_id)
         self.type = "list"
         self.wildcard = wildcard
         self.page = page
+        self.min_progress = min_progress
+        self.cursor = cursor
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}@@{self.wildcard}@@{self.page}"
+        rep = f"{self.user_id}@@{self.type}@@{self.wildcard}@@{self.page}"
+        if self.min_progress or self.cursor is not None:
+            rep += f"@@{self.min_progress}"
+        if self.cursor is not None:
+            rep += f"@@{self.cursor}"
+        return rep
 
 
 class LogsRequest(Request):
     """
-    A request to list all messages that match a wildcard
+    A request to list all messages that match a wildcard.
+    A backup only serves it once it has applied min_progress records, so
+    a client can read its own writes from any machine.
+    With a cursor (from the previous LogsResponse, "" to start) the pages
+    are counted from where it left off, and the response carries the
+    cursor for what comes next. None for clients that only use pages.
     """
+    __slots__ = ("wildcard", "page", "min_progress", "cursor")
 
-    def __init__(self, user_id, wildcard, page):
+    def __init__(self, user_id, wildcard, page, min_progress=0, cursor=None):
         super().__init__(user_id)
         self.type = "logs"
         self.wildcard = wildcard
         self.page = page
+        self.min_progress = min_progress
+        self.cursor = cursor
+
+    def marshal(self):
+        rep = f"{self.user_id}@@{self.type}@@{self.wildcard}@@{self.page}"
+        if self.min_progress or self.cursor is not None:
+            rep += f"@@{self.min_progress}"
+        if self.cursor is not None:
+            rep += f"@@{self.cursor}"
+        return rep
+
+
+class SearchRequest(Request):
+    """
+    A request to search the messages a user received for the words of a
+    query. A backup only serves it once it has applied min_progress
+    records, so a client can read its own writes from any machine.
+    """
+    __slots__ = ("query", "page", "min_progress")
+
+    def __init__(self, user_id, query, page, min_progress=0):
+        super().__init__(user_id)
+        self.type = "search"
+        self.query = query
+        self.page = page
+        self.min_progress = min_progress
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}@@{self.wildcard}@@{self.page}"
+        rep = f"{self.user_id}@@{self.type}@@{self.query}@@{self.page}"
+        if self.min_progress:
+            rep += f"@@{self.min_progress}"
+        return rep
 
 
 class SendRequest(Request):
     """
     A request to send a message to a user
     """
+    __slots__ = ("recipient_id", "text", "delivered")
 
-    def __init__(self, user_id, recipient_id, text):
+    def __init__(self, user_id, recipient_id, text, delivered=False):
         super().__init__(user_id)
         self.type = "send"
         self.recipient_id = recipient_id
         self.text = text
+        # Only ever set in compacted logs, for sends whose notif was folded in
+        self.delivered = delivered
 
     def marshal(self):
         return f"{self.user_id}@@{self.type}@@{self.recipient_id}@@{self.text}"
 
 
 class DeleteRequest(Request):
+    __slots__ = ()
+
     def __init__(self, user_id):
         super().__init__(user_id)
         self.type = "delete"
@@ -177,38 +273,100 @@ class TakeoverRequest(Request):
     queue to help a server signal to itself that it should take over the
     primary role
     """
+    __slots__ = ()
 
     def __init__(self):
         super().__init__("")
         self.type = "takeover"
 
 
+class CodecRequest(Request):
+    """
+    Sent by a client right after connecting, offering the wire codecs it
+    can speak in order of preference. Always sent in the text format.
+    """
+    __slots__ = ("codecs",)
+
+    def __init__(self, user_id, codecs: List[str]):
+        super().__init__(user_id)
+        self.type = "codec"
+        self.codecs = codecs
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{','.join(self.codecs)}"
+
+
+class AckRequest(Request):
+    """
+    Sent by a backup to the primary over their internal connection, saying
+    how many records the backup has logged. user_id holds the backup's
+    machine name.
+    """
+    __slots__ = ("progress",)
+
+    def __init__(self, user_id, progress: int):
+        super().__init__(user_id)
+        self.type = "ack"
+        self.progress = progress
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{self.progress}"
+
+
 class NotifRequest(Request):
     """
-    A request by a user to get one message from their cache
+    A request by a user to get messages from their cache, one unless count
+    says otherwise (a batch delivered together)
     """
+    __slots__ = ("count",)
 
-    def __init__(self, user_id):
+    def __init__(self, user_id, count=1):
         super().__init__(user_id)
         self.type = "notif"
+        self.count = int(count)
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}"
+        if self.count == 1:
+            return f"{self.user_id}@@{self.type}"
+        return f"{self.user_id}@@{self.type}@@{self.count}"
+
+
+class WatermarkRequest(Request):
+    """
+    Moves a user's delivery watermark: the first watermark messages they
+    ever received (counting from their create) have been delivered
+    """
+    __slots__ = ("watermark",)
+
+    def __init__(self, user_id, watermark: int):
+        super().__init__(user_id)
+        self.type = "watermark"
+        self.watermark = int(watermark)
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{self.watermark}"
 
 
 class Response:
     """
     A base class for all responses from server -> client
     """
+    __slots__ = ("user_id", "success", "error_message", "type", "progress")
 
     def __init__(self, user_id, success, error_message):
         self.user_id = user_id
         self.success = success
         self.error_message = error_message
         self.type = "basic"
+        # The progress of the log this was served at (for writes, where the
+        # request went in the log), 0 if unknown
+        self.progress = 0
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}"
+        rep = f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}"
+        if self.progress:
+            rep += f"@@{self.progress}"
+        return rep
 
     @staticmethod
     def unmarshal(rep):
@@ -220,34 +378,57 @@ class Response:
         if resp_type == "list":
             accounts = parts[4]
             accounts = ListResponse.unmarshal_accounts(accounts)
-            return ListResponse(user_id, success, error_message, accounts)
+            cursor = parts[6] if len(parts) > 6 else None
+            resp = ListResponse(user_id, success, error_message, accounts, cursor)
+            resp.progress = int(parts[5]) if len(parts) > 5 else 0
+            return resp
         elif resp_type == "logs":
             if len(parts) < 5 or parts[4] == "":
                 msgs = []
             else:
                 msgs = LogsResponse.unmarshal_msgs(parts[4])
-            return LogsResponse(user_id, success, error_message, msgs)
+            cursor = parts[6] if len(parts) > 6 else None
+            resp = LogsResponse(user_id, success, error_message, msgs, cursor)
+            resp.progress = int(parts[5]) if len(parts) > 5 else 0
+            return resp
+        elif resp_type == "search":
+            msgs = LogsResponse.unmarshal_msgs(parts[4]) if len(parts) > 4 and parts[4] else []
+            resp = SearchResponse(user_id, success, error_message, msgs)
+            resp.progress = int(parts[5]) if len(parts) > 5 else 0
+            return resp
         elif resp_type == "notif":
             author_id = parts[4]
             recipient_id = parts[5]
             text = parts[6]
             chat = data_schema.Chat(author_id, recipient_id, text)
             return NotifResponse(user_id, success, error_message, chat)
+        elif resp_type == "notifs":
+            msgs = LogsResponse.unmarshal_msgs(parts[5]) if parts[5] else []
+            return NotifBatchResponse(user_id, success, error_message, int(parts[4]), msgs)
         elif resp_type == "ping":
             return PingResponse()
+        elif resp_type == "notifack":
+            return NotifAckResponse(user_id, int(parts[4]), int(parts[5]))
+        elif resp_type == "codec":
+            return CodecResponse(user_id, success, error_message, parts[4])
         else:
-            return Response(user_id, success, error_message)
+            resp = Response(user_id, success, error_message)
+            resp.progress = int(parts[4]) if len(parts) > 4 else 0
+            return resp
 
 
 class ListResponse(Response):
     """
-    A response to a ListRequest
+    A response to a ListRequest. To requests with a cursor it carries the
+    cursor that resumes after this page, "" once there is nothing after it.
     """
+    __slots__ = ("accounts", "cursor")
 
-    def __init__(self, user_id, success, error_message, accounts):
+    def __init__(self, user_id, success, error_message, accounts, cursor=None):
         super().__init__(user_id, success, error_message)
         self.accounts = accounts
         self.type = "list"
+        self.cursor = cursor
 
     @staticmethod
     def marshal_accounts(accounts):
@@ -260,18 +441,26 @@ class ListResponse(Response):
         return [data_schema.Account.unmarshal(a) for a in str_list]
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{ListResponse.marshal_accounts(self.accounts)}"
+        rep = f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{ListResponse.marshal_accounts(self.accounts)}"
+        if self.progress or self.cursor is not None:
+            rep += f"@@{self.progress}"
+        if self.cursor is not None:
+            rep += f"@@{self.cursor}"
+        return rep
 
 
 class LogsResponse(Response):
     """
-    A response to a LogsRequest
+    A response to a LogsRequest. To requests with a cursor it carries the
+    cursor that resumes after this page, "" once there is nothing after it.
     """
+    __slots__ = ("msgs", "cursor")
 
-    def __init__(self, user_id, success, error_message, msgs):
+    def __init__(self, user_id, success, error_message, msgs, cursor=None):
         super().__init__(user_id, success, error_message)
         self.msgs = msgs
         self.type = "logs"
+        self.cursor = cursor
 
     @staticmethod
     def marshal_msgs(msgs):
@@ -283,13 +472,38 @@ class LogsResponse(Response):
         return [data_schema.Chat.unmarshal(el, "||") for el in arr]
 
     def marshal(self):
-        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{LogsResponse.marshal_msgs(self.msgs)}"
+        rep = f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{LogsResponse.marshal_msgs(self.msgs)}"
+        if self.progress or self.cursor is not None:
+            rep += f"@@{self.progress}"
+        if self.cursor is not None:
+            rep += f"@@{self.cursor}"
+        return rep
+
+
+class SearchResponse(Response):
+    """
+    A response to a SearchRequest, with the matching messages best first.
+    Search pages go by number only, there are no cursors.
+    """
+    __slots__ = ("msgs",)
+
+    def __init__(self, user_id, success, error_message, msgs):
+        super().__init__(user_id, success, error_message)
+        self.msgs = msgs
+        self.type = "search"
+
+    def marshal(self):
+        rep = f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{LogsResponse.marshal_msgs(self.msgs)}"
+        if self.progress:
+            rep += f"@@{self.progress}"
+        return rep
 
 
 class NotifResponse(Response):
     """
     A response to a NotifRequest
     """
+    __slots__ = ("chat",)
 
     def __init__(self, user_id, success, error_message, chat: data_schema.Chat):
         super().__init__(user_id, success, error_message)
@@ -300,10 +514,29 @@ class NotifResponse(Response):
         return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{self.chat.marshal()}"
 
 
+class NotifBatchResponse(Response):
+    """
+    Several chats delivered to a subscriber at once. seq numbers the
+    batches sent on a subscription, so one NotifAckResponse can answer
+    all of them up to a point.
+    """
+    __slots__ = ("seq", "msgs")
+
+    def __init__(self, user_id, success, error_message, seq: int, msgs):
+        super().__init__(user_id, success, error_message)
+        self.type = "notifs"
+        self.seq = seq
+        self.msgs = msgs
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{self.seq}@@{LogsResponse.marshal_msgs(self.msgs)}"
+
+
 class PingResponse(Response):
     """
     A response that just lets the server know this client is alive
     """
+    __slots__ = ()
 
     def __init__(self, user_id=""):
         super().__init__(user_id, True, "")
@@ -311,3 +544,36 @@ class PingResponse(Response):
 
     def marshal(self):
         return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}"
+
+
+class NotifAckResponse(Response):
+    """
+    A subscriber's answer to notif batches: it has every batch up to and
+    including seq, and can take credit more chats that it hasn't answered
+    """
+    __slots__ = ("seq", "credit")
+
+    def __init__(self, user_id, seq: int, credit: int):
+        super().__init__(user_id, True, "")
+        self.type = "notifack"
+        self.seq = seq
+        self.credit = credit
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{self.seq}@@{self.credit}"
+
+
+class CodecResponse(Response):
+    """
+    A response to a CodecRequest, naming the codec both sides will use
+    from now on. Always sent in the text format.
+    """
+    __slots__ = ("codec",)
+
+    def __init__(self, user_id, success, error_message, codec: str):
+        super().__init__(user_id, success, error_message)
+        self.type = "codec"
+        self.codec = codec
+
+    def marshal(self):
+        return f"{self.user_id}@@{self.type}@@{self.success}@@{self.error_message}@@{self.codec}"
@@ -0,0 +1,180 @@
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice, takewhile
+from typing import Iterable, List, Optional, Tuple
+
+# Ids are kept sorted in chunks of about CHUNK_SIZE, so creating or
+# deleting a user shifts one chunk rather than the whole directory
+CHUNK_SIZE = 1024
+# Ids are indexed by every substring of this length (their n-grams)
+GRAM = 3
+# A wildcard starting with this only matches ids that start with the rest
+PREFIX = "^"
+
+
+class SortedIds:
+    """
+    User ids in sorted order, as a list of sorted chunks, with the last id
+    of every chunk alongside to find the right one by bisection
+    """
+
+    def __init__(self, ids: Iterable[str] = ()):
+        ids = sorted(ids)
+        self.chunks = [ids[ix:ix + CHUNK_SIZE] for ix in range(0, len(ids), CHUNK_SIZE)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.size = len(ids)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, user_id: str):
+        if not self.chunks:
+            self.chunks.append([user_id])
+            self.maxes.append(user_id)
+            self.size += 1
+            return
+        ix = min(bisect_left(self.maxes, user_id), len(self.chunks) - 1)
+        chunk = self.chunks[ix]
+        insort(chunk, user_id)
+        self.maxes[ix] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self.chunks[ix:ix + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self.maxes[ix:ix + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+        self.size += 1
+
+    def remove(self, user_id: str):
+        ix = bisect_left(self.maxes, user_id)
+        chunk = self.chunks[ix]
+        del chunk[bisect_left(chunk, user_id)]
+        self.size -= 1
+        if chunk:
+            self.maxes[ix] = chunk[-1]
+        else:
+            del self.chunks[ix]
+            del self.maxes[ix]
+
+    def locate(self, user_id: str, after=False) -> Tuple[int, int]:
+        """
+        Returns (chunk, position in it) of the first id that is at least
+        user_id, or with after, greater than it
+        """
+        find = bisect_right if after else bisect_left
+        ix = find(self.maxes, user_id)
+        if ix == len(self.chunks):
+            return (ix, 0)
+        return (ix, find(self.chunks[ix], user_id))
+
+    def skip(self, start: Tuple[int, int], count: int) -> Tuple[int, int]:
+        """
+        Moves a location count ids forward, a chunk at a time
+        """
+        (ix, pos) = start
+        while ix < len(self.chunks) and pos + count >= len(self.chunks[ix]):
+            count -= len(self.chunks[ix]) - pos
+            (ix, pos) = (ix + 1, 0)
+        return (ix, pos + count)
+
+    def iterate(self, start: Tuple[int, int] = (0, 0)):
+        (ix, pos) = start
+        while ix < len(self.chunks):
+            yield from self.chunks[ix][pos:]
+            (ix, pos) = (ix + 1, 0)
+
+
+def grams(text: str) -> set:
+    return {text[ix:ix + GRAM] for ix in range(len(text) - GRAM + 1)}
+
+
+class UserDirectory:
+    """
+    An index of every user id, kept up to date as users are created and
+    deleted, that answers the wildcards of list requests a page at a time
+    without going through every account:
+    - "" and prefixes ("^abc") walk the sorted ids from where the page
+      starts, which is found by bisection (and page numbers skip whole
+      chunks).
+    - Substrings of at least GRAM characters intersect the sets of ids
+      holding each of their n-grams, starting from the smallest, then
+      check and order only those candidates.
+    - Shorter substrings walk the sorted ids and test each one. They match
+      so many ids that a page fills quickly.
+    Pages come in user id order. A page can also start after a given id,
+    which is what cursors hold (see make_cursor).
+    """
+
+    def __init__(self, user_ids: Iterable[str] = ()):
+        user_ids = list(user_ids)
+        self.ids = SortedIds(user_ids)
+        self.grams = {}  # n-gram -> set of the ids containing it
+        for user_id in user_ids:
+            self.index(user_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, user_id: str):
+        for gram in grams(user_id):
+            self.grams.setdefault(gram, set()).add(user_id)
+
+    def add(self, user_id: str):
+        self.ids.add(user_id)
+        self.index(user_id)
+
+    def remove(self, user_id: str):
+        self.ids.remove(user_id)
+        for gram in grams(user_id):
+            holders = self.grams[gram]
+            holders.discard(user_id)
+            if not holders:
+                del self.grams[gram]
+
+    def page(self, wildcard: str, size: int, page=0, after: Optional[str] = None) -> Tuple[List[str], bool]:
+        """
+        Returns the ids on the given page of those matching wildcard (that
+        come after the id after, if given), and whether there are more
+        """
+        if page < 0:
+            return ([], False)
+        skip = page * size
+        if wildcard == "" or wildcard.startswith(PREFIX):
+            prefix = wildcard[len(PREFIX):]
+            start = self.ids.skip(self.start(after, prefix), skip)
+            found = takewhile(lambda user_id: user_id.startswith(prefix), self.ids.iterate(start))
+            found = list(islice(found, size + 1))
+        elif len(wildcard) >= GRAM:
+            found = self.with_grams(wildcard, skip + size + 1, after)[skip:]
+        else:
+            found = (user_id for user_id in self.ids.iterate(self.start(after)) if wildcard in user_id)
+            found = list(islice(found, skip, skip + size + 1))
+        return (found[:size], len(found) > size)
+
+    def start(self, after: Optional[str], prefix="") -> Tuple[int, int]:
+        """
+        Where ids starting with prefix that come after the id after start
+        """
+        if after is not None and after >= prefix:
+            return self.ids.locate(after, after=True)
+        return self.ids.locate(prefix)
+
+    def with_grams(self, wildcard: str, limit: int, after: Optional[str]):
+        """
+        The first limit ids containing wildcard, in order
+        """
+        (smallest, *others) = sorted((self.grams.get(gram, set()) for gram in grams(wildcard)), key=len)
+        return heapq.nsmallest(limit, (
+            user_id for user_id in smallest
+            if (after is None or user_id > after) and wildcard in user_id and all(user_id in ids for ids in others)))
+
+
+def make_cursor(user_id: str) -> str:
+    """
+    A cursor resuming a listing after user_id. Clients treat it as opaque.
+    """
+    return user_id.encode().hex()
+
+
+def read_cursor(cursor: str) -> str:
+    """
+    The user_id a cursor resumes after. Raises ValueError if it isn't one.
+    """
+    return bytes.fromhex(cursor).decode()
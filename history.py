@@ -0,0 +1,237 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from types import MappingProxyType
+from typing import Iterable, List, Optional, Tuple
+import schema
+from search import TEXT_INDEXES, TextIndex
+
+
+class UserIds:
+    """
+    Interns user ids: every id is stored once, and known by a small integer
+    everywhere else (message logs store the authors of their chats as these)
+    """
+
+    def __init__(self):
+        self.numbers = {}  # user_id -> number
+        self.names = []  # number -> user_id
+
+    def __len__(self):
+        return len(self.names)
+
+    def number(self, user_id: str) -> int:
+        number = self.numbers.get(user_id)
+        if number is None:
+            number = self.numbers[user_id] = len(self.names)
+            self.names.append(user_id)
+        return number
+
+    def name(self, number: int) -> str:
+        return self.names[number]
+
+
+# Shared by every message log of the process. Ids are never forgotten:
+# the chats of deleted users stay in the logs of whoever they wrote to.
+USER_IDS = UserIds()
+# The author index of message logs that haven't received anything
+NO_AUTHORS = MappingProxyType({})
+
+
+class MessageLog:
+    """
+    Every chat a user received, in an append-only store: chats are kept
+    oldest first and new ones go on the end, so receiving one is O(1) no
+    matter how long the history is. A chat's position (how many chats came
+    before it) never changes, so positions make stable keys.
+    Chats are stored in columns rather than as objects: the author's
+    interned number (see UserIds) in an array, and the texts back to back
+    in one utf-8 blob with an array of where each ends. The recipient is
+    always the owner of the log, so it is stored once. Chat objects are
+    only made when a chat is read. Most users never receive anything, so
+    the columns and indexes are only made on the first chat.
+    Iterating goes newest first, like the list this replaces. Alongside,
+    every author maps to the positions of their chats (just the position
+    for authors of a single chat), so wildcard filters
+    on the author only go through the authors and the chats of those that
+    match, not the whole history. The words of the newest chats are
+    indexed for search once the log is first searched (see search.py).
+    """
+    __slots__ = ("recipient_id", "authors", "text_ends", "texts", "by_author")
+
+    def __init__(self, recipient_id: str, chats: Iterable = ()):
+        self.recipient_id = USER_IDS.name(USER_IDS.number(recipient_id))
+        self.authors = ()  # Number of the author of every chat, oldest first
+        self.text_ends = ()  # Where the text of every chat ends in texts
+        self.texts = b""
+        self.by_author = NO_AUTHORS  # author number -> positions of their chats, ascending
+        for chat in chats:
+            self.append(chat)
+
+    def __len__(self):
+        return len(self.authors)
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self.authors) - 1, -1, -1))
+
+    def __getitem__(self, position: int):
+        return schema.Chat(USER_IDS.name(self.authors[position]), self.recipient_id, self.text(position))
+
+    def text(self, position: int) -> str:
+        start = self.text_ends[position - 1] if position else 0
+        return self.texts[start:self.text_ends[position]].decode()
+
+    def append(self, chat):
+        position = len(self.authors)
+        if position == 0:
+            (self.authors, self.text_ends, self.texts) = (array("I"), array("Q"), bytearray())
+            self.by_author = {}
+        author = USER_IDS.number(chat.author_id)
+        positions = self.by_author.get(author)
+        if positions is None:
+            self.by_author[author] = position
+        elif isinstance(positions, int):
+            self.by_author[author] = array("I", (positions, position))
+        else:
+            positions.append(position)
+        self.authors.append(author)
+        self.texts += chat.text.encode()
+        self.text_ends.append(len(self.texts))
+        index = TEXT_INDEXES.peek(self)
+        if index is not None:
+            before = index.size
+            index.add(position, chat.text)
+            TEXT_INDEXES.resized(index.size - before)
+
+    def oldest(self, count: int) -> list:
+        """
+        The first count chats received, oldest first
+        """
+        return [self[position] for position in range(min(count, len(self.authors)))]
+
+    def page(self, wildcard: str, size: int, page=0, before: Optional[int] = None) -> Tuple[List[int], bool]:
+        """
+        Returns the positions on the given page of the chats whose author
+        contains wildcard, newest first (counting from the chats older than
+        the position before, if given), and whether there are more
+        """
+        if page < 0:
+            return ([], False)
+        end = len(self.authors) if before is None else max(min(before, len(self.authors)), 0)
+        skip = page * size
+        if wildcard == "":
+            found = list(range(end - 1 - skip, max(end - 1 - skip - size - 1, -1), -1))
+        else:
+            newest_first = [self.older(positions, end) for (author, positions) in self.by_author.items()
+                            if wildcard in USER_IDS.name(author)]
+            found = list(islice(heapq.merge(*newest_first, reverse=True), skip, skip + size + 1))
+        return (found[:size], len(found) > size)
+
+    def search(self, query: str, size: int, page=0) -> Tuple[List[int], bool]:
+        """
+        Returns the positions on the given page of the chats matching the
+        words of query, best first, and whether there are more
+        """
+        if not self.authors:
+            return ([], False)
+        return TEXT_INDEXES.get(self, self.build_index).search(query, size, page)
+
+    def build_index(self) -> TextIndex:
+        return TextIndex.build(self.text, len(self.authors))
+
+    def drop_index(self):
+        """
+        Frees the text index, for a log that won't be searched again
+        """
+        TEXT_INDEXES.discard(self)
+
+    @staticmethod
+    def older(positions, end: int):
+        """
+        The positions below end, newest first
+        """
+        if isinstance(positions, int):
+            return (positions,) if positions < end else ()
+        return (positions[ix] for ix in range(bisect_left(positions, end) - 1, -1, -1))
+
+
+class Undelivered:
+    """
+    The chats not yet delivered to every user. Chats are delivered in the
+    order they were received, so a user's undelivered chats are always the
+    newest of their message log, and all that is kept is the position of
+    the oldest one. Only users with undelivered chats have an entry, so
+    users who are never online cost nothing until someone writes to them.
+    """
+    __slots__ = ("starts",)
+
+    def __init__(self):
+        self.starts = {}  # user_id -> position of their oldest undelivered chat
+
+    def __len__(self):
+        """
+        The number of users with undelivered chats
+        """
+        return len(self.starts)
+
+    def add(self, user_id: str, position: int):
+        """
+        The chat at position (the newest) is undelivered
+        """
+        self.starts.setdefault(user_id, position)
+
+    def count(self, user_id: str, msg_log: MessageLog) -> int:
+        start = self.starts.get(user_id)
+        return 0 if start is None else len(msg_log) - start
+
+    def peek(self, user_id: str, msg_log: MessageLog) -> list:
+        """
+        The undelivered chats of a user, oldest first
+        """
+        start = self.starts.get(user_id, len(msg_log))
+        return [msg_log[position] for position in range(start, len(msg_log))]
+
+    def take(self, user_id: str, msg_log: MessageLog, limit: int) -> list:
+        """
+        Delivers up to limit of the oldest undelivered chats of a user, and
+        returns them
+        """
+        start = self.starts.get(user_id)
+        if start is None:
+            return []
+        end = min(start + max(limit, 0), len(msg_log))
+        self.keep(user_id, msg_log, len(msg_log) - end)
+        return [msg_log[position] for position in range(start, end)]
+
+    def keep(self, user_id: str, msg_log: MessageLog, count: int):
+        """
+        Delivers all but the newest count chats of a user. Never undoes a
+        delivery.
+        """
+        start = self.starts.get(user_id)
+        if start is None:
+            return
+        start = max(start, len(msg_log) - max(count, 0))
+        if start < len(msg_log):
+            self.starts[user_id] = start
+        else:
+            del self.starts[user_id]
+
+    def forget(self, user_id: str):
+        self.starts.pop(user_id, None)
+
+
+def make_log_cursor(position: int) -> str:
+    """
+    A cursor resuming a log listing with the chats older than the one at
+    position. Clients treat it as opaque.
+    """
+    return format(position, "x")
+
+
+def read_log_cursor(cursor: str) -> int:
+    """
+    The position a cursor resumes before. Raises ValueError if it isn't one.
+    """
+    return int(cursor, 16)
@@ -0,0 +1,42 @@
+# Configuration for how machines persist their logs
+
+# How hard the log writer tries to make a commit durable
+# - "fsync": every group commit is fsync'd before appenders are released
+# - "periodic": commits are flushed to the OS, fsync happens every FSYNC_INTERVAL
+# - "buffered": commits are flushed to the OS, fsync is left to the OS
+DURABILITY_FSYNC = "fsync"
+DURABILITY_PERIODIC = "periodic"
+DURABILITY_BUFFERED = "buffered"
+DURABILITY_MODES = [DURABILITY_FSYNC, DURABILITY_PERIODIC, DURABILITY_BUFFERED]
+DURABILITY = DURABILITY_PERIODIC
+
+# Seconds between fsyncs when running with DURABILITY_PERIODIC
+FSYNC_INTERVAL = 1
+
+# Seconds the writer lingers after waking up so more appends can join the
+# commit. 0 means "commit whatever is pending as soon as possible".
+BATCH_WINDOW = 0
+
+# How many recent commit sizes the writer remembers for reporting
+COMMIT_HISTORY = 1024
+
+# Take a snapshot of server state every time this many records have been
+# logged since the last one
+SNAPSHOT_INTERVAL = 1000
+
+# How many snapshots to keep around (older ones get deleted)
+SNAPSHOT_RETAIN = 2
+
+# zlib level for snapshots sent to other machines during catch up
+SNAPSHOT_COMPRESSION = 6
+
+# The log is split into segments, a new one is started once the active
+# segment grows past this many bytes
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# How many of the newest sealed segments are never compacted, so machines
+# that are a little behind can still catch up record by record
+SEGMENT_RETAIN = 2
+
+# Seconds between reports of group commit sizes (0 turns reporting off)
+COMMIT_REPORT_INTERVAL = 60
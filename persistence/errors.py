@@ -0,0 +1,25 @@
+# An exception type for log files that can't be read as binary logs
+class LogFormatException(Exception):
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.message = f"Log {filename} is not in the binary log format (try python3 -m persistence.migrate)"
+        super().__init__(self.message)
+
+
+# An exception type for reads that start inside the compacted part of a log
+class CompactedRangeException(Exception):
+    def __init__(self, progress: int, horizon: int):
+        self.progress = progress
+        self.horizon = horizon
+        self.message = f"Progress {progress} is inside the compacted part of the log (before {horizon})"
+        super().__init__(self.message)
+
+
+# An exception type for appends that can never be committed because the
+# log writer hit an error (disk full, I/O error, ...)
+class LogWriteException(Exception):
+    def __init__(self, filename: str, cause: Exception):
+        self.filename = filename
+        self.cause = cause
+        self.message = f"Writing to log {filename} failed: {cause}"
+        super().__init__(self.message)
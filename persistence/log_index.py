@@ -0,0 +1,146 @@
+import os
+import threading
+from array import array
+from typing import List
+from connections.schema import Request
+import persistence.records as records
+from utils import print_error
+
+ENTRY_SIZE = 8  # Every entry is the byte offset of one record, as a uint64
+
+
+class LogIndex:
+    """
+    A sidecar index for a log file (<log>.idx) mapping progress number to
+    the byte offset where that record starts. The log writer appends to it
+    after every commit, so the progress of a machine is just the number of
+    entries and catching someone up can seek straight to where they are.
+    If the index turns out to be missing or out of step with the log
+    it gets rebuilt from the log.
+    """
+
+    def __init__(self, log_filename: str) -> None:
+        self.log_filename = log_filename
+        self.filename = log_filename + ".idx"
+        self.lock = threading.Lock()
+        self.offsets = array("Q")  # In memory copy of the index
+        self.end = records.FILE_HEADER.size  # Byte offset just past the last indexed record
+        if not self.load():
+            self.rebuild()
+        self.file = open(self.filename, "ab")
+
+    def load(self):
+        """
+        Reads the index from disk. Returns False if it is missing or stale.
+        """
+        if not os.path.exists(self.filename) or not os.path.exists(self.log_filename):
+            return False
+        size = os.path.getsize(self.filename)
+        if size % ENTRY_SIZE != 0:
+            return False
+        offsets = array("Q")
+        with open(self.filename, "rb") as file:
+            offsets.fromfile(file, size // ENTRY_SIZE)
+        log_size = os.path.getsize(self.log_filename)
+        if log_size == 0:
+            return False
+        with open(self.log_filename, "rb") as log:
+            records.check_header(
+                log.read(records.FILE_HEADER.size), self.log_filename)
+            if len(offsets) == 0:
+                end = records.FILE_HEADER.size
+            else:
+                # The last indexed record must be the last record in the log
+                log.seek(offsets[-1])
+                header = log.read(records.RECORD_HEADER.size)
+                if len(header) < records.RECORD_HEADER.size:
+                    return False
+                (length, _) = records.RECORD_HEADER.unpack(header)
+                end = offsets[-1] + records.RECORD_HEADER.size + length
+        if end != log_size:
+            return False
+        self.offsets = offsets
+        self.end = log_size
+        return True
+
+    def rebuild(self):
+        """
+        Scans the log and writes a fresh index for it. If the log ends in a
+        torn record (a partial write, or one failing its checksum) the log
+        is truncated back to the last good record.
+        """
+        if not os.path.exists(self.log_filename) or os.path.getsize(self.log_filename) == 0:
+            with open(self.log_filename, "wb") as log:
+                log.write(records.file_header())
+        with open(self.log_filename, "rb") as log:
+            data = log.read()
+        records.check_header(data, self.log_filename)
+        offsets = array("Q")
+        end = records.FILE_HEADER.size
+        for (offset, record_end) in records.scan(data, end):
+            offsets.append(offset)
+            end = record_end
+        if end != len(data):
+            print_error(
+                f"Truncating torn tail of {self.log_filename} ({len(data) - end} bytes)")
+            os.truncate(self.log_filename, end)
+        with open(self.filename + ".tmp", "wb") as file:
+            offsets.tofile(file)
+        os.replace(self.filename + ".tmp", self.filename)
+        self.offsets = offsets
+        self.end = end
+
+    def append(self, offsets: List[int], end: int):
+        """
+        Records the offsets of a batch of records that was just committed
+        to the log, the last of which ends at byte `end`
+        """
+        batch = array("Q", offsets)
+        with self.lock:
+            self.offsets.extend(batch)
+            self.end = end
+            batch.tofile(self.file)
+            self.file.flush()
+
+    def is_full(self):
+        """
+        A plain index is for a single file log, which never fills up
+        """
+        return False
+
+    def count(self) -> int:
+        """
+        The progress of the log, i.e. how many records it has
+        """
+        with self.lock:
+            return len(self.offsets)
+
+    def read(self, start_progress: int, end_progress: int) -> List[Request]:
+        """
+        Returns the records with progress >= start_progress and
+        progress < end_progress, reading only that part of the log
+        """
+        with self.lock:
+            end_progress = min(end_progress, len(self.offsets))
+            if start_progress >= end_progress:
+                return []
+            start = self.offsets[start_progress]
+            end = self.offsets[end_progress] if end_progress < len(
+                self.offsets) else self.end
+        with open(self.log_filename, "rb") as log:
+            log.seek(start)
+            data = log.read(end - start)
+        return records.decode_all(data, 0)
+
+    def clear(self):
+        """
+        Empties the log and its index
+        """
+        with self.lock:
+            os.truncate(self.log_filename, records.FILE_HEADER.size)
+            self.file.truncate(0)
+            self.offsets = array("Q")
+            self.end = records.FILE_HEADER.size
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+from collections import deque
+from threading import Thread
+from typing import List
+import persistence.consts as consts
+from persistence.errors import LogWriteException
+from utils import print_error
+
+
+class LogWriter:
+    """
+    Owns the one open handle to a machine's log file. Appends can come from
+    any thread (the request loop, notif threads, ...). They are queued and a
+    background thread writes everything that is pending in a single group
+    commit: one write, one flush and (depending on durability) one fsync.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        durability: str = consts.DURABILITY,
+        batch_window: float = consts.BATCH_WINDOW,
+        fsync_interval: float = consts.FSYNC_INTERVAL,
+        on_commit=None,
+        index=None,
+    ) -> None:
+        if durability not in consts.DURABILITY_MODES:
+            raise ValueError("Invalid durability mode")
+        self.filename = filename
+        self.durability = durability
+        self.batch_window = batch_window
+        self.fsync_interval = fsync_interval
+        # Called with the number of records in every commit (for tuning)
+        self.on_commit = on_commit
+        # Optional LogIndex (or SegmentedLog) that is told where every
+        # committed record starts
+        self.index = index
+        self.file = open(filename, "ab")
+        self.lock = threading.Lock()
+        self.has_pending = threading.Condition(self.lock)
+        self.has_committed = threading.Condition(self.lock)
+        self.pending: List[bytes] = []
+        self.appended = 0  # Number of records handed to the writer
+        self.committed = 0  # Number of records that made it to the file
+        self.commit_sizes = deque(maxlen=consts.COMMIT_HISTORY)
+        self.dirty = False  # Written but not yet fsync'd
+        self.last_fsync = time.time()
+        self.alive = True
+        self.error = None  # Set if the writer thread failed, appends then raise
+        self.commit_thread = Thread(target=self.commit_loop, daemon=True)
+        self.commit_thread.start()
+
+    def append(self, record: bytes, wait=None) -> int:
+        """
+        Queues one record for the next group commit and returns its ticket.
+        By default, blocks until the commit holding the record is done,
+        except in buffered mode where the caller is released immediately.
+        """
+        with self.lock:
+            if self.error is not None:
+                raise LogWriteException(self.filename, self.error)
+            if not self.alive:
+                raise ValueError("Log writer has been closed")
+            self.pending.append(record)
+            self.appended += 1
+            ticket = self.appended
+            self.has_pending.notify()
+        if wait is None:
+            wait = self.durability != consts.DURABILITY_BUFFERED
+        if wait:
+            self.wait_for(ticket)
+        return ticket
+
+    def wait_for(self, ticket: int):
+        """
+        Blocks until the record with the given ticket has been committed.
+        Raises LogWriteException if the writer failed before committing it.
+        """
+        with self.lock:
+            while self.committed < ticket:
+                if self.error is not None:
+                    raise LogWriteException(self.filename, self.error)
+                self.has_committed.wait()
+
+    def last_ticket(self) -> int:
+        """
+        The ticket of the newest record appended so far
+        """
+        with self.lock:
+            return self.appended
+
+    def flush(self):
+        """
+        Blocks until everything appended so far has been committed
+        """
+        with self.lock:
+            ticket = self.appended
+        self.wait_for(ticket)
+
+    def commit_loop(self):
+        """
+        Runs on the writer thread. Sleeps until there is something to write,
+        then commits everything pending as one batch. If writing fails the
+        error is kept and everyone waiting (now or later) gets it raised.
+        """
+        try:
+            self.run_commits()
+        except Exception as e:
+            print_error(f"Log writer for {self.filename} failed: {e}")
+            with self.lock:
+                self.error = e
+                self.alive = False
+                self.pending = []
+                self.has_committed.notify_all()
+
+    def run_commits(self):
+        while True:
+            with self.lock:
+                while not self.pending and self.alive:
+                    if self.dirty and self.durability == consts.DURABILITY_PERIODIC:
+                        # Make sure the last commit is synced even if no
+                        # more appends ever show up
+                        remaining = self.fsync_interval - \
+                            (time.time() - self.last_fsync)
+                        if remaining <= 0:
+                            break
+                        self.has_pending.wait(remaining)
+                    else:
+                        self.has_pending.wait()
+                if not self.pending and not self.alive:
+                    break
+            if self.pending and self.batch_window > 0:
+                time.sleep(self.batch_window)
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+            self.commit(batch)
+        self.sync()
+
+    def commit(self, batch: List[bytes]):
+        """
+        Writes one batch to the file and releases everyone waiting on it
+        """
+        if batch:
+            # Where the file ends rather than tell(), which lags behind if
+            # the log was emptied from outside (see SegmentedLog.reset)
+            start = self.file.seek(0, os.SEEK_END)
+            self.file.write(b"".join(batch))
+            self.file.flush()
+            self.dirty = True
+            if self.index is not None:
+                offsets = []
+                for record in batch:
+                    offsets.append(start)
+                    start += len(record)
+                self.index.append(offsets, start)
+                if self.index.is_full():
+                    # Seal the active segment and continue in a fresh one
+                    self.sync()
+                    self.file.close()
+                    self.index.rotate()
+                    self.file = open(self.filename, "ab")
+        if self.durability == consts.DURABILITY_FSYNC:
+            self.sync()
+        elif self.durability == consts.DURABILITY_PERIODIC:
+            if time.time() - self.last_fsync >= self.fsync_interval:
+                self.sync()
+        if not batch:
+            return
+        with self.lock:
+            self.committed += len(batch)
+            self.commit_sizes.append(len(batch))
+            self.has_committed.notify_all()
+        if self.on_commit:
+            self.on_commit(len(batch))
+
+    def sync(self):
+        """
+        Forces whatever has been written down to disk
+        """
+        if not self.dirty:
+            return
+        os.fsync(self.file.fileno())
+        self.dirty = False
+        self.last_fsync = time.time()
+
+    def stats(self):
+        """
+        Summary of recent group commits, handy for tuning BATCH_WINDOW
+        """
+        with self.lock:
+            sizes = list(self.commit_sizes)
+            committed = self.committed
+        return {
+            "records": committed,
+            "commits": len(sizes),
+            "mean_batch": sum(sizes) / len(sizes) if sizes else 0,
+            "max_batch": max(sizes) if sizes else 0,
+        }
+
+    def close(self):
+        """
+        Commits whatever is pending, syncs, and closes the file
+        """
+        with self.lock:
+            if not self.alive and self.error is None:
+                return
+            self.alive = False
+            self.has_pending.notify()
+        self.commit_thread.join()
+        try:
+            self.file.close()
+        except Exception:
+            # Already reported by the writer thread
+            pass
@@ -0,0 +1,117 @@
+"""
+Offline converter from the old text logs (one Request.marshal() per line)
+to the binary record format in persistence/records.py. Run it with the
+servers stopped:
+
+    python3 -m persistence.migrate [logs/A_log.out ...]
+
+With no arguments every logs/*_log.out is converted. Logs that are already
+binary are left alone. Also reports how fast each log replays (reading and
+decoding every record) before and after conversion.
+"""
+import gc
+import os
+import sys
+import glob
+import time
+import connections.schema as conn_schema
+import persistence.records as records
+from utils import print_error, print_info, print_success
+
+
+def is_binary(filename: str):
+    with open(filename, "rb") as file:
+        head = file.read(records.FILE_HEADER.size)
+    try:
+        records.check_header(head, filename)
+        return True
+    except Exception:
+        return False
+
+
+def replay_text(filename: str):
+    """
+    Reads and decodes a text log the way rehydrate used to
+    """
+    with open(filename, "r") as file:
+        return [conn_schema.Request.unmarshal(l[:-1]) for l in file.readlines()]
+
+
+def replay_binary(filename: str):
+    """
+    Reads and decodes a binary log the way rehydrate does now
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    return records.decode_all(data, records.FILE_HEADER.size)
+
+
+def timed(replay, filename: str, runs=3):
+    """
+    Returns (requests, records per second) for the best of a few replays of
+    a log. The garbage collector is paused while timing so that whatever
+    else is alive in the process doesn't skew the comparison.
+    """
+    best = None
+    for _ in range(runs):
+        reqs = None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            reqs = replay(filename)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return (reqs, len(reqs) / best if best > 0 else float("inf"))
+
+
+def convert(filename: str) -> bool:
+    """
+    Rewrites one text log as a binary log, atomically. The binary log is
+    written next to it and replayed, and only replaces the text log if it
+    holds the same requests, so a failed conversion leaves the text log as
+    it was. Any sidecar index is removed so it gets rebuilt against the new
+    file. Returns whether the log is binary now.
+    """
+    if is_binary(filename):
+        print_info(f"{filename} is already binary, skipping")
+        return True
+    (reqs, text_rate) = timed(replay_text, filename)
+    converted_name = filename + ".tmp"
+    try:
+        with open(converted_name, "wb") as file:
+            file.write(records.file_header())
+            for req in reqs:
+                file.write(records.encode(req))
+            file.flush()
+            os.fsync(file.fileno())
+        (converted, binary_rate) = timed(replay_binary, converted_name)
+        survived = [r.marshal() for r in converted] == [r.marshal() for r in reqs]
+    except Exception as e:
+        print_error(f"Failed to convert {filename}: {e}")
+        survived = False
+    if not survived:
+        if os.path.exists(converted_name):
+            os.remove(converted_name)
+        print_error(f"{filename} did not survive conversion, left as it was")
+        return False
+    os.replace(converted_name, filename)
+    if os.path.exists(filename + ".idx"):
+        os.remove(filename + ".idx")
+    print_success(f"Converted {filename} ({len(reqs)} records)")
+    print_info(
+        f"Replay: {text_rate:,.0f} records/s as text, {binary_rate:,.0f} records/s as binary")
+    return True
+
+
+def main(filenames):
+    if not filenames:
+        filenames = sorted(glob.glob("logs/*_log.out"))
+    for filename in filenames:
+        convert(filename)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
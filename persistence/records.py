@@ -0,0 +1,216 @@
+import zlib
+import struct
+import connections.schema as conn_schema
+from persistence.errors import LogFormatException
+
+# Every log file starts with a header: magic, format version, reserved
+FILE_HEADER = struct.Struct(">4sHH")
+MAGIC = b"CLOG"
+VERSION = 1
+
+# Every record is: body length, crc32 of the body, then the body which is
+# the type tag, the length (in characters) of every field but the last, and
+# then all of the fields as one utf-8 string
+RECORD_HEADER = struct.Struct(">II")
+TAG_SIZE = 1
+
+# Compact tags for request types, these must never be renumbered
+TYPE_TAGS = {
+    "create": 1,
+    "send": 2,
+    "delete": 3,
+    "notif": 4,
+    "login": 5,
+    "list": 6,
+    "logs": 7,
+    "fallover": 8,
+    # A send that compaction found was later delivered (its notif is gone)
+    "delivered": 9,
+    # A notif delivering several chats at once
+    "notifs": 10,
+    "watermark": 11,
+}
+
+# For every request type, the attributes that make up its payload
+FIELDS = {
+    "create": ["user_id"],
+    "send": ["user_id", "recipient_id", "text"],
+    "delete": ["user_id"],
+    "notif": ["user_id"],
+    "login": ["user_id"],
+    "list": ["user_id", "wildcard", "page"],
+    "logs": ["user_id", "wildcard", "page"],
+    "fallover": ["user_id"],
+    "delivered": ["user_id", "recipient_id", "text"],
+    "notifs": ["user_id", "count"],
+    "watermark": ["user_id", "watermark"],
+}
+
+# For every tag, the struct holding the tag and the field lengths
+FIELD_HEADERS = {
+    TYPE_TAGS[req_type]: struct.Struct(">B" + "H" * (len(fields) - 1))
+    for (req_type, fields) in FIELDS.items()
+}
+
+
+# The two lengths in front of the fields of send and paged records
+TWO_LENGTHS = struct.Struct(">HH")
+# The length in front of the fields of notifs and watermark records
+ONE_LENGTH = struct.Struct(">H")
+# Longest field (in characters) that can go anywhere but last in a record
+MAX_FIELD_LENGTH = 2 ** 16 - 1
+
+
+# Decoders take the buffer and the bounds of one record body (starting at
+# its tag). They unpack the lengths in place and decode the fields with a
+# single utf-8 decode straight out of the buffer.
+
+def send_decoder(delivered: bool):
+    """
+    Decoder for send records, and for the sends compaction found delivered
+    """
+    def decoder(data, start, end, unpack_from=TWO_LENGTHS.unpack_from):
+        (a, b) = unpack_from(data, start + TAG_SIZE)
+        text = data[start + TAG_SIZE + TWO_LENGTHS.size:end].decode()
+        b += a
+        return conn_schema.SendRequest(text[:a], text[a:b], text[b:], delivered)
+    return decoder
+
+
+def decode_paged(data, start, end, request_class):
+    (a, b) = TWO_LENGTHS.unpack_from(data, start + TAG_SIZE)
+    text = data[start + TAG_SIZE + TWO_LENGTHS.size:end].decode()
+    b += a
+    return request_class(text[:a], text[a:b], int(text[b:]))
+
+
+def decode_notifs(data, start, end, unpack_from=ONE_LENGTH.unpack_from):
+    (a,) = unpack_from(data, start + TAG_SIZE)
+    text = data[start + TAG_SIZE + ONE_LENGTH.size:end].decode()
+    return conn_schema.NotifRequest(text[:a], int(text[a:]))
+
+
+def decode_watermark(data, start, end, unpack_from=ONE_LENGTH.unpack_from):
+    (a,) = unpack_from(data, start + TAG_SIZE)
+    text = data[start + TAG_SIZE + ONE_LENGTH.size:end].decode()
+    return conn_schema.WatermarkRequest(text[:a], int(text[a:]))
+
+
+def user_only(request_class):
+    """
+    Decoder for the records whose only field is the user_id
+    """
+    def decoder(data, start, end):
+        return request_class(data[start + TAG_SIZE:end].decode())
+    return decoder
+
+
+# Dispatch table from tag to the function building the request
+DECODERS = {
+    TYPE_TAGS["create"]: user_only(conn_schema.CreateRequest),
+    TYPE_TAGS["send"]: send_decoder(False),
+    TYPE_TAGS["delete"]: user_only(conn_schema.DeleteRequest),
+    TYPE_TAGS["notif"]: user_only(conn_schema.NotifRequest),
+    TYPE_TAGS["login"]: user_only(conn_schema.LoginRequest),
+    TYPE_TAGS["list"]: lambda data, start, end: decode_paged(data, start, end, conn_schema.ListRequest),
+    TYPE_TAGS["logs"]: lambda data, start, end: decode_paged(data, start, end, conn_schema.LogsRequest),
+    TYPE_TAGS["fallover"]: user_only(conn_schema.FalloverRequest),
+    TYPE_TAGS["delivered"]: send_decoder(True),
+    TYPE_TAGS["notifs"]: decode_notifs,
+    TYPE_TAGS["watermark"]: decode_watermark,
+}
+
+
+def file_header() -> bytes:
+    return FILE_HEADER.pack(MAGIC, VERSION, 0)
+
+
+def check_header(data: bytes, filename: str):
+    """
+    Makes sure data starts with a header this version can read
+    """
+    if len(data) < FILE_HEADER.size:
+        raise LogFormatException(filename)
+    (magic, version, _) = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise LogFormatException(filename)
+
+
+def encode(req: conn_schema.Request) -> bytes:
+    """
+    Turns a request into one complete log record
+    """
+    record_type = req.type
+    if record_type == "send" and req.delivered:
+        record_type = "delivered"
+    elif record_type == "notif" and req.count != 1:
+        record_type = "notifs"
+    tag = TYPE_TAGS[record_type]
+    fields = [str(getattr(req, name)) for name in FIELDS[record_type]]
+    for field in fields[:-1]:
+        if len(field) > MAX_FIELD_LENGTH:
+            raise ValueError(
+                f"Field of {len(field)} characters is too long to log")
+    body = FIELD_HEADERS[tag].pack(
+        tag, *[len(f) for f in fields[:-1]]) + "".join(fields).encode()
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode(data: bytes, start: int, end: int) -> conn_schema.Request:
+    """
+    Turns the body of a (checked) record back into a request
+    """
+    return DECODERS[data[start]](data, start, end)
+
+
+def scan(data: bytes, pos: int):
+    """
+    Walks the records in data starting at pos, yielding (offset, end) for
+    each one, where the body is data[offset + RECORD_HEADER.size:end].
+    Stops quietly at the first record that is incomplete or fails its
+    checksum (a torn tail), so the end of the last yielded record is where
+    the valid log ends.
+    """
+    view = memoryview(data)
+    unpack_from = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    size = len(data)
+    while pos + header_size <= size:
+        (length, crc) = unpack_from(data, pos)
+        start = pos + header_size
+        end = start + length
+        if length < TAG_SIZE or end > size:
+            return
+        if zlib.crc32(view[start:end]) != crc or data[start] not in DECODERS:
+            return
+        yield (pos, end)
+        pos = end
+
+
+def decode_all(data: bytes, pos: int):
+    """
+    Decodes every valid record in data starting at pos. Same walk as scan,
+    inlined since this is what replay spends its time in: checksums run on
+    memoryview slices and the decoders read straight out of data, so no
+    record body is copied before its fields are decoded.
+    """
+    reqs = []
+    append = reqs.append
+    unpack_from = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    crc32 = zlib.crc32
+    get_decoder = DECODERS.get
+    view = memoryview(data)
+    size = len(data)
+    while pos + header_size <= size:
+        (length, crc) = unpack_from(data, pos)
+        start = pos + header_size
+        end = start + length
+        if end > size or length < TAG_SIZE or crc32(view[start:end]) != crc:
+            break
+        decoder = get_decoder(data[start])
+        if decoder is None:
+            break
+        append(decoder(data, start, end))
+        pos = end
+    return reqs
@@ -0,0 +1,421 @@
+import os
+import json
+import threading
+from collections import deque
+from typing import List, Mapping
+import persistence.consts as consts
+import persistence.records as records
+from connections.schema import Request, SendRequest, WatermarkRequest
+from persistence.errors import CompactedRangeException
+from persistence.log_index import LogIndex
+from utils import print_info
+
+
+class Segment:
+    """
+    A sealed (full, never written again) piece of the log. Holds the
+    records with progress >= base and progress < base + count. A compacted
+    segment covers the same progress range but holds fewer records, so it
+    can only be replayed as a whole, from an empty state.
+    """
+
+    def __init__(self, base: int, count: int, filename: str, compacted=False) -> None:
+        self.base = base
+        self.count = count
+        self.filename = filename
+        self.compacted = compacted
+        self.index = None  # Opened lazily, most segments are never read
+
+    def end(self):
+        return self.base + self.count
+
+    def get_index(self):
+        if self.index is None:
+            self.index = LogIndex(self.filename)
+        return self.index
+
+    def marshal(self):
+        return {
+            "base": self.base,
+            "count": self.count,
+            "file": os.path.basename(self.filename),
+            "compacted": self.compacted,
+        }
+
+    @staticmethod
+    def unmarshal(raw, directory: str):
+        return Segment(raw["base"], raw["count"], os.path.join(directory, raw["file"]), raw["compacted"])
+
+
+class SegmentedLog:
+    """
+    A machine's log, split into fixed size segments. New records always go
+    to the active segment (the log file itself, e.g. logs/A_log.out). Once
+    it grows past SEGMENT_SIZE it is sealed: renamed to
+    logs/A_log.out.<base>.seg and recorded in logs/A_log.out.manifest.
+    Every segment is a complete binary log with its own offset index, so
+    reads only touch the segments they need.
+    Behaves like a LogIndex towards the log writer.
+    """
+
+    def __init__(self, log_filename: str, segment_size=consts.SEGMENT_SIZE) -> None:
+        self.log_filename = log_filename
+        self.directory = os.path.dirname(log_filename) or "."
+        self.manifest_filename = log_filename + ".manifest"
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+        self.sealed: List[Segment] = []  # Compacted segments first, then plain ones
+        # user_id -> sends to that user in the compacted segments that were
+        # still undelivered at the horizon. Carried from one compaction to
+        # the next so old compacted segments never need to be re-read.
+        self.pending: Mapping[str, int] = {}
+        # user_id -> that user's delivery watermark at the horizon, also
+        # carried over (see compact_requests)
+        self.delivered: Mapping[str, int] = {}
+        self.load_manifest()
+        self.adopt_orphans()
+        self.active = LogIndex(log_filename)
+        self.active_base = self.sealed[-1].end() if self.sealed else 0
+
+    def get_segment_filename(self, base: int, compacted=False):
+        kind = "compacted" if compacted else "seg"
+        return f"{self.log_filename}.{base}.{kind}"
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_filename):
+            return
+        with open(self.manifest_filename, "r") as file:
+            raw = json.load(file)
+        self.sealed = [Segment.unmarshal(s, self.directory)
+                       for s in raw["segments"]]
+        self.pending = raw.get("pending", {})
+        if "delivered" in raw:
+            self.delivered = raw["delivered"]
+        elif any(s.compacted for s in self.sealed):
+            # Written before watermarks were carried, work them out once
+            reqs = []
+            for segment in self.sealed:
+                if segment.compacted:
+                    with open(segment.filename, "rb") as file:
+                        reqs += records.decode_all(file.read(), records.FILE_HEADER.size)
+            (_, _, self.delivered) = compact_requests(reqs)
+
+    def write_manifest(self):
+        with open(self.manifest_filename + ".tmp", "w") as file:
+            json.dump({"segments": [s.marshal() for s in self.sealed],
+                       "pending": self.pending, "delivered": self.delivered}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.manifest_filename + ".tmp", self.manifest_filename)
+
+    def adopt_orphans(self):
+        """
+        A crash right after sealing a segment can leave it renamed but not
+        yet in the manifest. Picks any such segment back up.
+        """
+        while True:
+            base = self.sealed[-1].end() if self.sealed else 0
+            filename = self.get_segment_filename(base)
+            if not os.path.exists(filename):
+                return
+            index = LogIndex(filename)
+            segment = Segment(base, index.count(), filename)
+            segment.index = index
+            self.sealed.append(segment)
+            self.write_manifest()
+
+    def count(self) -> int:
+        """
+        The progress of the log, i.e. how many records it has (or had,
+        counting those that were compacted away)
+        """
+        with self.lock:
+            return self.active_base + self.active.count()
+
+    def horizon(self) -> int:
+        """
+        Progress before which the log has been compacted
+        """
+        with self.lock:
+            horizon = 0
+            for segment in self.sealed:
+                if segment.compacted:
+                    horizon = segment.end()
+            return horizon
+
+    def read(self, start_progress: int, end_progress: int, allow_compacted=False) -> List[Request]:
+        """
+        Returns the records with progress >= start_progress and
+        progress < end_progress, reading only the segments that hold them.
+        Reads starting inside the compacted part of the log are refused,
+        unless allow_compacted is set and the read starts at 0 (a replay
+        from scratch), in which case the compacted records are returned.
+        """
+        with self.lock:
+            horizon = self.horizon()
+            if start_progress < horizon and not (allow_compacted and start_progress == 0):
+                raise CompactedRangeException(start_progress, horizon)
+            reqs = []
+            for segment in self.sealed:
+                if segment.end() <= start_progress or segment.base >= end_progress:
+                    continue
+                if segment.compacted:
+                    with open(segment.filename, "rb") as file:
+                        data = file.read()
+                    reqs += records.decode_all(data, records.FILE_HEADER.size)
+                    continue
+                reqs += segment.get_index().read(
+                    max(start_progress - segment.base, 0), end_progress - segment.base)
+            if end_progress > self.active_base:
+                reqs += self.active.read(
+                    max(start_progress - self.active_base, 0), end_progress - self.active_base)
+            return reqs
+
+    def append(self, offsets: List[int], end: int):
+        """
+        Records the offsets of a batch just committed to the active segment
+        """
+        self.active.append(offsets, end)
+
+    def is_full(self):
+        return self.active.end >= self.segment_size
+
+    def rotate(self):
+        """
+        Seals the active segment and starts a new one. The caller (the log
+        writer) must have closed its handle on the active segment first.
+        """
+        with self.lock:
+            count = self.active.count()
+            filename = self.get_segment_filename(self.active_base)
+            self.active.close()
+            os.replace(self.active.filename, filename + ".idx")
+            os.replace(self.log_filename, filename)
+            self.sealed.append(Segment(self.active_base, count, filename))
+            self.write_manifest()
+            self.active = LogIndex(self.log_filename)
+            self.active_base += count
+
+    def compact(self, horizon: int):
+        """
+        Compacts the plain sealed segments that end at or before horizon
+        (the progress of the newest snapshot), keeping the newest
+        SEGMENT_RETAIN sealed segments as they are. Only the newly eligible
+        segments are read: they are folded against the state carried over
+        from earlier compactions, and the result either becomes a new
+        compacted segment or, while the newest compacted segment is still
+        small, is appended to it. So the cost of a compaction is bounded by
+        SEGMENT_SIZE, not by how long the log has been around.
+        Only ever called from one thread at a time.
+        """
+        with self.lock:
+            compacted = [s for s in self.sealed if s.compacted]
+            candidates = []
+            for segment in self.sealed[len(compacted):max(len(self.sealed) - consts.SEGMENT_RETAIN, 0)]:
+                if segment.end() > horizon:
+                    break
+                candidates.append(segment)
+            if not candidates:
+                return False
+            previous = compacted[-1] if compacted else None
+            pending = dict(self.pending)
+            delivered = dict(self.delivered)
+        # Sealed segments never change, so the rewrite can happen unlocked
+        reqs = []
+        for segment in candidates:
+            with open(segment.filename, "rb") as file:
+                data = file.read()
+            reqs += records.decode_all(data, records.FILE_HEADER.size)
+        (kept, pending, delivered) = compact_requests(reqs, pending, delivered)
+        body = b"".join(records.encode(req) for req in kept)
+        replaced = list(candidates)
+        base = candidates[0].base
+        if previous is not None and os.path.getsize(previous.filename) + len(body) <= self.segment_size:
+            # Grow the newest compacted segment instead of starting another
+            with open(previous.filename, "rb") as file:
+                body = file.read()[records.FILE_HEADER.size:] + body
+            replaced.insert(0, previous)
+            base = previous.base
+        end = candidates[-1].end()
+        filename = self.get_segment_filename(end, compacted=True)
+        with open(filename + ".tmp", "wb") as file:
+            file.write(records.file_header())
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(filename + ".tmp", filename)
+        with self.lock:
+            first = self.sealed.index(replaced[0])
+            self.sealed = self.sealed[:first] + [Segment(base, end - base, filename, compacted=True)] + \
+                self.sealed[first + len(replaced):]
+            self.pending = pending
+            self.delivered = delivered
+            self.write_manifest()
+        for segment in replaced:
+            if segment.index is not None:
+                segment.index.close()
+            for old in [segment.filename, segment.filename + ".idx"]:
+                if os.path.exists(old) and old != filename:
+                    os.remove(old)
+        print_info(
+            f"Compacted {len(reqs)} records before {end} down to {len(kept)}")
+        return True
+
+    def prefix(self):
+        """
+        Returns (horizon, records, pending): everything in the compacted
+        segments as one run of records, and the carried over state. This is
+        what a machine with an empty log needs to take on this log's
+        compacted part (see install_prefix).
+        """
+        with self.lock:
+            parts = []
+            for segment in self.sealed:
+                if segment.compacted:
+                    with open(segment.filename, "rb") as file:
+                        parts.append(file.read()[records.FILE_HEADER.size:])
+            return (self.horizon(), b"".join(parts), dict(self.pending))
+
+    def install_prefix(self, data: bytes, horizon: int, pending: Mapping[str, int]):
+        """
+        Makes the records of another machine's compacted prefix (see prefix)
+        this log's compacted part, covering progress 0 to horizon. Only
+        allowed while this log is empty.
+        """
+        with self.lock:
+            if self.count() != 0:
+                raise ValueError("Can only install a prefix into an empty log")
+            filename = self.get_segment_filename(horizon, compacted=True)
+            with open(filename + ".tmp", "wb") as file:
+                file.write(records.file_header())
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(filename + ".tmp", filename)
+            self.sealed = [Segment(0, horizon, filename, compacted=True)]
+            self.pending = dict(pending)
+            # The records are the whole history up to horizon, so the
+            # watermarks can be worked out from them
+            (_, _, self.delivered) = compact_requests(records.decode_all(data, 0))
+            self.write_manifest()
+            self.active_base = horizon
+
+    def reset(self):
+        """
+        Throws away every record, leaving an empty log. For a machine about
+        to take on another machine's state wholesale (see install_prefix).
+        The log writer must have nothing pending.
+        """
+        with self.lock:
+            for segment in self.sealed:
+                if segment.index is not None:
+                    segment.index.close()
+                for old in [segment.filename, segment.filename + ".idx"]:
+                    if os.path.exists(old):
+                        os.remove(old)
+            self.sealed = []
+            self.pending = {}
+            self.delivered = {}
+            self.write_manifest()
+            self.active.clear()
+            self.active_base = 0
+
+    def close(self):
+        with self.lock:
+            for segment in self.sealed:
+                if segment.index is not None:
+                    segment.index.close()
+            self.active.close()
+
+
+def compact_requests(reqs: List[Request], pending: Mapping[str, int] = None, delivered: Mapping[str, int] = None):
+    """
+    Drops records that no longer matter to a replay from scratch. reqs
+    directly follow the already compacted part of the log, and pending and
+    delivered are the state carried over from it (user_id -> sends to them
+    that are still undelivered there, and user_id -> their delivery
+    watermark there). Returns (kept, pending, delivered) for the next
+    compaction.
+    - Everything about a user that was later deleted (their create, the
+      sends they received, their deliveries, the delete itself). Sends they
+      wrote to others stay, those messages still exist. If the user was
+      created in the compacted part the delete is kept, since their create
+      is already out of reach.
+    - Deliveries (notifs and watermarks), which are folded into the sends
+      they delivered (marking them as delivered so a replay doesn't queue
+      them). If any of a user's deliveries reached sends from the compacted
+      part, which can't be marked anymore, their last delivery is kept as
+      a watermark.
+    Replaying the compacted part and then the result from an empty state
+    gives the same state as replaying the compacted part and then reqs.
+    """
+    pending = dict(pending or {})
+    delivered = dict(delivered or {})
+    dropped = [False] * len(reqs)
+    marked = [False] * len(reqs)  # Sends that were later delivered
+    created = set()  # Users created in reqs
+    about: Mapping[str, List[int]] = {}  # user_id -> records to drop on delete
+    queued: Mapping[str, deque] = {}  # user_id -> undelivered sends in reqs, oldest first
+    last = {}  # user_id -> (index, watermark) of their last delivery in reqs
+    reached = set()  # Users with deliveries of sends from the compacted part
+    for (ix, req) in enumerate(reqs):
+        if req.type == "create":
+            created.add(req.user_id)
+            about[req.user_id] = [ix]
+            queued[req.user_id] = deque()
+            pending.pop(req.user_id, None)
+            delivered[req.user_id] = 0
+            last.pop(req.user_id, None)
+            reached.discard(req.user_id)
+        elif req.type == "send":
+            about.setdefault(req.recipient_id, []).append(ix)
+            if not req.delivered:
+                queued.setdefault(req.recipient_id, deque()).append(ix)
+            else:
+                delivered[req.recipient_id] = delivered.get(req.recipient_id, 0) + 1
+        elif req.type in ["notif", "watermark"]:
+            user_id = req.user_id
+            dropped[ix] = True
+            if req.type == "notif":
+                count = req.count
+            else:
+                count = req.watermark - delivered.get(user_id, 0)
+            # Delivers sends from the compacted part first, oldest first
+            old = min(pending.get(user_id, 0), max(count, 0))
+            if old > 0:
+                pending[user_id] -= old
+                reached.add(user_id)
+            new = 0
+            while new < count - old and queued.get(user_id):
+                marked[queued[user_id].popleft()] = True
+                new += 1
+            delivered[user_id] = delivered.get(user_id, 0) + old + new
+            last[user_id] = (ix, delivered[user_id])
+        elif req.type == "delete":
+            for about_ix in about.pop(req.user_id, []):
+                dropped[about_ix] = True
+            queued.pop(req.user_id, None)
+            pending.pop(req.user_id, None)
+            delivered.pop(req.user_id, None)
+            last.pop(req.user_id, None)
+            reached.discard(req.user_id)
+            if req.user_id in created:
+                created.discard(req.user_id)
+                dropped[ix] = True
+    watermarks = {}  # Index of a kept delivery -> the watermark it is kept as
+    for user_id in reached:
+        (ix, watermark) = last[user_id]
+        dropped[ix] = False
+        watermarks[ix] = WatermarkRequest(user_id, watermark)
+    for (user_id, sends) in queued.items():
+        if sends:
+            pending[user_id] = pending.get(user_id, 0) + len(sends)
+    kept = []
+    for (ix, req) in enumerate(reqs):
+        if dropped[ix]:
+            continue
+        if marked[ix]:
+            req = SendRequest(req.user_id, req.recipient_id, req.text, True)
+        kept.append(watermarks.get(ix, req))
+    return (kept, {user_id: count for (user_id, count) in pending.items() if count > 0},
+            {user_id: count for (user_id, count) in delivered.items() if count > 0})
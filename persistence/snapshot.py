@@ -0,0 +1,267 @@
+import os
+import json
+import zlib
+import threading
+from threading import Thread
+from typing import List, Mapping
+from schema import Account, Chat
+from history import MessageLog
+from connections.schema import Request, CreateRequest, SendRequest
+import persistence.consts as consts
+
+
+class SnapshotState:
+    """
+    A consistent copy of a server's state at a given log progress. Taking
+    one is O(users): it only records, for every user, their message log and
+    how long it was. Message logs are append-only, so the writer thread can
+    slice out exactly the messages that existed at that progress later, off
+    the request loop.
+    """
+
+    def __init__(self, progress: int, users: Mapping[str, Account], pending: Mapping[str, int]) -> None:
+        # Number of log records this state covers
+        self.progress = progress
+        # user_id -> (that user's live message log, its length at capture)
+        self.sources = {
+            user_id: (account.msg_log, len(account.msg_log)) for (user_id, account) in users.items()
+        }
+        self.msg_logs = None  # user_id -> message log (newest first), see materialize
+        # user_id -> how many of the newest messages are still undelivered
+        self.pending = dict(pending)
+
+    def materialize(self):
+        """
+        Copies out the messages this state covers. Safe to run while the
+        request loop keeps appending to the live message logs.
+        """
+        if self.msg_logs is None:
+            self.msg_logs = {
+                user_id: msg_log.oldest(length)[::-1]
+                for (user_id, (msg_log, length)) in self.sources.items()
+            }
+            self.sources = {}
+        return self.msg_logs
+
+    def marshal(self):
+        return json.dumps({
+            "progress": self.progress,
+            "users": {
+                user_id: [[c.author_id, c.recipient_id, c.text] for c in msgs]
+                for (user_id, msgs) in self.materialize().items()
+            },
+            "pending": self.pending,
+        })
+
+    @staticmethod
+    def unmarshal(rep):
+        raw = json.loads(rep)
+        state = SnapshotState(raw["progress"], {}, raw["pending"])
+        state.msg_logs = {
+            user_id: [Chat(*parts) for parts in msgs]
+            for (user_id, msgs) in raw["users"].items()
+        }
+        return state
+
+    def users(self) -> Mapping[str, Account]:
+        """
+        Rebuilds the accounts this state was taken from
+        """
+        users = {}
+        for (user_id, msgs) in self.materialize().items():
+            account = Account(user_id)
+            account.msg_log = MessageLog(user_id, reversed(msgs))
+            users[user_id] = account
+        return users
+
+    def undelivered(self, user_id) -> List[Chat]:
+        """
+        The undelivered chats for a user, oldest first (i.e. queue order)
+        """
+        count = self.pending.get(user_id, 0)
+        return list(reversed(self.materialize()[user_id][:count]))
+
+    def requests(self) -> List[Request]:
+        """
+        Requests that rebuild this state when replayed from scratch: every
+        user's create, then the sends of their messages oldest first, with
+        all but the undelivered ones marked as delivered. This is a log
+        with the same state as the one the snapshot was taken from.
+        """
+        msg_logs = self.materialize()
+        reqs: List[Request] = [CreateRequest(user_id) for user_id in msg_logs]
+        for (user_id, msgs) in msg_logs.items():
+            undelivered = self.pending.get(user_id, 0)
+            for (ix, chat) in zip(range(len(msgs) - 1, -1, -1), reversed(msgs)):
+                reqs.append(SendRequest(chat.author_id, chat.recipient_id, chat.text, ix >= undelivered))
+        return reqs
+
+
+def compress_state(rep: str) -> bytes:
+    """
+    Packs a marshalled snapshot for sending to another machine
+    """
+    return zlib.compress(rep.encode(), consts.SNAPSHOT_COMPRESSION)
+
+
+def decompress_state(data: bytes) -> SnapshotState:
+    return SnapshotState.unmarshal(zlib.decompress(data).decode())
+
+
+class Snapshotter:
+    """
+    Takes periodic snapshots of a server's state so that rehydrating only
+    has to replay the part of the log written after the newest one.
+    Also keeps track of how many messages are undelivered per user (and so
+    each user's delivery watermark), in log order, so that snapshots agree
+    exactly with the log progress they claim.
+    """
+
+    def __init__(self, name: str, directory="logs", interval=consts.SNAPSHOT_INTERVAL, on_written=None) -> None:
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.pending: Mapping[str, int] = {}  # user_id -> undelivered count
+        self.delivered: Mapping[str, int] = {}  # user_id -> delivery watermark
+        self.last_progress = 0  # Progress covered by the newest snapshot
+        self.writing = False  # Is a snapshot being written right now?
+        self.lock = threading.Lock()
+        # Called (on the writer thread) with the progress of every snapshot
+        # once it is safely on disk
+        self.on_written = on_written
+
+    def get_filename(self, progress: int):
+        return f"{self.directory}/{self.name}_{progress}.snap"
+
+    def list_snapshots(self):
+        """
+        Returns (progress, filename) for every snapshot on disk, newest first
+        """
+        prefix = f"{self.name}_"
+        found = []
+        for entry in os.listdir(self.directory):
+            if not entry.startswith(prefix) or not entry.endswith(".snap"):
+                continue
+            try:
+                progress = int(entry[len(prefix):-len(".snap")])
+            except ValueError:
+                continue
+            found.append((progress, f"{self.directory}/{entry}"))
+        return sorted(found, reverse=True)
+
+    def track(self, req):
+        """
+        Must be called for every request as it is logged (in log order)
+        """
+        if req.type == "create":
+            self.pending[req.user_id] = 0
+            self.delivered[req.user_id] = 0
+        elif req.type == "delete":
+            self.pending.pop(req.user_id, None)
+            self.delivered.pop(req.user_id, None)
+        elif req.type == "send" and not req.delivered:
+            self.pending[req.recipient_id] = self.pending.get(
+                req.recipient_id, 0) + 1
+        elif req.type == "send":
+            self.delivered[req.recipient_id] = self.delivered.get(
+                req.recipient_id, 0) + 1
+        elif req.type == "notif":
+            self.deliver(req.user_id, req.count)
+        elif req.type == "watermark":
+            self.deliver(req.user_id, req.watermark - self.delivered.get(req.user_id, 0))
+
+    def deliver(self, user_id: str, count: int):
+        count = min(max(count, 0), self.pending.get(user_id, 0))
+        self.pending[user_id] = self.pending.get(user_id, 0) - count
+        self.delivered[user_id] = self.delivered.get(user_id, 0) + count
+
+    def is_due(self, progress: int):
+        return progress - self.last_progress >= self.interval and not self.writing
+
+    def capture(self, progress: int, users: Mapping[str, Account]):
+        """
+        Takes a snapshot of the given state. Must be called while nothing
+        can change users or the log (i.e. between requests).
+        """
+        return SnapshotState(progress, users, self.pending)
+
+    def write_async(self, state: SnapshotState):
+        """
+        Writes a snapshot in the background. If a snapshot is still being
+        written this one is dropped, the next one will cover it anyway.
+        """
+        with self.lock:
+            if self.writing:
+                return False
+            self.writing = True
+            self.last_progress = state.progress
+        writer = Thread(target=self.write, args=(state,), daemon=True)
+        writer.start()
+        return True
+
+    def write(self, state: SnapshotState):
+        """
+        Writes a snapshot to disk atomically, then prunes old ones
+        """
+        try:
+            filename = self.get_filename(state.progress)
+            with open(filename + ".tmp", "w") as file:
+                file.write(state.marshal())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(filename + ".tmp", filename)
+            self.last_progress = state.progress
+            for (_, old) in self.list_snapshots()[consts.SNAPSHOT_RETAIN:]:
+                os.remove(old)
+            if self.on_written:
+                self.on_written(state.progress)
+        finally:
+            with self.lock:
+                self.writing = False
+
+    def read_latest(self, max_progress: int, min_progress=0):
+        """
+        Returns (progress, marshalled state) for the newest readable
+        snapshot that does not claim more progress than max_progress (the
+        size of the log it'll be paired with), nor less than min_progress
+        (where the log can be replayed from). None if there is no such
+        snapshot.
+        """
+        for (progress, filename) in self.list_snapshots():
+            if progress > max_progress or progress < min_progress:
+                continue
+            try:
+                with open(filename, "r") as file:
+                    return (progress, file.read())
+            except Exception:
+                continue
+        return None
+
+    def load_latest(self, max_progress: int, min_progress=0):
+        """
+        Loads the newest snapshot that fits (see read_latest) and takes on
+        its undelivered counts. Returns None if there is no such snapshot.
+        """
+        for (progress, filename) in self.list_snapshots():
+            if progress > max_progress or progress < min_progress:
+                continue
+            try:
+                with open(filename, "r") as file:
+                    state = SnapshotState.unmarshal(file.read())
+            except Exception:
+                continue
+            self.take_on(state)
+            return state
+        return None
+
+    def take_on(self, state: SnapshotState):
+        """
+        Continues tracking from the given state, e.g. after installing one
+        that was sent by another machine
+        """
+        self.pending = dict(state.pending)
+        self.delivered = {
+            user_id: len(msgs) - state.pending.get(user_id, 0)
+            for (user_id, msgs) in state.materialize().items()
+        }
+        self.last_progress = state.progress
@@ -1,12 +1,15 @@
+import history
+
 
 class Account:
     """
     A class for users
     """
+    __slots__ = ("user_id", "msg_log")
 
     def __init__(self, user_id):
         self.user_id = user_id
-        self.msg_log = []
+        self.msg_log = history.MessageLog(user_id)
 
     def marshal(self):
         return f"{self.user_id}"
@@ -20,6 +23,7 @@ class Chat:
     """
     A class for chats sent from user -> user (NOT TO BE CONFUSED WITH INTERNAL MESSAGES)
     """
+    __slots__ = ("author_id", "recipient_id", "text")
 
     def __init__(self, author_id, recipient_id, text):
         self.author_id = author_id
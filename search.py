@@ -0,0 +1,198 @@
+import re
+import heapq
+from array import array
+from collections import Counter, OrderedDict
+from math import log
+from typing import Callable, List, Tuple
+
+# Words are runs of letters, digits and underscores, matched ignoring case
+WORD = re.compile(r"\w+")
+# Shorter or longer words aren't indexed (nor searched for)
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 32
+# Most postings (a word in a chat) an index holds. Past that, it forgets
+# the oldest chats until it is down to INDEX_KEEP of them.
+INDEX_POSTINGS = 1_000_000
+INDEX_KEEP = 0.75
+# Most postings all the indexes of the process hold together. Past that,
+# the indexes searched longest ago are thrown away (see IndexCache).
+INDEX_BUDGET = 4_000_000
+
+
+def terms(text: str) -> set:
+    """
+    The distinct words of text that go in the index, lowercased
+    """
+    return {word for word in WORD.findall(text.lower()) if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH}
+
+
+class TextIndex:
+    """
+    An inverted index over the text of one user's chats: every word maps
+    to the positions (see history.MessageLog) of the chats holding it, in
+    order. Chats are added as they are received. To keep its memory
+    bounded it only covers the newest chats: once it holds more than
+    INDEX_POSTINGS postings it drops the oldest chats from every word
+    that has them, a batch at a time. Searches rank chats by how many of
+    the query's words they hold, each weighted by how rare it is among
+    the indexed chats (its inverse document frequency), newer chats first
+    among equals.
+    """
+    __slots__ = ("text_at", "postings", "start", "end", "size")
+
+    def __init__(self, text_at: Callable[[int], str]):
+        self.text_at = text_at  # position -> text of the chat there
+        self.postings = {}  # word -> positions of the chats holding it, ascending
+        self.start = 0  # Position of the oldest indexed chat
+        self.end = 0  # Position after the newest indexed chat
+        self.size = 0  # Number of postings held
+
+    def __len__(self):
+        """
+        The number of chats indexed
+        """
+        return self.end - self.start
+
+    @staticmethod
+    def build(text_at: Callable[[int], str], end: int) -> "TextIndex":
+        """
+        An index of the chats before end, going back from the newest only
+        as far as fits in INDEX_POSTINGS
+        """
+        newest = []
+        size = 0
+        for position in range(end - 1, -1, -1):
+            found = terms(text_at(position))
+            if size + len(found) > INDEX_POSTINGS:
+                break
+            newest.append(found)
+            size += len(found)
+        index = TextIndex(text_at)
+        index.start = index.end = end - len(newest)
+        for (position, found) in enumerate(reversed(newest), index.start):
+            index.add(position, found=found)
+        return index
+
+    def add(self, position: int, text: str = "", found=None):
+        """
+        Indexes the chat at position, the newest so far. found is its
+        terms, if they are known already.
+        """
+        if found is None:
+            found = terms(text)
+        for term in found:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array("I")
+            postings.append(position)
+        self.end = position + 1
+        self.size += len(found)
+        if self.size > INDEX_POSTINGS:
+            self.forget(int(INDEX_POSTINGS * INDEX_KEEP))
+
+    def forget(self, keep: int):
+        """
+        Drops the oldest chats until at most keep postings are left
+        """
+        dropped = Counter()
+        while self.size > keep and self.start < self.end:
+            found = terms(self.text_at(self.start))
+            dropped.update(found)
+            self.size -= len(found)
+            self.start += 1
+        for (term, count) in dropped.items():
+            postings = self.postings[term]
+            del postings[:count]
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query: str, size: int, page=0) -> Tuple[List[int], bool]:
+        """
+        Returns the positions on the given page of the chats matching any
+        word of query, best first, and whether there are more
+        """
+        if page < 0:
+            return ([], False)
+        skip = page * size
+        wanted = terms(query)
+        if len(wanted) == 1:
+            # Every match scores the same, so the newest come first
+            postings = self.postings.get(wanted.pop(), ())
+            found = postings[max(len(postings) - skip - size - 1, 0):max(len(postings) - skip, 0)][::-1]
+            return (list(found[:size]), len(found) > size)
+        scores = Counter()
+        for term in wanted:
+            postings = self.postings.get(term, ())
+            if not postings:
+                continue
+            weight = log(1 + len(self) / len(postings))
+            for position in postings:
+                scores[position] += weight
+        found = heapq.nlargest(skip + size + 1, scores, key=lambda position: (scores[position], position))
+        found = found[skip:]
+        return (found[:size], len(found) > size)
+
+
+class IndexCache:
+    """
+    The text indexes of every message log in the process. A log's index is
+    only built when the log is first searched, is kept up to date as the
+    log receives chats from then on, and is thrown away once the indexes
+    together hold more than INDEX_BUDGET postings and it is the one
+    searched longest ago. So index memory is bounded for the whole process
+    rather than per user, and users that never search cost nothing.
+    """
+    __slots__ = ("indexes", "size")
+
+    def __init__(self):
+        self.indexes = OrderedDict()  # owner -> TextIndex, least recently searched first
+        self.size = 0  # Postings held by all of the indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def peek(self, owner):
+        """
+        The owner's index if it has one, without counting as a search
+        """
+        return self.indexes.get(owner)
+
+    def get(self, owner, build: Callable[[], TextIndex]) -> TextIndex:
+        """
+        The owner's index, built with build if it doesn't have one
+        """
+        index = self.indexes.get(owner)
+        if index is not None:
+            self.indexes.move_to_end(owner)
+            return index
+        index = self.indexes[owner] = build()
+        self.size += index.size
+        self.trim(keep=owner)
+        return index
+
+    def resized(self, change: int):
+        """
+        Called when an index gained or lost postings
+        """
+        self.size += change
+        self.trim()
+
+    def discard(self, owner):
+        index = self.indexes.pop(owner, None)
+        if index is not None:
+            self.size -= index.size
+
+    def trim(self, keep=None):
+        """
+        Throws indexes away, the one searched longest ago first, until the
+        rest fit in INDEX_BUDGET. keep is never thrown away.
+        """
+        while self.size > INDEX_BUDGET and self.indexes:
+            owner = next(iter(self.indexes))
+            if owner is keep:
+                return
+            self.discard(owner)
+
+
+# Shared by every message log of the process
+TEXT_INDEXES = IndexCache()
@@ -1,19 +1,31 @@
-import socket
 import os
 import sys
 from threading import Lock
-from typing import List, Mapping
-from queue import Queue, Empty
+from typing import List, Mapping, Tuple
+from queue import Queue
 from schema import Account, Chat
+from directory import UserDirectory, make_cursor, read_cursor
+from history import Undelivered, make_log_cursor, read_log_cursor
 import connections.consts as consts
 import connections.schema as conn_schema
+import persistence.consts as persist_consts
 from connections.manager import ConnectionManager
+from connections.async_manager import AsyncConnectionManager
+from connections.replication import LatencyHistogram
+from connections.notifications import NotifDispatcher
+from persistence.log_writer import LogWriter
+from persistence.segments import SegmentedLog
+import persistence.records as records
+from persistence.snapshot import Snapshotter, compress_state, decompress_state
 from threading import Thread
+from persistence.errors import LogWriteException
+from utils import print_error, print_info
 import threading
 import time
 
 ACCOUNT_PAGE_SIZE = 4
 LOG_PAGE_SIZE = 4
+SEARCH_PAGE_SIZE = 4
 
 
 class Server:
@@ -32,19 +44,48 @@ class Server:
         self.identity = consts.MACHINE_MAP[name]  # Hosting info
         # Bring myself up to date with info I have locally
         self.users = {}  # Users of the system NOTE: Also contains all chats that have ever happened
-        # Chats that are undelivered
-        self.msg_cache: "Mapping[str, Queue[Chat]]" = {}
-        self.notif_lock = Lock()  # Make sure only one thread is changing notif_sockets
-        self.notif_sockets: Mapping[str, any] = {}  # Sockets for notif threads
+        self.directory = UserDirectory()  # Index of the user ids, for list
+        # Chats that are undelivered, by where they start in the message logs
+        self.undelivered = Undelivered()
         self.alive = True
+        self.log_lock = Lock()  # Keeps progress and snapshots in step with the log
+        # Held while the request loop applies a request, so that reads
+        # served on the side (see read_loop) see whole requests
+        self.applied = threading.Condition()
+        self.progress = 0  # Number of records in the log
+        # Periodic snapshots of users and undelivered chats
+        self.snapshotter = Snapshotter(name, on_written=self.compact_log)
+        self.log_index = None  # Segments of the log, and where each record is
+        self.conman = None  # Connection manager
         ###### ACTIONS ######
         self.rehydrate()
-        self.conman = ConnectionManager(self.identity)  # Connection manager
+        # Group commits log appends, and keeps the offset index up to date
+        self.log_writer = LogWriter(
+            self.get_logfile(), index=self.log_index, on_commit=self.on_log_commit)
+        # Connection manager
+        if consts.MANAGER == consts.MANAGER_ASYNCIO:
+            self.conman = AsyncConnectionManager(self.identity)
+        else:
+            self.conman = ConnectionManager(self.identity)
         # Connects to all other internal machines
-        self.conman.initialize(self.get_progress(), self.get_reqs_by_progress)
-        self.notif_listen_socket = None
-        notif_listen_thread = Thread(target=self.notif_listener)
-        notif_listen_thread.start()  # Listen for clients that want notifications
+        self.conman.initialize(self.get_progress(), self.get_reqs_by_progress,
+                               self.log_index.prefix, self.install_log_prefix,
+                               self.get_catchup_snapshot, self.install_catchup_snapshot,
+                               self.at_log_position)
+        # Responses waiting for the commit of their request, in order
+        self.responses: "Queue[(int, int, str, float, str, conn_schema.Response)]" = Queue()
+        # How long responses waited for their commit, per commit level
+        self.commit_latency = {level: LatencyHistogram() for level in consts.COMMIT_LEVELS}
+        self.responder = Thread(target=self.respond_loop, daemon=True)
+        self.responder.start()
+        self.reader = Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        if persist_consts.COMMIT_REPORT_INTERVAL > 0:
+            Thread(target=self.report_commits, daemon=True).start()
+        # Delivers chats to the clients that want notifications
+        self.notifier = NotifDispatcher(self.identity, self.next_chats, self.mark_delivered,
+                                        lambda: self.conman.is_primary)
+        self.notifier.start()
 
     def get_logfile(self):
         return f"logs/{self.name}_log.out"
@@ -53,9 +94,8 @@ class Server:
         """
         Get the progress of this machine (count of lines in log file)
         """
-        filename = self.get_logfile()
-        with open(filename, "r") as file:
-            return len(file.readlines())
+        self.log_writer.flush()
+        return self.log_index.count()
 
     def get_reqs_by_progress(self, start_progress: int, end_progress: int) -> List[conn_schema.Request]:
         """
@@ -63,118 +103,289 @@ class Server:
         and progress < end_progress. Can return an empty array. Also does the
         work of unmarshalling and making the requests pretty.
         """
-        filename = self.get_logfile()
-        with open(filename, "r") as file:
-            lines = file.readlines()
-            lines = lines[start_progress:end_progress]
-            return [conn_schema.Request.unmarshal(l[:-1]) for l in lines]
+        self.log_writer.flush()
+        return self.log_index.read(start_progress, end_progress)
 
     def rehydrate(self):
         """
         Run when a server boots, it should read it's log and construct
-        the state of the server (accounts and messages)
+        the state of the server (accounts and messages). Starts from the
+        newest snapshot and only replays the part of the log after it.
         """
-        if not os.path.exists("logs"):
-            os.mkdir("logs")
+        os.makedirs("logs", exist_ok=True)
         filename = self.get_logfile()
-        if not os.path.exists(filename):
-            # If the file doesn't exist make a blank one
-            with open(filename, "w") as file:
-                file.write("")
-        with open(filename, "r") as file:
-            for l in file.readlines():
-                req = conn_schema.Request.unmarshal(l[:-1])
+        # NOTE: If the log doesn't exist the index makes a blank one
+        self.log_index = SegmentedLog(filename)
+        count = self.log_index.count()
+        snapshot = self.snapshotter.load_latest(
+            count, self.log_index.horizon())
+        if snapshot:
+            self.users = snapshot.users()
+            self.restore_undelivered(snapshot.pending)
+            self.progress = snapshot.progress
+        self.directory = UserDirectory(self.users)
+        for req in self.log_index.read(self.progress, count, allow_compacted=True):
+            self.handle_req(req, False)
+            self.snapshotter.track(req)
+        self.progress = count
+
+    def restore_undelivered(self, pending: Mapping[str, int]):
+        """
+        Takes on the undelivered counts of a snapshot: those are the newest
+        chats of every user
+        """
+        self.undelivered = Undelivered()
+        for (user_id, count) in pending.items():
+            if count and user_id in self.users:
+                self.undelivered.add(user_id, len(self.users[user_id].msg_log) - count)
+
+    def install_log_prefix(self, data: bytes, horizon: int, pending: Mapping[str, int]):
+        """
+        Called during catch up when this machine's log is empty and the
+        leader's log is compacted: takes on the leader's compacted records
+        as this machine's log and applies them, holding applied like
+        install_catchup_snapshot.
+        """
+        with self.applied, self.log_lock:
+            self.log_index.install_prefix(data, horizon, pending)
+            for req in records.decode_all(data, 0):
                 self.handle_req(req, False)
+                self.snapshotter.track(req)
+            self.progress = horizon
+            self.applied.notify_all()
 
-    def update_log(self, req: conn_schema.Request):
+    def get_catchup_snapshot(self):
         """
-        Add items to server log file
+        Returns (progress, compressed state) of the newest snapshot that the
+        log can continue from, for catching up a machine that is far behind.
+        None if there is no such snapshot.
+        """
+        found = self.snapshotter.read_latest(
+            self.get_progress(), self.log_index.horizon())
+        if found is None:
+            return None
+        (progress, rep) = found
+        return (progress, compress_state(rep))
+
+    def install_catchup_snapshot(self, data: bytes, progress: int):
+        """
+        Called during catch up when the leader sent its state instead of
+        the records this machine is missing. Throws this machine's log
+        away and makes the snapshot its state, logged as the requests that
+        rebuild it (see SnapshotState.requests).
+        Holds applied (before log_lock, in the order the request loop takes
+        them) for the whole swap: on a resync the request loop is running,
+        and must not apply a record against half of the old state.
+        """
+        state = decompress_state(data)
+        with self.applied, self.log_lock:
+            self.log_writer.flush()
+            self.log_index.reset()
+            body = b"".join(records.encode(req) for req in state.requests())
+            self.log_index.install_prefix(body, progress, state.pending)
+            for account in self.users.values():
+                account.msg_log.drop_index()
+            self.users = state.users()
+            self.directory = UserDirectory(self.users)
+            self.restore_undelivered(state.pending)
+            self.snapshotter.take_on(state)
+            self.progress = progress
+            self.applied.notify_all()
+
+    def at_log_position(self, func):
+        """
+        Calls func with this machine's progress while nothing can be logged,
+        so that replication to a machine that rejoins starts right there
+        """
+        with self.log_lock:
+            return func(self.progress)
+
+    def update_log(self, req: conn_schema.Request, wait=True):
+        """
+        Add items to server log file. The log writer coalesces appends from
+        all threads into group commits, see persistence/log_writer.py
+        On the primary this also hands the request to the backups, in the
+        same order it goes in the log.
+        Returns (ticket, position) for the record, position being the
+        progress once it is logged (None if nothing was logged). With
+        wait=False the caller is responsible for waiting on the ticket.
         """
         if req.type in conn_schema.UNIMPORTANT_REQUEST_TYPES:
-            return
-        filename = self.get_logfile()
-        fout = open(filename, "a")
-        fout.write(req.marshal() + "\n")
-        fout.flush()
-        fout.close()
-
-    def notif_listener(self):
-        """
-        Handles connections from clients that have logged in and want
-        immediate delivery of notifications
-        """
-        self.notif_listen_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
-        self.notif_listen_socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.notif_listen_socket.bind(
-            (self.identity.host_ip, self.identity.notif_port))
-        self.notif_listen_socket.listen()
-        try:
-            while self.alive:
-                conn, _ = self.notif_listen_socket.accept()
-                user_id = conn.recv(2048).decode()
-                with self.notif_lock:
-                    if user_id in self.notif_sockets:
-                        resp = conn_schema.Response(
-                            user_id, False, "Already logged in")
-                    else:
-                        resp = conn_schema.Response(user_id, True, "")
-                        self.notif_sockets[user_id] = conn
-                conn.send(resp.marshal().encode())
-                handler = Thread(target=self.notif_thread, args=(user_id,))
-                handler.start()
-        except:
-            self.notif_listen_socket.close()
-
-    def notif_thread(self, user_id: str):
-        """
-        A thread that is for a specific logged in user and does the
-        instant delivery shenanigans
-        """
-        CHECK_IN_RATE = 3
-        with self.notif_lock:
-            if user_id not in self.notif_sockets:
+            return None
+        with self.log_lock:
+            ticket = self.log_writer.append(records.encode(req), wait=False)
+            self.snapshotter.track(req)
+            self.progress += 1
+            position = self.progress
+            self.conman.broadcast_to_backups(req, position)
+        if wait and self.log_writer.durability != persist_consts.DURABILITY_BUFFERED:
+            self.log_writer.wait_for(ticket)
+        return (ticket, position)
+
+    def commit_level(self, req: conn_schema.Request) -> str:
+        """
+        Which commit level the response to req waits for, see
+        connections/consts.py. Requests that aren't logged never wait on
+        the backups.
+        """
+        if req.type in conn_schema.UNIMPORTANT_REQUEST_TYPES:
+            return consts.COMMIT_PRIMARY
+        return consts.COMMIT_LEVEL_OVERRIDES.get(req.type, consts.COMMIT_LEVEL)
+
+    def respond(self, client_name: str, resp: conn_schema.Response, commit=None, level=consts.COMMIT_PRIMARY):
+        """
+        Hands a response to the responder, which sends it once the request
+        is committed at the given level. commit is what update_log returned.
+        Responses to requests that weren't logged still wait for everything
+        logged before them, so they never show a client state that isn't
+        committed yet.
+        """
+        (ticket, position) = commit if commit else (self.log_writer.last_ticket(), None)
+        resp.progress = position if position is not None else self.progress
+        self.responses.put((ticket, position, level, time.time(), client_name, resp))
+
+    def respond_loop(self):
+        """
+        Sends responses in order as their requests get committed. This is
+        what lets the request loop keep going (and the log writer commit
+        whole bursts at once) instead of waiting for every commit itself.
+        """
+        while True:
+            item = self.responses.get()
+            if item is None:
                 return
-            conn = self.notif_sockets[user_id]
-        try:
-            while True:
-                # NOTE: It can take up to 3 seconds for a logout to propogate
-                # This is probably fine
+            (ticket, position, level, queued_at, client_name, resp) = item
+            if self.log_writer.durability != persist_consts.DURABILITY_BUFFERED:
                 try:
-                    msg = self.msg_cache[user_id].get(
-                        block=True, timeout=CHECK_IN_RATE)
-                except Empty:
-                    # Send a ping regularly to see that client is still there
-                    ping = conn_schema.PingResponse()
-                    conn.send(ping.marshal().encode())
-                    data = conn.recv(2048)
-                    if not data or len(data) <= 0:
-                        # If the ping fails we assume the client has died and we stop
-                        raise Exception("Client not there")
-                    resp = conn_schema.Response.unmarshal(data.decode())
-                    if not resp.success:
-                        # If the ping fails we assume the client has died and we stop
-                        raise Exception("Client not there")
-                    # If the ping succeeds go back to listening
-                    continue
-                req = conn_schema.NotifRequest(user_id)
-                # Marks in the system that a message has been delivered
-                self.update_log(req)
-                # Lets the backups know about this so they have the same view of undelivered messages
-                self.conman.broadcast_to_backups(req)
-                # Gives the client the notif
-                resp = conn_schema.NotifResponse(user_id, True, "", msg)
-                conn.send(resp.marshal().encode())
-                data = conn.recv(2048)
+                    self.log_writer.wait_for(ticket)
+                except LogWriteException as e:
+                    print_error(e.message)
+                    resp = conn_schema.Response(
+                        user_id=resp.user_id, success=False, error_message="Error: request could not be logged")
+            if position is not None and not self.conman.wait_for_replication(position, level):
+                print_error(f"Request at {position} wasn't acked by enough backups for a {level} commit")
+                resp = conn_schema.Response(
+                    user_id=resp.user_id, success=False, error_message="Error: request could not be replicated")
+            self.commit_latency[level].record(time.time() - queued_at)
+            try:
+                self.conman.send_response(client_name, resp)
+            except Exception as e:
+                print_error(f"Failed to respond to {client_name}: {e}")
+
+    def read_loop(self):
+        """
+        Serves reads that clients send to this machine while it is a
+        backup, next to the request loop. Each is answered with the
+        progress it was served at. A read asking for more progress than
+        this machine has applied waits up to READ_WAIT for it, and is
+        refused after that, so the client can go to the primary instead.
+        So is a read that fails while it is served.
+        """
+        while True:
+            item = self.conman.read_requests.get()
+            if item is None:
+                return
+            (client_name, req) = item
+            with self.applied:
+                if self.applied.wait_for(lambda: self.progress >= req.min_progress, consts.READ_WAIT):
+                    try:
+                        resp = self.handle_req(req, False)
+                    except Exception as e:
+                        # This thread serves every read, it must outlive a bad one
+                        print_error(f"Failed to serve {req.type} for {client_name}: {e}")
+                        resp = conn_schema.Response(
+                            user_id=req.user_id, success=False, error_message="Error: read could not be served")
+                else:
+                    resp = conn_schema.Response(
+                        user_id=req.user_id, success=False,
+                        error_message=f"Error: at progress {self.progress}, behind {req.min_progress}")
+                resp.progress = self.progress
+            try:
+                self.conman.send_response(client_name, resp)
+            except Exception as e:
+                print_error(f"Failed to respond to {client_name}: {e}")
+
+    def report_commits(self):
+        """
+        Regularly prints how well appends are being group committed
+        """
+        while self.alive:
+            time.sleep(persist_consts.COMMIT_REPORT_INTERVAL)
+            stats = self.log_writer.stats()
+            if stats["commits"] > 0:
+                print_info(
+                    f"Log: {stats['records']} records committed, last {stats['commits']} commits held "
+                    f"{stats['mean_batch']:.1f} on average and {stats['max_batch']} at most")
+            for (level, histogram) in self.commit_latency.items():
+                latency = histogram.summary()
+                if latency["count"] > 0:
+                    print_info(
+                        f"Commit ({level}): {latency['count']} responses, mean {latency['mean_ms']:.2f}ms, "
+                        f"p50 <= {latency['p50_ms']}ms, p99 <= {latency['p99_ms']}ms")
+            for (name, status) in self.conman.replication_status().items():
+                print_info(
+                    f"Replication to {name}: acked {status['acked']}, {status['lag']} behind, "
+                    f"{status['queued']} queued, last ack {status['since_ack']}s ago")
+
+    def on_log_commit(self, _):
+        """
+        Called by the log writer after every commit. Backups let the primary
+        know how far they have logged.
+        """
+        if self.conman is not None and not self.conman.is_primary:
+            self.conman.acknowledge(self.log_index.count())
+
+    def compact_log(self, snapshot_progress: int):
+        """
+        Called once a snapshot is on disk. Everything before it will never
+        need to be replayed record by record again, so compact it.
+        """
+        try:
+            self.log_index.compact(snapshot_progress)
         except Exception as e:
-            # Error means the client has stopped listening on this thread
-            # Clean up by deliting the socket from the map so that otehr clients
-            # can connect using this username
-            conn.close()
-            with self.notif_lock:
-                if user_id in self.notif_sockets:
-                    del self.notif_sockets[user_id]
+            print_error(f"Failed to compact log: {e}")
+
+    def maybe_snapshot(self):
+        """
+        Called between requests on the request loop. Takes a snapshot if
+        enough has been logged since the last one, and writes it out in the
+        background.
+        """
+        with self.log_lock:
+            if not self.snapshotter.is_due(self.progress):
+                return
+            state = self.snapshotter.capture(self.progress, self.users)
+        self.snapshotter.write_async(state)
+
+    def next_chats(self, user_id: str, limit: int) -> List[Chat]:
+        """
+        Takes up to limit of the oldest chats not yet delivered to user_id,
+        for the notifier. Holds applied, so the notifier only ever sees
+        whole requests.
+        """
+        with self.applied:
+            if user_id not in self.users:
+                return []
+            return self.undelivered.take(user_id, self.users[user_id].msg_log, limit)
+
+    def mark_delivered(self, deliveries: List[Tuple[str, int]]):
+        """
+        Marks in the system that chats have been delivered, (user_id, count)
+        for every batch, by moving those users' delivery watermarks. Lets the
+        backups know so they have the same view of undelivered messages.
+        Every watermark is one record, and they all wait on one commit.
+        """
+        commit = None
+        for (user_id, _) in deliveries:
+            with self.applied:
+                # Everything the user received that isn't undelivered anymore
+                if user_id not in self.users:
+                    continue
+                msg_log = self.users[user_id].msg_log
+                watermark = len(msg_log) - self.undelivered.count(user_id, msg_log)
+            commit = self.update_log(conn_schema.WatermarkRequest(user_id, watermark), wait=False)
+        if commit and self.log_writer.durability != persist_consts.DURABILITY_BUFFERED:
+            self.log_writer.wait_for(commit[0])
 
     def handle_create(self, request: conn_schema.CreateRequest, _):
         """
@@ -182,9 +393,12 @@ class Server:
         """
         if request.user_id in self.users:
             return conn_schema.Response(user_id=request.user_id, success=False, error_message="User already exists")
+        if len(request.user_id) > records.MAX_FIELD_LENGTH:
+            # Ids are logged with a 16 bit length, see persistence/records.py
+            return conn_schema.Response(user_id=request.user_id, success=False, error_message="User id is too long")
         new_account = Account(user_id=request.user_id)
         self.users[new_account.user_id] = new_account
-        self.msg_cache[new_account.user_id] = Queue()
+        self.directory.add(new_account.user_id)
         return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
 
     def handle_login(self, request: conn_schema.LoginRequest, _):
@@ -202,21 +416,34 @@ class Server:
         """
         if not request.user_id in self.users:
             return conn_schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
+        self.users[request.user_id].msg_log.drop_index()
         del self.users[request.user_id]
-        del self.msg_cache[request.user_id]
+        self.directory.remove(request.user_id)
+        self.undelivered.forget(request.user_id)
         return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
 
     def handle_list(self, request: conn_schema.ListRequest, _):
         """
-        Lists all accounts that match the given wildcard.
-        NOTE: "" will match all accounts. Other strings will simply use
-        Python's built-in "in" operator.
+        Lists all accounts that match the given wildcard, in user_id order.
+        NOTE: "" will match all accounts, "^abc" the ones starting with
+        abc, and other strings the ones containing them. Answered from the
+        user directory (see directory.py), so a page doesn't cost a pass
+        over every account. With a cursor the page is counted from where
+        the cursor left off, and the response carries the next cursor.
         """
-        satisfying = filter(
-            lambda user: request.wildcard in user.user_id, self.users.values())
-        limited_to_page = list(satisfying)[
-            request.page * ACCOUNT_PAGE_SIZE: (request.page + 1) * ACCOUNT_PAGE_SIZE]
-        return conn_schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=limited_to_page)
+        after = None
+        if request.cursor:
+            try:
+                after = read_cursor(request.cursor)
+            except ValueError:
+                return conn_schema.Response(user_id=request.user_id, success=False, error_message="Invalid cursor")
+        (user_ids, more) = self.directory.page(request.wildcard, ACCOUNT_PAGE_SIZE, request.page, after)
+        limited_to_page = [self.users[user_id] for user_id in user_ids]
+        cursor = None
+        if request.cursor is not None:
+            cursor = make_cursor(user_ids[-1]) if more else ""
+        return conn_schema.ListResponse(user_id=request.user_id, success=True, error_message="",
+                                        accounts=limited_to_page, cursor=cursor)
 
     def handle_send(self, request, was_primary: bool):
         """
@@ -227,36 +454,79 @@ class Server:
             return conn_schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
         chat = Chat(
             author_id=request.user_id, recipient_id=request.recipient_id, text=request.text)
-        if not request.recipient_id in self.msg_cache:
-            self.msg_cache[request.recipient_id] = Queue()
-        if not was_primary:
-            self.msg_cache[request.recipient_id].put(chat)
-        self.users[request.recipient_id].msg_log.insert(0, chat)
+        msg_log = self.users[request.recipient_id].msg_log
+        msg_log.append(chat)
+        if not request.delivered:
+            # On the primary the notifier can only take it once the request
+            # loop lets go of applied, by then the send is logged
+            self.undelivered.add(request.recipient_id, len(msg_log) - 1)
         return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
 
     def handle_notif(self, request, _):
         """
-        The primary will have their msg_cache continuously emptied by
+        The primary will have their undelivered chats continuously taken by
         clients subscribing to real-time updates. The backups, however,
         need to have their caches managed by discrete reqs. This is what
         this is for. Since requests are well ordered by the primary, this
-        is as simple as just getting the latest chat and removing it
+        is as simple as just getting the latest chats and removing them
         """
-        if not request.user_id in self.msg_cache or self.msg_cache[request.user_id].empty():
+        if len(self.next_chats(request.user_id, request.count)) < request.count:
             return conn_schema.Response(user_id=request.user_id, success=False, error_message="Can't catchup queue")
-        self.msg_cache[request.user_id].get()
+        return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def handle_watermark(self, request, _):
+        """
+        Moves a user's delivery watermark, on the backups and on replay:
+        every chat they received up to it is delivered, so only the ones
+        after it stay undelivered. Moving it back or to where it is changes
+        nothing.
+        """
+        if not request.user_id in self.users:
+            return conn_schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
+        msg_log = self.users[request.user_id].msg_log
+        self.undelivered.keep(request.user_id, msg_log, len(msg_log) - request.watermark)
         return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
 
     def handle_logs(self, request, _):
         """
-        Returns a users message logs
+        Returns the messages a user received whose author contains the
+        given wildcard, newest first. Answered from the author index of the
+        user's message log (see history.py), so a page only costs the
+        chats of matching authors. With a cursor the page is counted from
+        where the cursor left off, and the response carries the next
+        cursor. Cursors are positions in the log, so chats arriving in
+        between don't shift the pages.
+        """
+        before = None
+        if request.cursor:
+            try:
+                before = read_log_cursor(request.cursor)
+            except ValueError:
+                return conn_schema.Response(user_id=request.user_id, success=False, error_message="Invalid cursor")
+        if not request.user_id in self.users:
+            return conn_schema.LogsResponse(user_id=request.user_id, success=False,
+                                            error_message="User does not exist", msgs=[])
+        msg_hist = self.users[request.user_id].msg_log
+        (positions, more) = msg_hist.page(request.wildcard, LOG_PAGE_SIZE, request.page, before)
+        limited_to_page = [msg_hist[position] for position in positions]
+        cursor = None
+        if request.cursor is not None:
+            cursor = make_log_cursor(positions[-1]) if more else ""
+        return conn_schema.LogsResponse(user_id=request.user_id, success=True, error_message="",
+                                        msgs=limited_to_page, cursor=cursor)
+
+    def handle_search(self, request, _):
+        """
+        Returns the messages a user received that hold the words of the
+        query, best first. Answered from the text index of the user's
+        message log (see search.py), which covers their newest messages.
         """
+        if not request.user_id in self.users:
+            return conn_schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
         msg_hist = self.users[request.user_id].msg_log
-        satisfying = filter(
-            lambda msg: request.wildcard in msg.author_id, msg_hist)
-        limited_to_page = list(satisfying)[
-            request.page * LOG_PAGE_SIZE: (request.page + 1) * LOG_PAGE_SIZE]
-        return conn_schema.LogsResponse(user_id=request.user_id, success=True, error_message="", msgs=limited_to_page)
+        (positions, _) = msg_hist.search(request.query, SEARCH_PAGE_SIZE, request.page)
+        return conn_schema.SearchResponse(user_id=request.user_id, success=True, error_message="",
+                                          msgs=[msg_hist[position] for position in positions])
 
     def handle_fallover(self, request, _):
         """
@@ -264,6 +534,30 @@ class Server:
         """
         return conn_schema.Response(user_id=request.user_id, success=True, error_message="")
 
+    def in_sequence(self, req) -> bool:
+        """
+        Backups apply every record the primary replicates exactly once, in
+        log order, going by its LSN (see ConnectionManager.broadcast_to_backups).
+        A record at or below this machine's progress was applied already,
+        it came twice (say once replicated and once in a catch up) and is
+        skipped. A record further ahead than the next one means records went
+        missing, so it is refused and this machine asks to be caught up
+        again from its progress. Records from a primary that has since been
+        replaced (an older term) are refused.
+        """
+        if not req.lsn:
+            return True  # Not sequenced, e.g. a fallover
+        if not self.conman.observe_term(req.term):
+            print_error(f"Refusing record {req.lsn} from term {req.term}, at term {self.conman.term}")
+            return False
+        if req.lsn <= self.progress:
+            return False
+        if req.lsn > self.progress + 1:
+            print_error(f"Records {self.progress + 1} to {req.lsn - 1} are missing, catching up again")
+            self.conman.resync(self.progress)
+            return False
+        return True
+
     def handle_req(self, req, was_primary: bool):
         if req.type == "create":
             resp = self.handle_create(req, was_primary)
@@ -273,10 +567,14 @@ class Server:
             resp = self.handle_list(req, was_primary)
         elif req.type == "logs":
             resp = self.handle_logs(req, was_primary)
+        elif req.type == "search":
+            resp = self.handle_search(req, was_primary)
         elif req.type == "send":
             resp = self.handle_send(req, was_primary)
         elif req.type == "notif":
             resp = self.handle_notif(req, was_primary)
+        elif req.type == "watermark":
+            resp = self.handle_watermark(req, was_primary)
         elif req.type == "delete":
             resp = self.handle_delete(req, was_primary)
         elif req.type == "fallover":
@@ -290,35 +588,43 @@ class Server:
         request_iter = self.conman.request_generator()
         while True:
             (was_primary, client_name, req) = next(request_iter)
-            resp = self.handle_req(req, was_primary)
+            if not was_primary and not self.in_sequence(req):
+                continue
+            with self.applied:
+                resp = self.handle_req(req, was_primary)
+                commit = None
+                # A replicated record is in the primary's log, so it goes in
+                # this one too, keeping positions the same on every machine
+                if resp.success or req.lsn:
+                    # Update log (and on the primary broadcast to backups),
+                    # without waiting for the commit so that the next
+                    # requests can join it
+                    commit = self.update_log(req, wait=False)
+                self.applied.notify_all()
             if was_primary:
                 if resp.success:
-                    # Broadcast to backups
-                    self.conman.broadcast_to_backups(req)
-                    # Update log
-                    self.update_log(req)
-                    # Put it in the cache to be available for notifications
+                    if req.type == "fallover":
+                        # Fallover isn't logged but the backups still need it
+                        self.conman.broadcast_to_backups(req, self.progress)
                     if req.type == "send":
-                        chat = Chat(
-                            author_id=req.user_id, recipient_id=req.recipient_id, text=req.text)
-                        self.msg_cache[req.recipient_id].put(chat)
-                self.conman.send_response(client_name, resp)
-            else:
-                # Is a backup
-                if resp.success:
-                    self.update_log(req)
+                        self.notifier.wake(req.recipient_id)
+                self.respond(client_name, resp, commit, self.commit_level(req))
             if req.type == "fallover":
                 self.kill()
                 break
+            self.maybe_snapshot()
 
     def kill(self):
         self.alive = False
+        # Let the responses already queued go out first
+        self.responses.put(None)
+        self.responder.join(timeout=5)
+        # And what was handed to the backups (a fallover, say)
+        self.conman.flush_backups(timeout=5)
         self.conman.kill()
-        with self.notif_lock:
-            for user_id in self.notif_sockets:
-                self.notif_sockets[user_id].close()
-        if self.notif_listen_socket:
-            self.notif_listen_socket.close()
+        self.notifier.stop()
+        self.log_writer.close()
+        self.log_index.close()
         time.sleep(1)
 
 
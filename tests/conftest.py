@@ -1,5 +1,8 @@
 from mocks.mock_socket import socket
 import sys
+# Imported before the socket module is swapped for the mock below, the
+# event loop needs the real one
+import asyncio
 sys.path.append("../..")
 
 
@@ -1,3 +1,4 @@
+import struct
 from queue import Queue
 
 
@@ -15,15 +16,25 @@ class socket:
         self.has_listened = False
         self.fake_connects = []
         self.sent: list[bytes] = []
+        self.pending = b""  # Bytes of a fake send not yet returned by recv_into
+        self.timeout = None
 
     # HELPER FUNCTIONS
 
     def add_fake_send(self, data):
         """
-        Makes it so the next call to recv will return the given message
-        encoded as a bytestring
+        Makes it so the next recv will return the given message
+        encoded as a bytestring and framed
         """
-        self.fake_sends.put(data)
+        payload = data if isinstance(data, bytes) else str(data).encode()
+        self.fake_sends.put(struct.pack(">I", len(payload)) + payload)
+
+    def add_fake_bytes(self, raw: bytes):
+        """
+        Makes it so the next recv will return exactly these bytes (for
+        sending partial or several frames at once)
+        """
+        self.fake_sends.put(raw)
 
     def set_fake_accepts(self, accepts):
         """
@@ -42,11 +53,18 @@ class socket:
             raise Exception("Socket has been closed")
         if self.fake_sends.empty():
             raise Exception("No more messages to send")
-        msg = self.fake_sends.get()
-        return str(msg).encode()
+        return self.fake_sends.get()
 
-    def settimeout(self, _):
-        pass
+    def recv_into(self, buffer):
+        if not self.pending:
+            self.pending = self.recv(len(buffer))
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
 
     def setsockopt(self, _, __, ___):
         pass
@@ -73,3 +91,48 @@ class socket:
 
     def send(self, bs: bytes):
         self.sent.append(bs)
+
+    def sendall(self, bs: bytes):
+        """
+        Unframes what is sent so that sent holds one payload per message
+        """
+        pos = 0
+        while pos < len(bs):
+            (length,) = struct.unpack_from(">I", bs, pos)
+            self.sent.append(bs[pos + 4:pos + 4 + length])
+            pos += 4 + length
+
+
+class paired_socket(socket):
+    """
+    One end of an in memory connection: what one end sends the other
+    receives, and recv blocks until something arrives
+    """
+
+    def __init__(self):
+        super().__init__(0, 0)
+        self.peer = None
+        self.inbox = Queue()
+
+    def recv(self, _):
+        data = self.inbox.get()
+        if data is None:
+            return b""
+        return data
+
+    def sendall(self, bs: bytes):
+        super().sendall(bs)  # Keeps sent like any other mock socket
+        self.peer.inbox.put(bytes(bs))
+
+    def close(self):
+        if not self.has_closed:
+            self.has_closed = True
+            self.inbox.put(None)
+            self.peer.inbox.put(None)
+
+
+def socketpair():
+    a = paired_socket()
+    b = paired_socket()
+    (a.peer, b.peer) = (b, a)
+    return (a, b)
@@ -0,0 +1,28 @@
+"""
+Checks paged indexes (directory.py, history.py) against testing every item
+"""
+
+
+def walk(paged, wildcard, size, by_cursor):
+    """
+    Everything listed by going through all the pages, by number or by
+    cursor. paged.page takes (wildcard, size, page, cursor) and returns
+    (items, more), a cursor being the last item of a page.
+    """
+    (listed, page, cursor) = ([], 0, None)
+    while True:
+        (items, more) = paged.page(wildcard, size, 0 if by_cursor else page, cursor)
+        listed += items
+        if not more:
+            return listed
+        (page, cursor) = (page + 1, items[-1] if by_cursor else None)
+
+
+def assert_pages(paged, wildcard, expected, sizes=(1, 4, 7)):
+    """
+    Going through every page, by number and by cursor, lists expected
+    whatever the page size
+    """
+    for size in sizes:
+        assert walk(paged, wildcard, size, by_cursor=False) == expected
+        assert walk(paged, wildcard, size, by_cursor=True) == expected
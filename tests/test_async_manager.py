@@ -0,0 +1,57 @@
+import time
+import asyncio.base_events
+import connections.schema as conn_schema
+import connections.consts as consts
+import connections.framing as framing
+from connections.async_manager import AsyncConnectionManager
+
+A = consts.MACHINE_A
+B = consts.MACHINE_B
+
+# The socket module is mocked for the tests (see conftest.py), the event
+# loop needs sockets with real file descriptors. asyncio was imported
+# before the mock, so it still holds the real module.
+real_socket = asyncio.base_events.socket
+
+
+def test_consume():
+    """
+    Frames from other machines are handled on the loop, acks included
+    """
+    conman = AsyncConnectionManager(B)
+    (mine, theirs) = real_socket.socketpair()
+    conman.consume("A", mine)
+    framing.send_frames(theirs, [conn_schema.CreateRequest("ream").marshal().encode(),
+                                 conn_schema.Request.marshal_entry(conn_schema.CreateRequest("mark"), 2, 1).encode()])
+    first = conman.internal_requests.get(timeout=5)
+    second = conman.internal_requests.get(timeout=5)
+    assert (first.user_id, second.user_id, second.lsn) == ("ream", "mark", 2)
+    theirs.close()
+    conman.kill()
+
+
+def test_serve_client():
+    """
+    Clients are served on the loop like handle_client would, and dropped
+    once they go away
+    """
+    conman = AsyncConnectionManager(A)
+    conman.is_primary = True
+    (mine, theirs) = real_socket.socketpair()
+    conman.client_sockets["client"] = mine
+    conman.serve_client("client")
+    framing.send_message(theirs, conn_schema.LoginRequest("ream").marshal())
+    (was_primary, name, req) = conman.client_requests.get(timeout=5)
+    assert (was_primary, name, req.type) == (True, "client", "login")
+    conman.send_response(name, conn_schema.Response("ream", True, ""))
+    assert conn_schema.Response.unmarshal(framing.recv_message(theirs)).success
+
+    conman.is_primary = False
+    framing.send_message(theirs, conn_schema.LoginRequest("ream").marshal())
+    assert "Not primary" in framing.recv_message(theirs)
+    theirs.close()
+    deadline = time.time() + 5
+    while "client" in conman.client_sockets:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    conman.kill()
@@ -111,6 +111,10 @@ class Test_server(unittest.TestCase):
         client.input = lambda _: "a"*9
         c.handle_list()
         assert "wildcard cannot be longer than 8 characters" in sys.stdout.getvalue()
+
+        # Pages gone on to by cursor aren't shown as "page next"
+        assert client.page_name("next") == "the next page"
+        assert client.page_name("2") == "page 2"
     
     def test_handle_logs(self):
             
@@ -129,6 +133,23 @@ class Test_server(unittest.TestCase):
         c.handle_logs()
         assert "wildcard cannot be longer than 8 characters" in sys.stdout.getvalue()
     
+    def test_handle_search(self):
+
+        # Create test client
+        c = Client_dummy()
+
+        # Test handle_search when not logged in
+        c.user_id = ""
+        sys.stdout = io.StringIO()
+        c.handle_search()
+        assert "You must be logged in to search" in sys.stdout.getvalue()
+
+        # Test handle_search when logged in
+        c.user_id = "ream"
+        client.input = lambda _: "a@@b"
+        c.handle_search()
+        assert "search cannot contain" in sys.stdout.getvalue()
+
     def test_handle_send(self):
         # Create test client
         c = Client_dummy()
@@ -150,8 +171,8 @@ class Test_server(unittest.TestCase):
         c = Client_dummy()
         
         # Test parse_input returns correct function
-        functions = [c.handle_create, c.handle_login, c.handle_delete, c.handle_list, c.handle_send, c.handle_logs, c.handle_fallover]
-        for ix, command in enumerate(["create", "login", "delete", "list", "send", "logs", "fallover"]):
+        functions = [c.handle_create, c.handle_login, c.handle_delete, c.handle_list, c.handle_send, c.handle_logs, c.handle_search, c.handle_fallover]
+        for ix, command in enumerate(["create", "login", "delete", "list", "send", "logs", "search", "fallover"]):
             ret = c.parse_input(command)
             assert ret == functions[ix]
 
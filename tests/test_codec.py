@@ -0,0 +1,199 @@
+import connections.schema as conn_schema
+import connections.consts as consts
+import connections.codec as codec
+import schema as data_schema
+from tests.mocks.mock_socket import socket
+from connections.manager import ConnectionManager
+from connections.connector import ClientConnector
+
+
+def fields(obj):
+    """
+    Every attribute of a slotted object
+    """
+    return {name: getattr(obj, name) for cls in type(obj).__mro__ for name in getattr(cls, "__slots__", ())}
+
+
+def round_trip_request(req):
+    return codec.BINARY.decode_request(codec.BINARY.encode_request(req))
+
+
+def round_trip_response(resp):
+    return codec.BINARY.decode_response(codec.BINARY.encode_response(resp))
+
+
+def test_requests():
+    """
+    Every request type comes back as the same request
+    """
+    reqs = [
+        conn_schema.Request("blank"),
+        conn_schema.CreateRequest("ream"),
+        conn_schema.LoginRequest("ream"),
+        conn_schema.DeleteRequest("ream"),
+        conn_schema.NotifRequest("ream"),
+        conn_schema.NotifRequest("ream", 500),
+        conn_schema.WatermarkRequest("ream", 2 ** 40),
+        conn_schema.FalloverRequest("ream"),
+        conn_schema.SendRequest("ream", "mark", "hi @@ there ## || ünïcode"),
+        conn_schema.SendRequest("", "", ""),
+        conn_schema.ListRequest("ream", "ma@@", 3),
+        conn_schema.ListRequest("ream", "^ma", 1, 5, ""),
+        conn_schema.ListRequest("ream", "", 0, 0, "6d61726b"),
+        conn_schema.LogsRequest("ream", "", -1),
+        conn_schema.LogsRequest("ream", "", 0, 2 ** 40),
+        conn_schema.LogsRequest("ream", "ma", 2, 0, "1f"),
+        conn_schema.SearchRequest("ream", "lunch on friday?", 1),
+        conn_schema.SearchRequest("ream", "", 0, 2 ** 40),
+        conn_schema.AckRequest("B", 2 ** 40),
+    ]
+    for req in reqs:
+        out = round_trip_request(req)
+        assert type(out) == type(req)
+        assert fields(out) == fields(req)
+
+
+def test_entries():
+    """
+    Replicated records come back with their LSN and term, in both codecs
+    """
+    req = conn_schema.SendRequest("ream", "mark", "hi there")
+    for conn_codec in [codec.BINARY, codec.TEXT]:
+        out = conn_codec.decode_request(conn_codec.encode_entry(req, 2 ** 40, 7))
+        assert type(out) == type(req)
+        assert (out.user_id, out.recipient_id, out.text) == ("ream", "mark", "hi there")
+        assert (out.lsn, out.term) == (2 ** 40, 7)
+        batch = conn_codec.decode_request(conn_codec.encode_entry(conn_schema.NotifRequest("ream", 64), 3, 7))
+        assert (batch.type, batch.count, batch.lsn) == ("notif", 64, 3)
+
+
+def test_responses():
+    """
+    Every response type comes back as the same response
+    """
+    chat = data_schema.Chat("mark", "ream", "hello @@ ## ||")
+    basic = round_trip_response(conn_schema.Response("ream", False, "No @@"))
+    assert (basic.type, basic.user_id, basic.success, basic.error_message) == \
+        ("basic", "ream", False, "No @@")
+    assert round_trip_response(conn_schema.PingResponse()).type == "ping"
+
+    notif = round_trip_response(conn_schema.NotifResponse("ream", True, "", chat))
+    assert notif.type == "notif" and notif.success
+    assert fields(notif.chat) == fields(chat)
+
+    accounts = [data_schema.Account("ream"), data_schema.Account("ma@@rk")]
+    listed = round_trip_response(conn_schema.ListResponse("ream", True, "", accounts))
+    assert [a.user_id for a in listed.accounts] == ["ream", "ma@@rk"]
+    assert round_trip_response(conn_schema.ListResponse("ream", True, "", [])).accounts == []
+    for cursor in ["6d61726b", ""]:
+        paged = conn_schema.ListResponse("ream", True, "", [data_schema.Account("ream"), data_schema.Account("mark")], cursor)
+        for out in [round_trip_response(paged), conn_schema.Response.unmarshal(paged.marshal())]:
+            assert ([a.user_id for a in out.accounts], out.cursor) == (["ream", "mark"], cursor)
+    assert round_trip_response(conn_schema.ListResponse("ream", True, "", [], "")).accounts == []
+
+    for resp in [conn_schema.Response("ream", True, ""), conn_schema.ListResponse("ream", True, "", [data_schema.Account("mark")]),
+                 conn_schema.LogsResponse("ream", True, "", [data_schema.Chat("mark", "ream", "hi")])]:
+        resp.progress = 7
+        assert round_trip_response(resp).progress == 7
+        assert conn_schema.Response.unmarshal(resp.marshal()).progress == 7
+
+    logs = round_trip_response(conn_schema.LogsResponse("ream", True, "", [chat, chat]))
+    assert [fields(c) for c in logs.msgs] == [fields(chat), fields(chat)]
+    assert round_trip_response(conn_schema.LogsResponse("ream", True, "", [])).msgs == []
+    for msgs in [[data_schema.Chat("mark", "ream", "lunch?"), data_schema.Chat("mark", "ream", "hi")], []]:
+        found = conn_schema.SearchResponse("ream", True, "", msgs)
+        found.progress = 3
+        for out in [round_trip_response(found), conn_schema.Response.unmarshal(found.marshal())]:
+            assert out.type == "search" and [fields(c) for c in out.msgs] == [fields(c) for c in msgs]
+            assert out.progress == 3 and "cursor" not in fields(out)
+    for cursor in ["1f", ""]:
+        paged = conn_schema.LogsResponse("ream", True, "", [data_schema.Chat("mark", "ream", "hi")], cursor)
+        for out in [round_trip_response(paged), conn_schema.Response.unmarshal(paged.marshal())]:
+            assert ([c.text for c in out.msgs], out.cursor) == (["hi"], cursor)
+
+
+def test_text_matches_marshal():
+    """
+    The text codec is exactly the old format
+    """
+    req = conn_schema.SendRequest("ream", "mark", "hello")
+    assert codec.TEXT.encode_request(req) == req.marshal().encode()
+    assert fields(codec.TEXT.decode_request(req.marshal().encode())) == fields(req)
+
+
+def test_bad_page():
+    """
+    A page that doesn't fit is refused rather than crashing the encoder
+    """
+    for req in [conn_schema.ListRequest("ream", "", 2 ** 40),
+                conn_schema.LogsRequest("ream", "", -2 ** 40, cursor=""),
+                conn_schema.SearchRequest("ream", "hi", 2 ** 40)]:
+        try:
+            codec.BINARY.encode_request(req)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_negotiate():
+    assert codec.negotiate(["binary", "text"]) == "binary"
+    assert codec.negotiate(["zstd", "text"]) == "text"
+    assert codec.negotiate([]) == "text"
+
+
+def DUMMY_ATTEMPT(self):
+    self.primary_identity = consts.MACHINE_A
+    self.iconn = socket(0, 0)
+
+
+def test_old_server_fallback():
+    """
+    A server that doesn't know about codecs answers with an error and the
+    client stays on text
+    """
+    connector = ClientConnector(DUMMY_ATTEMPT)
+    connector.iconn.add_fake_send(
+        conn_schema.Response("", False, "Invalid request type").marshal())
+    connector.negotiate_codec()
+    assert connector.codec == codec.TEXT
+
+
+def test_client_negotiation():
+    """
+    The server switches a client to the codec it picked
+    """
+    conman = ConnectionManager(consts.MACHINE_A)
+    conman.is_primary = True
+    sock = socket(0, 0)
+    conman.client_sockets["client_id"] = sock
+    sock.add_fake_send(conn_schema.CodecRequest("", ["binary", "text"]).marshal())
+    sock.add_fake_send(codec.BINARY.encode_request(conn_schema.CreateRequest("ream")))
+    conman.handle_client("client_id")
+    assert conn_schema.Response.unmarshal(sock.sent[0].decode()).codec == "binary"
+    assert conman.client_requests.get()[2].user_id == "ream"
+
+
+def test_internal_handshake():
+    """
+    Machines that offer codecs get one, machines that don't stay on text
+    """
+    conman = ConnectionManager(consts.MACHINE_A)
+    conman.internal_progress = {"A": 100}
+    listener = socket(0, 0)
+    listener.set_fake_accepts(["B@@1@@binary,text", "C@@6"])
+    conman.listen_internally(listener)
+    assert conman.get_internal_codec("B") == codec.BINARY
+    assert conman.get_internal_codec("C") == codec.TEXT
+
+    conman = ConnectionManager(consts.MACHINE_B)
+    sock = socket(0, 0)
+    sock.add_fake_send("1@@binary")
+    conman.connect_internally("A", 5, sock)
+    assert sock.sent[0].decode() == "B@@5@@binary,text"
+    assert conman.internal_progress["A"] == 1
+    assert conman.get_internal_codec("A") == codec.BINARY
+
+    sock = socket(0, 0)
+    sock.add_fake_send("1")
+    conman.connect_internally("A", 5, sock)
+    assert conman.get_internal_codec("A") == codec.TEXT
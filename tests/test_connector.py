@@ -41,9 +41,14 @@ def test_attempt_connection():
     good_resp = conn_schema.Response("", True, None)
     dummy_sock.add_fake_send(bad_resp.marshal())
     dummy_sock.add_fake_send(good_resp.marshal())
+    # Once connected the client negotiates a codec
+    codec_resp = conn_schema.CodecResponse("", True, "", "binary")
+    dummy_sock.add_fake_send(codec_resp.marshal())
     connector.iconn = None
     connector.attempt_connection(dummy_sock)
     assert connector.ix == 2
+    assert connector.codec.name == "binary"
+    assert dummy_sock.sent[0].decode() == conn_schema.CodecRequest("", consts.CODECS).marshal()
 
 def test_send_request():
     """
@@ -56,6 +61,50 @@ def test_send_request():
     dummy_sock.add_fake_send(resp.marshal())
     assert connector.send_request(req).marshal() == resp.marshal()
 
+def test_send_read():
+    """
+    Reads go to a backup, asking for the newest progress the client has
+    seen, and to the primary if the backup can't serve them
+    """
+    connector = ClientConnector(DUMMY_ATTEMPT, read_from_backups=True)
+    write = conn_schema.Response("ream", True, "")
+    write.progress = 5
+    connector.iconn.add_fake_send(write.marshal())
+    connector.send_request(conn_schema.CreateRequest("ream"))
+    assert connector.progress == 5
+
+    connector.rconn = socket(0, 0)
+    listed = conn_schema.ListResponse("ream", True, "", [data_schema.Account("ream")])
+    listed.progress = 6
+    connector.rconn.add_fake_send(listed.marshal())
+    assert connector.send_request(conn_schema.ListRequest("ream", "", 0)).progress == 6
+    assert conn_schema.Request.unmarshal(connector.rconn.sent[0].decode()).min_progress == 5
+    assert connector.progress == 6
+
+    connector.rconn.add_fake_send(conn_schema.Response("ream", False, "Error: behind").marshal())
+    connector.iconn.add_fake_send(listed.marshal())
+    assert connector.send_request(conn_schema.ListRequest("ream", "", 0)).type == "list"
+    assert len(connector.iconn.sent) == 2
+
+def test_send_read_timeout():
+    """
+    Reads to a backup time out, and one that gets no answer goes to the
+    primary
+    """
+    connector = ClientConnector(DUMMY_ATTEMPT, read_from_backups=True)
+    backup = socket(0, 0)
+    backup.add_fake_send(conn_schema.Response("", False, "").marshal())
+    backup.add_fake_send(conn_schema.CodecResponse("", True, "", "text").marshal())
+    connector.connect_for_reads(backup)
+    assert connector.rconn is backup and backup.timeout == consts.READ_TIMEOUT
+
+    # Nothing comes back from the backup, as when recv times out
+    listed = conn_schema.ListResponse("ream", True, "", [data_schema.Account("ream")])
+    connector.iconn.add_fake_send(listed.marshal())
+    assert connector.send_request(conn_schema.ListRequest("ream", "", 0)).type == "list"
+    assert backup.has_closed and connector.rconn is None
+    assert len(connector.iconn.sent) == 1
+
 def test_watch_chats():
     """
     Ensure that it calls the callback on receiving a message
@@ -68,7 +117,22 @@ def test_watch_chats():
     connector.watch_chats(dummy_sock)
     assert len(dummy_sock.sent) == 1
     assert dummy_sock.has_closed
-    
+
+
+def test_watch_chats_batched():
+    """
+    Batches of chats are answered with one ack each, granting the credit
+    again
+    """
+    connector = ClientConnector(DUMMY_ATTEMPT)
+    dummy_sock = connector.iconn
+    chats = [data_schema.Chat("auth", "recp", f"mess{ix}") for ix in range(3)]
+    dummy_sock.add_fake_send(conn_schema.NotifBatchResponse("recp", True, "", 4, chats).marshal())
+    connector.watch_chats(dummy_sock)
+    ack = conn_schema.Response.unmarshal(dummy_sock.sent[0].decode())
+    assert (ack.type, ack.seq, ack.credit) == ("notifack", 4, consts.NOTIF_CREDIT)
+    assert dummy_sock.has_closed
+
 def test_subscribe():
     """
     Ensure that subscription works as expected, even when server isn't there/ready/primary
@@ -80,6 +144,24 @@ def test_subscribe():
     dummy_sock.add_fake_send(resp.marshal())
     assert not connector.subscribe("client_id")
 
+def test_ping_server():
+    """
+    Pings reuse one connection to the primary's health port, and a broken
+    one is made again before the primary is given up on
+    """
+    connector = ClientConnector(DUMMY_ATTEMPT)
+    dummy_sock = socket(0, 0)
+    for _ in range(2):
+        dummy_sock.add_fake_send(conn_schema.PingResponse().marshal())
+    assert connector.ping_server(dummy_sock)
+    assert connector.ping_server()
+    assert connector.hconn is dummy_sock
+    assert dummy_sock.connected_to == (consts.MACHINE_A.host_ip, consts.MACHINE_A.health_port)
+    assert len(dummy_sock.sent) == 2
+    # The fresh connection doesn't answer either
+    assert not connector.ping_server()
+    assert dummy_sock.has_closed and connector.hconn is None
+
 def test_kill():
     """
     Ensure that it closes the connection
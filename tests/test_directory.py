@@ -0,0 +1,54 @@
+import random
+import directory
+from directory import UserDirectory, make_cursor, read_cursor
+from tests.paging import assert_pages
+
+
+def matching(ids, wildcard):
+    if wildcard.startswith("^"):
+        return sorted(i for i in ids if i.startswith(wildcard[1:]))
+    return sorted(i for i in ids if wildcard in i)
+
+
+def test_matches_scan(monkeypatch):
+    """
+    Every kind of wildcard lists the same ids as testing every one, with
+    chunks split and emptied by creates and deletes along the way
+    """
+    monkeypatch.setattr(directory, "CHUNK_SIZE", 4)
+    rng = random.Random(3)
+    ids = set()
+    while len(ids) < 400:
+        ids.add("".join(rng.choice("abcd") for _ in range(rng.randint(1, 7))))
+    ids = list(ids)
+    users = UserDirectory(ids[:200])
+    for user_id in ids[200:]:
+        users.add(user_id)
+    for user_id in ids[:100]:
+        users.remove(user_id)
+    live = ids[100:]
+    assert len(users) == len(live)
+    assert list(users.ids.iterate()) == sorted(live)
+    for wildcard in ["", "a", "db", "abc", "bcad", "^", "^ab", "^dddd", "zzz", "^z"]:
+        assert_pages(users, wildcard, matching(live, wildcard), sizes=[1, 4, 9])
+
+
+def test_pages_from_cursor():
+    """
+    A page number counts from where the cursor left off
+    """
+    users = UserDirectory(f"user{ix:02}" for ix in range(20))
+    (first, more) = users.page("user", 4, 0, read_cursor(make_cursor("user05")))
+    assert (first, more) == (["user06", "user07", "user08", "user09"], True)
+    assert users.page("^user1", 4, 1, "user11") == (["user16", "user17", "user18", "user19"], False)
+    assert users.page("", 4, -1) == ([], False)
+
+
+def test_grams_forgotten():
+    """
+    Deleting the last id holding an n-gram drops it from the index
+    """
+    users = UserDirectory(["ream", "mark"])
+    users.remove("ream")
+    assert set(users.grams) == {"mar", "ark"}
+    assert users.page("rea", 4) == ([], False)
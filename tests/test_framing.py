@@ -0,0 +1,125 @@
+import gc
+import time
+import struct
+from threading import Thread
+import connections.framing as framing
+from tests.mocks.mock_socket import socket as mock_socket
+
+
+def make_sock():
+    return mock_socket(0, 0)
+
+
+def test_send_message():
+    sock = make_sock()
+    framing.send_message(sock, "hello")
+    framing.send_frame(sock, b"a")
+    assert sock.sent == [b"hello", b"a"]
+
+
+def test_recv_message():
+    sock = make_sock()
+    sock.add_fake_send("hello")
+    sock.add_fake_send("world")
+    assert framing.recv_message(sock) == "hello"
+    assert framing.recv_message(sock) == "world"
+
+
+def test_several_frames_in_one_recv():
+    sock = make_sock()
+    sock.add_fake_bytes(framing.frame(b"one") +
+                        framing.frame(b"two") + framing.frame(b""))
+    assert framing.recv_frame(sock) == b"one"
+    assert framing.recv_frame(sock) == b"two"
+    assert framing.recv_frame(sock) == b""
+
+
+def test_partial_frames():
+    sock = make_sock()
+    raw = framing.frame(b"split across recvs") + framing.frame(b"next")
+    sock.add_fake_bytes(raw[:2])
+    sock.add_fake_bytes(raw[2:9])
+    sock.add_fake_bytes(raw[9:])
+    assert framing.recv_frame(sock) == b"split across recvs"
+    assert framing.recv_frame(sock) == b"next"
+
+
+def test_large_frame():
+    sock = make_sock()
+    payload = bytes(range(256)) * 1000
+    sock.add_fake_send(payload)
+    assert framing.recv_frame(sock) == payload
+
+
+def test_closed_socket():
+    sock = make_sock()
+    sock.add_fake_bytes(b"")
+    assert framing.recv_frame(sock) is None
+    sock.add_fake_bytes(b"")
+    assert framing.recv_message(sock) == ""
+
+
+def test_frame_too_big():
+    sock = make_sock()
+    sock.add_fake_bytes(struct.pack(">I", framing.MAX_FRAME_SIZE + 1))
+    try:
+        framing.recv_frame(sock)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_readers_released():
+    """
+    A socket's reader goes away with the socket
+    """
+    sock = make_sock()
+    sock.add_fake_send("hello")
+    framing.recv_frame(sock)
+    assert sock in framing.readers
+    before = len(framing.readers)
+    del sock
+    gc.collect()
+    assert len(framing.readers) == before - 1
+
+
+class SlowSocket:
+    """
+    A socket whose sendall writes in two halves with a pause in between,
+    the way a real sendall can when the send buffer fills up
+    """
+
+    def __init__(self):
+        self.stream = bytearray()
+
+    def sendall(self, data):
+        half = len(data) // 2
+        self.stream += data[:half]
+        time.sleep(0.0001)
+        self.stream += data[half:]
+
+
+def test_concurrent_sends():
+    """
+    Frames sent from several threads at once come out whole
+    """
+    sock = SlowSocket()
+
+    def sender(name):
+        for ix in range(50):
+            framing.send_message(sock, f"{name}{ix}" * 20)
+    threads = [Thread(target=sender, args=(str(t),)) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reader = framing.FrameReader()
+    reader.buffer = sock.stream
+    received = []
+    while True:
+        payload = reader.next_frame()
+        if payload is None:
+            break
+        received.append(payload.decode())
+    assert sorted(received) == sorted(
+        f"{t}{ix}" * 20 for t in range(4) for ix in range(50))
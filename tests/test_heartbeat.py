@@ -0,0 +1,61 @@
+import math
+import connections.consts as consts
+from connections.heartbeat import PhiAccrualDetector
+
+
+def test_suspicion_grows():
+    """
+    Phi is low right after a heartbeat and grows the longer the next one
+    takes, past the threshold once it is well overdue
+    """
+    detector = PhiAccrualDetector(1, now=0)
+    for now in range(1, 11):
+        detector.heartbeat(now)
+    assert detector.phi(10.5) < 1
+    assert detector.phi(11) < detector.phi(11.2) < detector.phi(11.5)
+    assert not detector.is_suspected(11)
+    assert detector.is_suspected(12)
+
+
+def test_learns_jitter():
+    """
+    A machine whose heartbeats arrive unevenly is given more slack than one
+    that is steady
+    """
+    steady = PhiAccrualDetector(1, now=0)
+    jittery = PhiAccrualDetector(1, now=0)
+    now = 0
+    for ix in range(20):
+        steady.heartbeat(ix + 1)
+        now += 0.5 if ix % 2 else 1.5
+        jittery.heartbeat(now)
+    assert steady.last == jittery.last == 20
+    assert jittery.phi(21.6) < steady.phi(21.6)
+
+
+def test_window():
+    """
+    Only the last window gaps count, so a machine that has slowed down is
+    judged by how it answers now
+    """
+    detector = PhiAccrualDetector(0.1, window=5, min_std=0.01, now=0)
+    now = 0
+    for _ in range(10):
+        now += 0.1
+        detector.heartbeat(now)
+    for _ in range(5):
+        now += 1
+        detector.heartbeat(now)
+    assert len(detector.gaps) == 5
+    assert math.isclose(detector.total, 5)
+    assert not detector.is_suspected(now + 1)
+
+
+def test_bootstrap():
+    """
+    Before any heartbeat arrives the gaps are taken to be the interval
+    """
+    detector = PhiAccrualDetector(consts.HEARTBEAT_INTERVAL, now=0)
+    assert not detector.is_suspected(consts.HEARTBEAT_INTERVAL)
+    assert detector.is_suspected(consts.HEARTBEAT_INTERVAL + 10 * consts.HEARTBEAT_MIN_STD)
+    assert detector.phi(1000) == math.inf
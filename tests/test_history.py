@@ -0,0 +1,93 @@
+import random
+from search import TEXT_INDEXES
+from history import MessageLog, Undelivered, make_log_cursor, read_log_cursor
+from schema import Chat
+from tests.paging import assert_pages
+
+
+def matching(chats, wildcard):
+    return [ix for ix in range(len(chats) - 1, -1, -1) if wildcard in chats[ix].author_id]
+
+
+def test_matches_scan():
+    """
+    Every wildcard lists the same chats, newest first, as testing every one
+    """
+    rng = random.Random(5)
+    authors = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(30)]
+    chats = [Chat(rng.choice(authors), "ream", str(ix)) for ix in range(500)]
+    msg_log = MessageLog("ream", chats[:250])
+    for chat in chats[250:]:
+        msg_log.append(chat)
+    assert len(msg_log) == 500
+    assert [c.text for c in msg_log] == [c.text for c in reversed(chats)]
+    for wildcard in ["", "a", "ab", "cab", "zz"]:
+        assert_pages(msg_log, wildcard, matching(chats, wildcard))
+
+
+def test_page_edges():
+    """
+    Pages past the end or before the start are empty, and cursors round trip
+    """
+    msg_log = MessageLog("ream", (Chat("mark", "ream", str(ix)) for ix in range(5)))
+    assert msg_log.page("", 4) == ([4, 3, 2, 1], True)
+    assert msg_log.page("", 4, 1) == ([0], False)
+    assert msg_log.page("", 4, 2) == ([], False)
+    assert msg_log.page("", 4, -1) == ([], False)
+    assert msg_log.page("ma", 4, 0, before=2) == ([1, 0], False)
+    assert msg_log.page("", 4, 0, before=-3) == ([], False)
+    assert MessageLog("ream").page("", 4) == ([], False)
+    assert [c.text for c in msg_log.oldest(2)] == ["0", "1"]
+    # Authors of a single chat, and a log that never received any
+    msg_log.append(Chat("joe", "ream", "5"))
+    assert msg_log.page("o", 4) == ([5], False)
+    assert msg_log.page("o", 4, 0, before=5) == ([], False)
+    assert [(c.author_id, c.recipient_id, c.text) for c in msg_log.oldest(10)][-1] == ("joe", "ream", "5")
+    assert list(MessageLog("ream")) == [] and MessageLog("ream").search("hi", 4) == ([], False)
+    assert read_log_cursor(make_log_cursor(1234)) == 1234
+    try:
+        read_log_cursor("nope")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_lazy_index():
+    """
+    A log's text index is only built on its first search, then kept up to
+    date with what it receives, until it is dropped
+    """
+    msg_log = MessageLog("ream", [Chat("mark", "ream", "lunch friday"), Chat("mark", "ream", "ok")])
+    assert TEXT_INDEXES.peek(msg_log) is None
+    assert msg_log.search("lunch", 4) == ([0], False)
+    assert TEXT_INDEXES.peek(msg_log) is not None
+    msg_log.append(Chat("joe", "ream", "lunch then"))
+    assert msg_log.search("lunch", 4) == ([2, 0], False)
+    msg_log.drop_index()
+    assert TEXT_INDEXES.peek(msg_log) is None
+    assert msg_log.search("then", 4) == ([2], False)
+    msg_log.drop_index()
+
+
+def test_undelivered():
+    """
+    Undelivered chats are the newest of a log, taken oldest first, and
+    users without any have no entry
+    """
+    msg_log = MessageLog("ream", (Chat("mark", "ream", str(ix)) for ix in range(3)))
+    undelivered = Undelivered()
+    assert (undelivered.count("ream", msg_log), undelivered.take("ream", msg_log, 5)) == (0, [])
+    for ix in range(3, 6):
+        msg_log.append(Chat("mark", "ream", str(ix)))
+        undelivered.add("ream", len(msg_log) - 1)
+    assert undelivered.count("ream", msg_log) == 3
+    assert [c.text for c in undelivered.peek("ream", msg_log)] == ["3", "4", "5"]
+    assert [c.text for c in undelivered.take("ream", msg_log, 2)] == ["3", "4"]
+    # Keeping more than are undelivered never undoes a delivery
+    undelivered.keep("ream", msg_log, 3)
+    assert [c.text for c in undelivered.peek("ream", msg_log)] == ["5"]
+    undelivered.keep("ream", msg_log, 0)
+    assert len(undelivered) == 0 and undelivered.peek("ream", msg_log) == []
+    undelivered.add("ream", 5)
+    undelivered.forget("ream")
+    assert len(undelivered) == 0
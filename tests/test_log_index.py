@@ -0,0 +1,124 @@
+import sys
+sys.path.append("..")
+import os
+import pytest
+import persistence.consts as consts
+import persistence.records as records
+import connections.schema as conn_schema
+from persistence.errors import LogFormatException
+from persistence.log_index import LogIndex
+from persistence.log_writer import LogWriter
+
+
+def write_log(filename, reqs, tail=b""):
+    with open(filename, "wb") as file:
+        file.write(records.file_header())
+        for req in reqs:
+            file.write(records.encode(req))
+        file.write(tail)
+
+
+def test_rebuild(tmp_path):
+    """
+    A missing index gets built from the log
+    """
+    filename = str(tmp_path / "A_log.out")
+    reqs = [
+        conn_schema.CreateRequest("ream"),
+        conn_schema.CreateRequest("mark"),
+        conn_schema.SendRequest("mark", "ream", "hi"),
+    ]
+    write_log(filename, reqs)
+    index = LogIndex(filename)
+    assert os.path.exists(filename + ".idx")
+    assert index.count() == 3
+    assert [r.marshal() for r in index.read(1, 3)] == [r.marshal() for r in reqs[1:]]
+    assert [r.marshal() for r in index.read(2, 100)] == [reqs[2].marshal()]
+    assert index.read(3, 5) == []
+    index.close()
+
+
+def test_blank(tmp_path):
+    """
+    A missing log gets created with just a header
+    """
+    filename = str(tmp_path / "A_log.out")
+    index = LogIndex(filename)
+    assert index.count() == 0
+    with open(filename, "rb") as file:
+        assert file.read() == records.file_header()
+    index.close()
+
+
+def test_stale(tmp_path):
+    """
+    An index that doesn't match the log anymore gets rebuilt
+    """
+    filename = str(tmp_path / "A_log.out")
+    write_log(filename, [conn_schema.CreateRequest("ream")])
+    LogIndex(filename).close()
+    # Log grew behind the index's back
+    write_log(filename, [conn_schema.CreateRequest("ream"), conn_schema.CreateRequest("mark")])
+    index = LogIndex(filename)
+    assert index.count() == 2
+    index.close()
+    # Log got truncated behind the index's back
+    write_log(filename, [])
+    index = LogIndex(filename)
+    assert index.count() == 0
+    index.close()
+
+
+def test_torn_tail(tmp_path):
+    """
+    A partially written last record gets truncated instead of crashing
+    """
+    filename = str(tmp_path / "A_log.out")
+    good = [conn_schema.CreateRequest("ream")]
+    torn = records.encode(conn_schema.SendRequest("ream", "ream", "cut off"))[:-3]
+    write_log(filename, good, torn)
+    index = LogIndex(filename)
+    assert index.count() == 1
+    assert os.path.getsize(filename) == index.end
+    index.close()
+
+    # So does a complete record that fails its checksum
+    corrupt = bytearray(records.encode(conn_schema.CreateRequest("mark")))
+    corrupt[-1] ^= 0xFF
+    write_log(filename, good, bytes(corrupt))
+    index = LogIndex(filename)
+    assert index.count() == 1
+    index.close()
+
+
+def test_text_log(tmp_path):
+    """
+    Old text logs are refused rather than misread
+    """
+    filename = str(tmp_path / "A_log.out")
+    with open(filename, "w") as file:
+        file.write("ream@@create\n")
+    with pytest.raises(LogFormatException):
+        LogIndex(filename)
+
+
+def test_maintained_by_writer(tmp_path):
+    """
+    The log writer keeps the index up to date as it commits, and a
+    reopened index is trusted without a rebuild
+    """
+    filename = str(tmp_path / "A_log.out")
+    write_log(filename, [conn_schema.CreateRequest("ream")])
+    index = LogIndex(filename)
+    writer = LogWriter(filename, durability=consts.DURABILITY_BUFFERED, index=index)
+    for ix in range(10):
+        writer.append(records.encode(conn_schema.CreateRequest(f"user{ix}")))
+    writer.flush()
+    assert index.count() == 11
+    assert index.read(10, 11)[0].user_id == "user9"
+    writer.close()
+    index.close()
+
+    reopened = LogIndex(filename)
+    assert reopened.offsets == index.offsets
+    reopened.close()
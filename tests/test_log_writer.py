@@ -0,0 +1,93 @@
+import sys
+sys.path.append("..")
+import pytest
+import persistence.consts as consts
+import persistence.records as records
+import connections.schema as conn_schema
+from persistence.log_writer import LogWriter
+from persistence.errors import LogWriteException
+from threading import Thread
+
+
+def test_append(tmp_path):
+    """
+    Appended records end up in the file, in order
+    """
+    filename = str(tmp_path / "test_log.out")
+    open(filename, "w").close()
+    writer = LogWriter(filename, durability=consts.DURABILITY_FSYNC)
+    first = records.encode(conn_schema.CreateRequest("ream"))
+    second = records.encode(conn_schema.CreateRequest("mark"))
+    writer.append(first)
+    writer.append(second)
+    with open(filename, "rb") as file:
+        assert file.read() == first + second
+    writer.close()
+
+
+def test_group_commit(tmp_path):
+    """
+    Appends from many threads get coalesced and every record is accounted
+    for in the commit sizes
+    """
+    filename = str(tmp_path / "test_log.out")
+    open(filename, "w").close()
+    sizes = []
+    writer = LogWriter(filename, durability=consts.DURABILITY_FSYNC,
+                       batch_window=0.01, on_commit=sizes.append)
+
+    def appender(name):
+        for ix in range(25):
+            writer.append(records.encode(
+                conn_schema.CreateRequest(f"{name}{ix}")))
+    threads = [Thread(target=appender, args=(str(t),)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+    assert sum(sizes) == 200
+    assert len(sizes) < 200
+    assert writer.stats()["records"] == 200
+    with open(filename, "rb") as file:
+        assert len(records.decode_all(file.read(), 0)) == 200
+
+
+def test_buffered(tmp_path):
+    """
+    Buffered appends return right away, flush waits for them to land
+    """
+    filename = str(tmp_path / "test_log.out")
+    open(filename, "w").close()
+    writer = LogWriter(filename, durability=consts.DURABILITY_BUFFERED)
+    for ix in range(10):
+        writer.append(records.encode(conn_schema.CreateRequest(f"user{ix}")))
+    writer.flush()
+    assert writer.committed == 10
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.append(records.encode(conn_schema.CreateRequest("late")))
+
+
+def test_bad_durability(tmp_path):
+    """
+    Unknown durability modes are rejected
+    """
+    with pytest.raises(ValueError):
+        LogWriter(str(tmp_path / "test_log.out"), durability="whenever")
+
+
+def test_write_error(tmp_path):
+    """
+    If the writer thread fails, waiters and later appends get the error
+    instead of hanging
+    """
+    filename = str(tmp_path / "test_log.out")
+    writer = LogWriter(filename, durability=consts.DURABILITY_FSYNC)
+    writer.file.close()  # Every write will now fail
+    with pytest.raises(LogWriteException):
+        writer.append(records.encode(conn_schema.CreateRequest("ream")))
+    with pytest.raises(LogWriteException):
+        writer.append(records.encode(conn_schema.CreateRequest("mark")))
+    writer.close()
@@ -2,10 +2,19 @@ import sys
 sys.path.append("..")
 import connections.schema as conn_schema
 import connections.consts as consts
+import connections.framing as framing
 import schema as data_schema
-from tests.mocks.mock_socket import socket
+from tests.mocks.mock_socket import socket, socketpair
 from connections.manager import ConnectionManager
+from connections.heartbeat import PhiAccrualDetector
+from persistence.errors import CompactedRangeException
 from queue import Queue
+import threading
+import time
+import asyncio.base_events
+
+# Real sockets, see test_async_manager.py
+real_socket = asyncio.base_events.socket
 
 
 A = consts.MACHINE_A
@@ -47,6 +56,8 @@ def test_initialize():
     conman.listen_health = DUMMY_FUNC
     conman.probe_health = DUMMY_FUNC
     conman.listen_externally = DUMMY_FUNC
+    conman.find_running_siblings = lambda: []
+    conman.listen_rejoins = DUMMY_FUNC
     conman.initialize(progress, DUMMY_FUNC)
     
     assert conman.internal_progress["A"] == progress
@@ -106,27 +117,144 @@ def test_listen_health():
     assert dummy_sock.binded_to == (A.host_ip, A.health_port)
     assert dummy_sock.has_listened
 
-def test_probe_health():
+def test_check_siblings():
     """
-    Tests that machines ping each other and correctly adapt
+    Tests that machines take the siblings they stop hearing from for dead
+    and correctly adapt
     """
     conman = ConnectionManager(A)
-    dummy_sock = socket(0, 0)
     conman.living_siblings = [B]
-    
-    # Without config, B should appear dead and be removed
-    conman.probe_health(dummy_sock)
+    conman.detectors["B"] = PhiAccrualDetector(consts.HEARTBEAT_INTERVAL, now=0)
+
+    # B was just heard from, so it stays
+    conman.check_siblings(0.1)
+    assert conman.living_siblings == [B]
+
+    # Without heartbeats, B should appear dead and be removed
+    conman.check_siblings(10)
     assert conman.is_primary
     assert conman.living_siblings == []
-    
+    assert "B" not in conman.detectors
+
     # From B's perspective, it should also claim primary
     conmanB = ConnectionManager(B)
-    duummy_sock = socket(0, 0)
     conmanB.living_siblings = [A]
-    conmanB.probe_health(dummy_sock)
+    conmanB.detectors["A"] = PhiAccrualDetector(consts.HEARTBEAT_INTERVAL, now=0)
+    conmanB.check_siblings(10)
     assert conmanB.is_primary
     assert conmanB.living_siblings == []
 
+def test_heartbeat(monkeypatch):
+    """
+    Pings go over one connection until it fails, every answer feeds the
+    detector, and the heartbeat stops once the sibling is taken for dead
+    """
+    monkeypatch.setattr(consts, "HEARTBEAT_INTERVAL", 0.01)
+    conman = ConnectionManager(A)
+    conman.living_siblings = [B]
+    detector = PhiAccrualDetector(consts.HEARTBEAT_INTERVAL, now=0)
+    conman.detectors["B"] = detector
+    dummy_sock = socket(0, 0)
+    for _ in range(3):
+        dummy_sock.add_fake_send(conn_schema.PingResponse().marshal())
+    beat = threading.Thread(target=conman.heartbeat, args=(B, detector, dummy_sock))
+    beat.start()
+    deadline = time.time() + 5
+    while not dummy_sock.has_closed:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    conman.stop_watching("B")
+    beat.join(5)
+    assert not beat.is_alive()
+    assert dummy_sock.connected_to == (B.host_ip, B.health_port)
+    assert len(dummy_sock.sent) == 4  # The last one went unanswered
+    assert len(detector.gaps) == 4
+
+def test_answer_health():
+    """
+    A health check connection gets every ping answered until it closes
+    """
+    conman = ConnectionManager(A)
+    (mine, theirs) = real_socket.socketpair()
+    answer = threading.Thread(target=conman.answer_health, args=(mine,))
+    answer.start()
+    for _ in range(3):
+        framing.send_message(theirs, conn_schema.PingResponse().marshal())
+        assert conn_schema.Response.unmarshal(framing.recv_message(theirs)).type == "ping"
+    theirs.close()
+    answer.join(5)
+    assert not answer.is_alive()
+
+def test_rejoined_rank():
+    """
+    Machines that rejoined rank after the others, in the order they rejoined
+    """
+    assert consts.get_primary(["C", "B", "A"]) == "A"
+    assert consts.get_primary(["C", "B", "A"], ["A"]) == "B"
+    assert consts.get_primary(["A", "C"], ["C", "A"]) == "C"
+    assert consts.should_i_be_primary("C", [A, B], ["A", "B"])
+    assert not consts.should_i_be_primary("A", [C], ["C", "A"])
+
+def test_greet_rejoin():
+    """
+    A machine that rejoins is told the order machines rejoined in, itself last
+    """
+    conman = ConnectionManager(A)
+    conman.internal_progress["A"] = 9
+    conman.rejoined = ["C"]
+    dummy_sock = socket(0, 0)
+    dummy_sock.add_fake_send("B@@2@@binary,text@@rejoin")
+    assert conman.greet_sibling(dummy_sock) == "B"
+    assert dummy_sock.sent[0].decode() == "9@@binary@@C,B"
+    assert conman.internal_progress["B"] == 2
+
+    conmanB = ConnectionManager(B)
+    conmanB.rejoined = ["B"]
+    dummy_sock = socket(0, 0)
+    dummy_sock.add_fake_send("9@@binary@@C,B")
+    conmanB.connect_internally("A", 2, dummy_sock, rejoin=True)
+    assert dummy_sock.sent[0].decode() == "B@@2@@binary,text@@rejoin"
+    assert conmanB.rejoined == ["C", "B"]
+
+def test_catch_up_rejoiner():
+    """
+    Records logged while a rejoining machine is caught up reach it after
+    the catch up stream, it is only taken back once caught up, and only
+    counts for commit levels once it acks having logged records
+    """
+    log = [conn_schema.CreateRequest(f"user{i}") for i in range(1000)]
+    conmanA = ConnectionManager(A)
+    conmanA.is_primary = True
+    conmanA.living_siblings = [C]
+    conmanA.internal_sockets["C"] = socket(0, 0)
+    (leader_end, rejoiner_end) = socketpair()
+    conmanA.internal_sockets["B"] = leader_end
+    conmanA.get_reqs_by_progress = lambda low, high: log[low:high]
+    def at_log_position(func):
+        found = func(len(log))
+        # Logged right after replication to B started, but before B is caught up
+        assert [sib.name for sib in conmanA.living_siblings] == ["C"]
+        conmanA.broadcast_to_backups(conn_schema.CreateRequest("live"), len(log) + 1)
+        return found
+    conmanA.at_log_position = at_log_position
+
+    conmanB = ConnectionManager(B)
+    conmanB.internal_sockets = {"A": rejoiner_end}
+    receiver = threading.Thread(target=conmanB.receive_catchup, args=("A",))
+    receiver.start()
+    assert conmanA.catch_up_rejoiner("B", 10)
+    receiver.join(timeout=10)
+    assert [sib.name for sib in conmanA.living_siblings] == ["C", "B"]
+    # Acks of the stream say nothing about what B applied
+    assert conmanA.count_acks(len(log)) == 0
+    conmanA.record_ack("B", len(log))
+    assert conmanA.count_acks(len(log)) == 1
+    live = conn_schema.Request.unmarshal(framing.recv_message(rejoiner_end))
+    assert live.user_id == "live"
+    reqs = list(conmanB.internal_requests.queue)
+    assert [req.user_id for req in reqs] == [req.user_id for req in log[10:]]
+    conmanA.kill()
+
 def test_connect_internally():
     """
     Makes sure that a machine connects to another machine
@@ -193,9 +321,11 @@ def test_play_catchup():
         "A": socket(0, 0),
         "B": socket(0, 0)
     }
+    for sock in conmanC.internal_sockets.values():
+        sock.add_fake_send("ping")
     conmanC.play_catchup(get_reqs_star)
-    assert get_reqs_Q.get() == (1, 3)
-    assert get_reqs_Q.get() == (2, 3)
+    assert {get_reqs_Q.get(), get_reqs_Q.get()} == {(1, 3), (2, 3)}
+    assert conmanC.internal_sockets["A"].sent[0] == b"catchup@@2@@0@@512@@records@@0@@{}"
 
     # A should catch up and receive 2 requests
     Csock = socket(0, 0)
@@ -204,12 +334,132 @@ def test_play_catchup():
     }
     dummy_req1 = conn_schema.Request("user_id")
     dummy_req2 = conn_schema.Request("user_id")
+    Csock.add_fake_send("catchup@@2@@0@@512@@records@@0@@{}")
     Csock.add_fake_send(dummy_req1.marshal())
     Csock.add_fake_send(dummy_req2.marshal())
     conmanA.play_catchup(get_reqs_star)
     assert conmanA.internal_requests.get().marshal() == dummy_req1.marshal()
     assert conmanA.internal_requests.get().marshal() == dummy_req2.marshal()
-    assert len(Csock.sent) == 2
+    assert len(Csock.sent) == 1  # One ack for the whole batch
+
+def test_play_catchup_streams():
+    """
+    The leader streams to every machine behind it at once, in batches,
+    and each ends up with exactly the records it was missing
+    """
+    log = [conn_schema.CreateRequest(f"user{i}") for i in range(3000)]
+    def get_reqs(low, high):
+        return log[low:high]
+    progress_map = {"A": 3000, "B": 0, "C": 2990}
+    conmanA = ConnectionManager(A)
+    conmanA.internal_progress = progress_map
+    followers = []
+    for (machine, name) in [(B, "B"), (C, "C")]:
+        (leader_end, follower_end) = socketpair()
+        conmanA.internal_sockets[name] = leader_end
+        follower = ConnectionManager(machine)
+        follower.internal_progress = progress_map
+        follower.internal_sockets = {"A": follower_end}
+        followers.append(follower)
+    threads = [threading.Thread(target=f.play_catchup, args=(DUMMY_FUNC,)) for f in followers]
+    for thread in threads:
+        thread.start()
+    conmanA.play_catchup(get_reqs)
+    for thread in threads:
+        thread.join(timeout=10)
+    (B_reqs, C_reqs) = [list(f.internal_requests.queue) for f in followers]
+    assert [req.user_id for req in B_reqs] == [req.user_id for req in log]
+    assert [req.user_id for req in C_reqs] == [req.user_id for req in log[2990:]]
+    # Six batches of records for B, and B acked every one of them
+    assert len(conmanA.internal_sockets["B"].sent) == 1 + 3000
+    assert len(followers[0].internal_sockets["A"].sent) == 6
+    assert [sib.name for sib in conmanA.living_siblings] == ["B", "C"]
+
+def test_play_catchup_level():
+    """
+    A machine that isn't behind is sent nothing, it doesn't wait for a header
+    """
+    conmanA = ConnectionManager(A)
+    conmanA.internal_progress = {"A": 5, "B": 5}
+    dummy_sock = socket(0, 0)
+    conmanA.internal_sockets = {"B": dummy_sock}
+    conmanA.play_catchup(DUMMY_FUNC)
+    assert dummy_sock.sent == []
+
+def test_play_catchup_compacted():
+    """
+    A machine with an empty log gets the leader's compacted records as a
+    whole, then the rest one by one
+    """
+    progress_map = {"A": 0, "C": 9}
+    conmanC = ConnectionManager(C)
+    conmanC.internal_progress = progress_map
+    Asock = socket(0, 0)
+    conmanC.internal_sockets = {"A": Asock}
+    (get_reqs_Q, get_reqs_F) = QUEUE_FUNC()
+    def get_reqs(*args):
+        get_reqs_F(*args)
+        return [conn_schema.NotifRequest("ream")]
+    Asock.add_fake_send("ping")
+    conmanC.play_catchup(get_reqs, lambda: (8, b"compacted", {"ream": 1}))
+    assert get_reqs_Q.get() == (8, 9)
+    assert Asock.sent[0].decode() == 'catchup@@1@@8@@512@@records@@0@@{"ream": 1}'
+    assert Asock.sent[1] == b"compacted"
+
+    conmanA = ConnectionManager(A)
+    conmanA.internal_progress = progress_map
+    Csock = socket(0, 0)
+    conmanA.internal_sockets = {"C": Csock}
+    for frame in Asock.sent:
+        Csock.add_fake_send(frame)
+    (install_Q, install_F) = QUEUE_FUNC()
+    conmanA.play_catchup(DUMMY_FUNC, None, install_F)
+    assert install_Q.get() == (b"compacted", 8, {"ream": 1})
+    assert conmanA.internal_requests.get().type == "notif"
+
+def test_play_catchup_snapshot():
+    """
+    A machine too far behind, or behind the leader's compaction, gets the
+    leader's snapshot and only the records after it
+    """
+    progress_map = {"A": 10, "C": 200010}
+    conmanC = ConnectionManager(C)
+    conmanC.internal_progress = progress_map
+    Asock = socket(0, 0)
+    conmanC.internal_sockets = {"A": Asock}
+    (get_reqs_Q, get_reqs_F) = QUEUE_FUNC()
+    def get_reqs(*args):
+        get_reqs_F(*args)
+        return [conn_schema.NotifRequest("ream")] * (args[1] - args[0])
+    Asock.add_fake_send("ping")
+    conmanC.play_catchup(get_reqs, None, None, lambda: (200009, b"state"))
+    assert get_reqs_Q.get() == (200009, 200010)
+    assert Asock.sent[0] == b"catchup@@1@@200009@@512@@snapshot@@0@@{}"
+    assert Asock.sent[1] == b"state"
+
+    conmanA = ConnectionManager(A)
+    conmanA.internal_progress = progress_map
+    Csock = socket(0, 0)
+    conmanA.internal_sockets = {"C": Csock}
+    for frame in Asock.sent:
+        Csock.add_fake_send(frame)
+    (install_Q, install_F) = QUEUE_FUNC()
+    conmanA.play_catchup(DUMMY_FUNC, None, None, None, install_F)
+    assert install_Q.get() == (b"state", 200009)
+    assert conmanA.internal_requests.get().type == "notif"
+
+    # Close behind, but behind the compaction
+    progress_map = {"A": 10, "C": 30}
+    conmanC = ConnectionManager(C)
+    conmanC.internal_progress = progress_map
+    conmanC.internal_sockets = {"A": socket(0, 0)}
+    conmanC.internal_sockets["A"].add_fake_send("ping")
+    def get_compacted(low, high):
+        if low < 20:
+            raise CompactedRangeException(low, 20)
+        return [conn_schema.NotifRequest("ream")] * (high - low)
+    conmanC.play_catchup(get_compacted, None, None, lambda: (25, b"state"))
+    assert conmanC.internal_sockets["A"].sent[0] == b"catchup@@5@@25@@512@@snapshot@@0@@{}"
 
 def test_handle_client():
     """
@@ -235,6 +485,15 @@ def test_handle_client():
     conman.handle_client("client_id")
     assert b"Not primary" in dummy_sock.sent[0]
 
+    # Backups serve reads
+    dummy_sock = socket(0, 0)
+    conman.client_sockets["client_id"] = dummy_sock
+    dummy_sock.add_fake_send(conn_schema.LogsRequest("client_id", "", 0, 4).marshal())
+    conman.handle_client("client_id")
+    (name, req) = conman.read_requests.get()
+    assert (name, req.type, req.min_progress) == ("client_id", "logs", 4)
+    assert dummy_sock.sent == []
+
 def test_broadcast_to_backups():
     """
     Tests that requests get sent to backups
@@ -248,10 +507,110 @@ def test_broadcast_to_backups():
         "B": dummy_sock1,
         "C": dummy_sock2
     }
+    conman.term = 3
     dummy_req = conn_schema.Request("user_id")
-    conman.broadcast_to_backups(dummy_req)
-    assert dummy_sock1.sent[0].decode() == dummy_req.marshal()
-    assert dummy_sock2.sent[0].decode() == dummy_req.marshal()
+    conman.broadcast_to_backups(dummy_req, 1)
+    conman.flush_backups(timeout=5)
+    assert dummy_sock1.sent[0].decode() == conn_schema.Request.marshal_entry(dummy_req, 1, 3)
+    assert dummy_sock2.sent[0].decode() == conn_schema.Request.marshal_entry(dummy_req, 1, 3)
+    replicated = conn_schema.Request.unmarshal(dummy_sock1.sent[0].decode())
+    assert (replicated.user_id, replicated.lsn, replicated.term) == ("user_id", 1, 3)
+    assert conman.replication_status()["B"]["lag"] == 1
+    # Fallover isn't logged, so it goes out without a position
+    conman.broadcast_to_backups(conn_schema.FalloverRequest("user_id"), 1)
+    deadline = time.time() + 5
+    while len(dummy_sock1.sent) < 2:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert dummy_sock1.sent[1] == b"user_id@@fallover"
+    conman.kill()
+
+def test_catchup_lsns():
+    """
+    Catch up records carry their position in the leader's log, and the
+    header carries the leader's term
+    """
+    log = [conn_schema.CreateRequest(f"user{i}") for i in range(20)]
+    conmanA = ConnectionManager(A)
+    conmanA.term = 2
+    (leader_end, follower_end) = socketpair()
+    conmanA.internal_sockets["B"] = leader_end
+    conmanB = ConnectionManager(B)
+    conmanB.internal_sockets = {"A": follower_end}
+    receiver = threading.Thread(target=conmanB.receive_catchup, args=("A",))
+    receiver.start()
+    assert conmanA.stream_catchup("B", 7, 20, lambda low, high: log[low:high])
+    receiver.join(timeout=10)
+    reqs = list(conmanB.internal_requests.queue)
+    assert [req.lsn for req in reqs] == list(range(8, 21))
+    assert {req.term for req in reqs} == {2}
+    assert conmanB.term == 2
+
+def test_observe_term():
+    """
+    Terms only go up, records from an older one are refused
+    """
+    conman = ConnectionManager(B)
+    assert conman.observe_term(2)
+    assert conman.observe_term(2)
+    assert not conman.observe_term(1)
+    assert conman.term == 2
+
+def test_acks():
+    """
+    Acks from backups are recorded against their sender and never reach
+    the request loop, and backups ack to the primary only
+    """
+    conman = ConnectionManager(A)
+    conman.is_primary = True
+    conman.living_siblings = [B]
+    dummy_sock = socket(0, 0)
+    conman.internal_sockets = {"B": dummy_sock}
+    conman.broadcast_to_backups(conn_schema.CreateRequest("ream"), 4)
+    dummy_sock.add_fake_send(conn_schema.AckRequest("B", 4).marshal())
+    conman.consume_internally(dummy_sock, name="B")
+    assert conman.internal_requests.empty()
+    assert conman.replication_status()["B"]["lag"] == 0
+    assert conman.replication_status()["B"]["acked"] == 4
+    conman.kill()
+
+    backup = ConnectionManager(C)
+    backup.living_siblings = [A, B]
+    primary_sock = socket(0, 0)
+    backup.internal_sockets = {"A": primary_sock, "B": socket(0, 0)}
+    ack_thread = threading.Thread(target=backup.ack_loop)
+    ack_thread.start()
+    backup.acknowledge(3)
+    backup.acknowledge(7)
+    deadline = time.time() + 5
+    while not primary_sock.sent or b"@@7" not in primary_sock.sent[-1]:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    backup.kill()
+    ack_thread.join()
+    acks = [conn_schema.Request.unmarshal(sent.decode()) for sent in primary_sock.sent]
+    assert {ack.type for ack in acks} == {"ack"}
+    assert [ack.progress for ack in acks][-1] == 7
+    assert backup.internal_sockets["B"].sent == []
+
+def test_wait_for_replication():
+    """
+    quorum needs a majority of all machines, all needs every living one,
+    and a backup that goes away stops counting
+    """
+    conman = ConnectionManager(A)
+    conman.is_primary = True
+    conman.living_siblings = [B, C]
+    conman.internal_sockets = {"B": socket(0, 0), "C": socket(0, 0)}
+    conman.broadcast_to_backups(conn_schema.CreateRequest("ream"), 1)
+    assert conman.wait_for_replication(1, consts.COMMIT_PRIMARY, timeout=0)
+    assert not conman.wait_for_replication(1, consts.COMMIT_QUORUM, timeout=0.05)
+    conman.record_ack("B", 1)
+    assert conman.wait_for_replication(1, consts.COMMIT_QUORUM, timeout=0)
+    assert not conman.wait_for_replication(1, consts.COMMIT_ALL, timeout=0.05)
+    threading.Timer(0.05, conman.drop_backup, args=("C",)).start()
+    assert conman.wait_for_replication(1, consts.COMMIT_ALL, timeout=5)
+    conman.kill()
 
 def test_send_response():
     """
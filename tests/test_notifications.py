@@ -0,0 +1,230 @@
+import time
+import threading
+import asyncio.base_events
+from queue import Queue, Empty
+import connections.schema as conn_schema
+import connections.consts as consts
+import connections.framing as framing
+from connections.notifications import NotifDispatcher
+from schema import Chat
+
+# Real sockets, see test_async_manager.py
+real_socket = asyncio.base_events.socket
+
+
+def make_dispatcher(serving=lambda: True):
+    """
+    A dispatcher without a thread or a listening socket, driven with
+    run_once. Returns it with the chats queued per user and the batches
+    logged as delivered.
+    """
+    queues = {"ream": Queue(), "mark": Queue()}
+    delivered = []
+
+    def next_chats(user_id, limit):
+        chats = []
+        try:
+            while len(chats) < limit:
+                chats.append(queues[user_id].get_nowait())
+        except Empty:
+            pass
+        return chats
+    return (NotifDispatcher(consts.MACHINE_A, next_chats, delivered.extend, serving), queues, delivered)
+
+
+def subscribe(dispatcher, greeting):
+    (mine, theirs) = real_socket.socketpair()
+    dispatcher.add_subscriber(mine)
+    framing.send_message(theirs, greeting)
+    dispatcher.run_once(1)
+    return (theirs, conn_schema.Response.unmarshal(framing.recv_message(theirs)))
+
+
+def test_delivery():
+    """
+    Clients that don't advertise credit get chats one at a time, each
+    logged before it is sent, and the next one only once they answered
+    """
+    (dispatcher, queues, delivered) = make_dispatcher()
+    (ream, resp) = subscribe(dispatcher, "ream")
+    assert resp.success and dispatcher.is_subscribed("ream")
+    for text in ["one", "two"]:
+        queues["ream"].put(Chat("mark", "ream", text))
+    dispatcher.wake("ream")
+    dispatcher.run_once(1)
+    assert delivered == [("ream", 1)]
+    notif = conn_schema.Response.unmarshal(framing.recv_message(ream))
+    assert notif.type == "notif" and notif.chat.text == "one"
+    dispatcher.run_once(0.1)
+    assert delivered == [("ream", 1)]  # Not answered yet
+    framing.send_message(ream, conn_schema.PingResponse().marshal())
+    dispatcher.run_once(1)
+    assert delivered == [("ream", 1), ("ream", 1)]
+    assert conn_schema.Response.unmarshal(framing.recv_message(ream)).chat.text == "two"
+    ream.close()
+    dispatcher.stop()
+
+
+def test_batched_delivery():
+    """
+    Clients that advertise credit get what is queued in batches that fit
+    in it, one log record per batch, and acks free the window
+    """
+    (dispatcher, queues, delivered) = make_dispatcher()
+    for ix in range(5):
+        queues["ream"].put(Chat("mark", "ream", f"msg{ix}"))
+    (ream, resp) = subscribe(dispatcher, "ream@@2")
+    assert resp.success
+    dispatcher.run_once(0.1)
+    first = conn_schema.Response.unmarshal(framing.recv_message(ream))
+    assert (first.type, first.seq, [c.text for c in first.msgs]) == ("notifs", 1, ["msg0", "msg1"])
+    assert delivered == [("ream", 2)]
+    # The window is full until the client acks, and then it can grow
+    dispatcher.run_once(0.1)
+    assert delivered == [("ream", 2)]
+    framing.send_message(ream, conn_schema.NotifAckResponse("ream", 1, 10).marshal())
+    dispatcher.run_once(1)
+    second = conn_schema.Response.unmarshal(framing.recv_message(ream))
+    assert (second.seq, [c.text for c in second.msgs]) == (2, ["msg2", "msg3", "msg4"])
+    assert delivered == [("ream", 2), ("ream", 3)]
+    # Chats queued while a batch is out still fit in the window
+    queues["ream"].put(Chat("mark", "ream", "late"))
+    dispatcher.wake("ream")
+    dispatcher.run_once(1)
+    third = conn_schema.Response.unmarshal(framing.recv_message(ream))
+    assert (third.seq, [c.text for c in third.msgs]) == (3, ["late"])
+    # One cumulative ack answers both
+    framing.send_message(ream, conn_schema.NotifAckResponse("ream", 3, 10).marshal())
+    dispatcher.run_once(1)
+    assert dispatcher.subscribers["ream"].in_flight == 0
+    ream.close()
+    dispatcher.stop()
+
+
+def test_credit_limits(monkeypatch):
+    """
+    The server grants no more than NOTIF_MAX_CREDIT, however much a client
+    advertises, and turns away a credit that isn't a number
+    """
+    monkeypatch.setattr(consts, "NOTIF_MAX_CREDIT", 3)
+    (dispatcher, queues, delivered) = make_dispatcher()
+    for ix in range(5):
+        queues["ream"].put(Chat("mark", "ream", f"msg{ix}"))
+    (ream, resp) = subscribe(dispatcher, "ream@@1000000")
+    assert resp.success and dispatcher.subscribers["ream"].credit == 3
+    dispatcher.run_once(0.1)
+    assert delivered == [("ream", 3)]
+    framing.recv_message(ream)
+    framing.send_message(ream, conn_schema.NotifAckResponse("ream", 1, 10 ** 9).marshal())
+    dispatcher.run_once(1)
+    assert dispatcher.subscribers["ream"].credit == 3
+    (mark, resp) = subscribe(dispatcher, "mark@@lots")
+    assert not resp.success and resp.error_message == "Invalid credit"
+    assert not dispatcher.is_subscribed("mark")
+    ream.close()
+    mark.close()
+    dispatcher.stop()
+
+
+def test_slow_subscriber():
+    """
+    A client that stops reading only fills its own outbox, the others keep
+    getting their chats, and it gets the rest once it reads again
+    """
+    (dispatcher, queues, delivered) = make_dispatcher()
+    (ream, _) = subscribe(dispatcher, "ream@@200")
+    (mark, _) = subscribe(dispatcher, "mark@@1")
+    for ix in range(200):
+        queues["ream"].put(Chat("mark", "ream", f"{ix}" * 5000))
+    dispatcher.wake("ream")
+    dispatcher.run_once(1)
+    slow = dispatcher.subscribers["ream"]
+    assert delivered == [("ream", 200)] and len(slow.outbox) > 0
+    queues["mark"].put(Chat("ream", "mark", "hi"))
+    dispatcher.wake("mark")
+    dispatcher.run_once(1)
+    assert conn_schema.Response.unmarshal(framing.recv_message(mark)).msgs[0].text == "hi"
+    # Reading again lets the rest of the batch out
+    received = []
+    reader = threading.Thread(target=lambda: received.append(framing.recv_message(ream)))
+    reader.start()
+    deadline = time.time() + 5
+    while slow.outbox:
+        assert time.time() < deadline
+        dispatcher.run_once(0.05)
+    reader.join(timeout=5)
+    assert len(conn_schema.Response.unmarshal(received[0]).msgs) == 200
+    ream.close()
+    mark.close()
+    dispatcher.stop()
+
+
+def test_one_subscriber_per_user():
+    """
+    A second client for the same user is turned away, and a user can
+    subscribe again once their client is gone
+    """
+    (dispatcher, _, _) = make_dispatcher()
+    (first, resp) = subscribe(dispatcher, "ream")
+    assert resp.success
+    (second, resp) = subscribe(dispatcher, "ream")
+    assert not resp.success and resp.error_message == "Already logged in"
+    first.close()
+    dispatcher.run_once(1)
+    assert not dispatcher.is_subscribed("ream")
+    (third, resp) = subscribe(dispatcher, "ream")
+    assert resp.success
+    second.close()
+    third.close()
+    dispatcher.stop()
+
+
+def test_backups_refuse_subscriptions():
+    """
+    Only the primary takes subscriptions and delivers, so a backup never
+    logs a delivery of its own
+    """
+    primary = [False]
+    (dispatcher, queues, delivered) = make_dispatcher(lambda: primary[0])
+    (first, resp) = subscribe(dispatcher, "ream")
+    assert not resp.success and resp.error_message == "Not the primary"
+    assert not dispatcher.is_subscribed("ream")
+    primary[0] = True
+    (second, resp) = subscribe(dispatcher, "ream")
+    assert resp.success
+    primary[0] = False
+    queues["ream"].put(Chat("mark", "ream", "one"))
+    dispatcher.wake("ream")
+    dispatcher.run_once(0.1)
+    assert delivered == [] and queues["ream"].qsize() == 1
+    first.close()
+    second.close()
+    dispatcher.stop()
+
+
+def test_liveness(monkeypatch):
+    """
+    Idle subscribers get pinged, and are dropped when they don't answer
+    """
+    monkeypatch.setattr(consts, "NOTIF_CHECK_IN", 0.05)
+    monkeypatch.setattr(consts, "NOTIF_TIMEOUT", 0.05)
+    (dispatcher, _, _) = make_dispatcher()
+    (ream, _) = subscribe(dispatcher, "ream")
+    (mark, _) = subscribe(dispatcher, "mark")
+    deadline = time.time() + 5
+    while dispatcher.is_subscribed("mark"):
+        assert time.time() < deadline
+        dispatcher.run_once(0.05)
+        ream.setblocking(False)
+        try:
+            # ream answers every ping, mark never does
+            framing.recv_frame(ream)
+            framing.send_message(ream, conn_schema.PingResponse().marshal())
+        except BlockingIOError:
+            pass
+        ream.setblocking(True)
+    assert dispatcher.is_subscribed("ream")
+    assert conn_schema.Response.unmarshal(framing.recv_message(mark)).type == "ping"
+    ream.close()
+    mark.close()
+    dispatcher.stop()
@@ -0,0 +1,94 @@
+import os
+import sys
+sys.path.append("..")
+import connections.schema as conn_schema
+import persistence.records as records
+import persistence.migrate as migrate
+from persistence.migrate import convert, replay_binary
+
+
+def test_round_trip():
+    """
+    Every loggable request survives encoding, including text the old
+    format couldn't hold
+    """
+    reqs = [
+        conn_schema.CreateRequest("ream"),
+        conn_schema.SendRequest("mark", "ream", "a@@b||c ünïcode"),
+        conn_schema.DeleteRequest("ream"),
+        conn_schema.NotifRequest("mark"),
+        conn_schema.ListRequest("mark", "re", 2),
+        conn_schema.NotifRequest("mark", 40),
+        conn_schema.WatermarkRequest("mark", 2 ** 40),
+    ]
+    data = b"".join(records.encode(req) for req in reqs)
+    decoded = records.decode_all(data, 0)
+    assert [type(r) for r in decoded] == [type(r) for r in reqs]
+    assert decoded[1].text == "a@@b||c ünïcode"
+    assert decoded[4].page == 2
+    assert (decoded[3].count, decoded[5].count) == (1, 40)
+    assert decoded[6].watermark == 2 ** 40
+
+
+def test_scan_stops_at_torn_tail():
+    """
+    Scanning yields every good record and stops before a torn one
+    """
+    first = records.encode(conn_schema.CreateRequest("ream"))
+    second = records.encode(conn_schema.CreateRequest("mark"))
+    found = list(records.scan(first + second[:5], 0))
+    assert len(found) == 1
+    assert found[0] == (0, len(first))
+
+
+def test_long_fields():
+    """
+    Only the last field of a record may be longer than 16 bits of length
+    """
+    long_text = "x" * 70000
+    req = conn_schema.SendRequest("ream", "mark", long_text)
+    data = records.encode(req)
+    assert records.decode_all(data, 0)[0].text == long_text
+    try:
+        records.encode(conn_schema.SendRequest(long_text, "mark", "hi"))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_migrate(tmp_path):
+    """
+    Text logs get converted in place to the same requests
+    """
+    filename = str(tmp_path / "A_log.out")
+    with open(filename, "w") as file:
+        file.write("ream@@create\n")
+        file.write("mark@@create\n")
+        file.write("mark@@send@@ream@@hello\n")
+    convert(filename)
+    reqs = replay_binary(filename)
+    assert [r.marshal() for r in reqs] == ["ream@@create", "mark@@create", "mark@@send@@ream@@hello"]
+    # Converting twice does nothing
+    convert(filename)
+    assert len(replay_binary(filename)) == 3
+
+
+def test_migrate_failure(tmp_path, monkeypatch):
+    """
+    A log that can't be converted, or doesn't come out the same, is left
+    as it was, with nothing next to it
+    """
+    filename = str(tmp_path / "A_log.out")
+    text = "ream@@create\n" + "x" * (records.MAX_FIELD_LENGTH + 1) + "@@send@@ream@@hi\n"
+    with open(filename, "w") as file:
+        file.write(text)
+    assert not convert(filename)
+    with open(filename) as file:
+        assert file.read() == text
+    assert os.listdir(tmp_path) == ["A_log.out"]
+
+    with open(filename, "w") as file:
+        file.write("ream@@create\nmark@@create\n")
+    monkeypatch.setattr(migrate, "replay_binary", lambda name: replay_binary(name)[:1])
+    assert not convert(filename)
+    assert not migrate.is_binary(filename) and os.listdir(tmp_path) == ["A_log.out"]
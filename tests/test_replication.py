@@ -0,0 +1,94 @@
+import threading
+import time
+import connections.schema as conn_schema
+from tests.mocks.mock_socket import socket
+from connections.replication import BackupSender, LatencyHistogram
+
+
+class StuckSocket(socket):
+    """
+    A socket whose sends block until released, like a backup that stopped
+    reading
+    """
+
+    def __init__(self):
+        super().__init__(0, 0)
+        self.release = threading.Event()
+
+    def sendall(self, bs: bytes):
+        self.release.wait()
+        super().sendall(bs)
+
+
+def test_pipelines_in_order():
+    """
+    Everything enqueued goes out in order, several records per sendall
+    """
+    sock = StuckSocket()
+    sender = BackupSender("B", sock)
+    for position in range(1, 101):
+        assert sender.enqueue(position, str(position).encode())
+    sock.release.set()
+    assert sender.flush(timeout=5)
+    assert [int(payload) for payload in sock.sent] == list(range(1, 101))
+    assert sender.status()["sent"] == 100
+    sender.stop()
+
+
+def test_lag():
+    """
+    Lag is what was handed over but not acked yet, acks never go back
+    """
+    sock = socket(0, 0)
+    sender = BackupSender("B", sock)
+    for position in range(1, 6):
+        sender.enqueue(position, b"x")
+    assert sender.lag() == 5
+    sender.ack(3)
+    sender.ack(2)
+    assert sender.lag() == 2
+    assert sender.status()["acked"] == 3
+    sender.stop()
+
+
+def test_full_queue_drops_backup():
+    """
+    A backup that falls too far behind is given up on instead of making
+    the caller wait
+    """
+    sock = StuckSocket()
+    failed = []
+    sender = BackupSender("B", sock, on_failure=failed.append, queue_size=2)
+    start = time.time()
+    results = [sender.enqueue(position, b"x") for position in range(1, 10)]
+    assert time.time() - start < 1
+    assert False in results
+    assert failed == ["B"]
+    assert not sender.alive
+    assert not sender.enqueue(11, b"x")
+    sock.release.set()
+
+
+def test_send_failure_drops_backup():
+    """
+    A failed send drops the backup too
+    """
+    sock = socket(0, 0)
+    sock.sendall = None  # Calling it raises
+    failed = []
+    sender = BackupSender("B", sock, on_failure=failed.append)
+    sender.enqueue(1, conn_schema.CreateRequest("ream").marshal().encode())
+    assert not sender.flush(timeout=5)
+    assert failed == ["B"]
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.summary()["count"] == 0
+    for ms in [0.05, 0.3, 0.3, 3, 20000]:
+        histogram.record(ms / 1000)
+    summary = histogram.summary()
+    assert summary["count"] == 5
+    assert summary["p50_ms"] == 0.5
+    assert summary["p99_ms"] == float("inf")
+    assert summary["buckets"] == {"<=0.1": 1, "<=0.5": 2, "<=5": 1, ">5000": 1}
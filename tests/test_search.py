@@ -0,0 +1,93 @@
+import random
+import search
+from search import IndexCache, TextIndex, terms
+
+
+def make_index(texts):
+    index = TextIndex(lambda position: texts[position])
+    for (position, text) in enumerate(texts):
+        index.add(position, text)
+    return index
+
+
+def test_terms():
+    """
+    Words are lowercased, and too short or too long ones are left out
+    """
+    assert terms("Lunch, LUNCH at 1pm? a " + "x" * 40) == {"lunch", "at", "1pm"}
+
+
+def test_ranking():
+    """
+    Chats with more (and rarer) words of the query rank first, newer ones
+    first among equals, and pages go on from there
+    """
+    index = make_index(["lunch on friday", "lunch", "friday", "lunch today", "lunch friday", "nothing"])
+    assert index.search("friday lunch", 10) == ([4, 0, 2, 3, 1], False)
+    assert index.search("friday lunch", 2) == ([4, 0], True)
+    assert index.search("friday lunch", 2, 2) == ([1], False)
+    assert index.search("lunch", 2) == ([4, 3], True)
+    assert index.search("lunch", 2, 1) == ([1, 0], False)
+    assert index.search("lunch", 2, 2) == ([], False)
+    assert index.search("FRIDAY", 10, -1) == ([], False)
+    assert index.search("", 10) == ([], False)
+    assert index.search("missing", 10) == ([], False)
+
+
+def test_bounded(monkeypatch):
+    """
+    The index never holds more than INDEX_POSTINGS postings, forgetting
+    the oldest chats, and still matches a scan of the chats it covers
+    """
+    monkeypatch.setattr(search, "INDEX_POSTINGS", 200)
+    rng = random.Random(7)
+    words = [f"w{ix}" for ix in range(30)]
+    texts = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 6))) for _ in range(500)]
+    index = TextIndex(lambda position: texts[position])
+    for (position, text) in enumerate(texts):
+        index.add(position, text)
+        assert index.size <= 200
+        assert sum(len(postings) for postings in index.postings.values()) == index.size
+    assert index.end == 500 and index.start > 0
+    covered = range(index.start, index.end)
+    (found, more) = index.search("w3", 1000)
+    assert not more
+    assert sorted(found) == [p for p in covered if "w3" in terms(texts[p])]
+    # Built at once, an index goes back from the newest chats as far as fits
+    built = TextIndex.build(lambda position: texts[position], 500)
+    assert built.end == 500 and built.size <= 200 and built.start < index.start
+    assert built.size == sum(len(terms(texts[p])) for p in range(built.start, 500))
+    (found, _) = built.search("w3", 1000)
+    assert sorted(found) == [p for p in range(built.start, 500) if "w3" in terms(texts[p])]
+
+
+def test_index_cache(monkeypatch):
+    """
+    Indexes are built on first use, and the ones used longest ago are
+    thrown away once together they hold more than INDEX_BUDGET postings
+    """
+    monkeypatch.setattr(search, "INDEX_BUDGET", 10)
+    cache = IndexCache()
+    built = []
+
+    def builder(owner, count):
+        def build():
+            built.append(owner)
+            return make_index([f"w{ix}" for ix in range(count)])
+        return build
+    assert cache.get("a", builder("a", 4)).size == 4
+    cache.get("b", builder("b", 4))
+    cache.get("a", builder("a", 4))
+    assert built == ["a", "b"] and cache.size == 8
+    # b was used longest ago, so it goes to make room for c
+    cache.get("c", builder("c", 4))
+    assert list(cache.indexes) == ["a", "c"] and cache.size == 8
+    # Growing an index past the budget throws away the oldest
+    index = cache.peek("c")
+    index.add(4, "x1 x2 x3")
+    cache.resized(3)
+    assert list(cache.indexes) == ["c"] and cache.size == 7
+    # An index bigger than the budget on its own is still kept while in use
+    assert cache.get("d", builder("d", 20)).size == 20 and list(cache.indexes) == ["d"]
+    cache.discard("d")
+    assert len(cache) == 0 and cache.size == 0
@@ -0,0 +1,223 @@
+import sys
+sys.path.append("..")
+import os
+import pytest
+import persistence.consts as consts
+import persistence.records as records
+import connections.schema as conn_schema
+from persistence.errors import CompactedRangeException
+from persistence.log_writer import LogWriter
+from persistence.segments import SegmentedLog, compact_requests
+from persistence.snapshot import Snapshotter
+
+
+def fill(filename, reqs, segment_size):
+    """
+    Writes reqs through a log writer onto a segmented log, one commit each
+    """
+    log = SegmentedLog(filename, segment_size=segment_size)
+    writer = LogWriter(filename, durability=consts.DURABILITY_BUFFERED, index=log)
+    for req in reqs:
+        writer.append(records.encode(req), wait=True)
+    writer.close()
+    return log
+
+
+def test_rotation(tmp_path):
+    """
+    The active segment gets sealed once it is full, and reads span segments
+    """
+    filename = str(tmp_path / "A_log.out")
+    reqs = [conn_schema.CreateRequest(f"user{ix}") for ix in range(20)]
+    log = fill(filename, reqs, segment_size=64)
+    assert len(log.sealed) > 1
+    assert os.path.exists(filename + ".manifest")
+    assert log.count() == 20
+    assert [r.user_id for r in log.read(3, 17)] == [f"user{ix}" for ix in range(3, 17)]
+    log.close()
+
+    # Everything comes back after a restart
+    reopened = SegmentedLog(filename, segment_size=64)
+    assert reopened.count() == 20
+    assert [r.user_id for r in reopened.read(0, 20)] == [r.user_id for r in reqs]
+    reopened.close()
+
+
+def test_compact_requests():
+    """
+    Deleted users disappear, notifs get folded into their sends
+    """
+    reqs = [
+        conn_schema.CreateRequest("ream"),
+        conn_schema.CreateRequest("mark"),
+        conn_schema.SendRequest("mark", "ream", "one"),
+        conn_schema.SendRequest("mark", "ream", "two"),
+        conn_schema.NotifRequest("ream"),
+        conn_schema.SendRequest("ream", "mark", "bye"),
+        conn_schema.DeleteRequest("ream"),
+    ]
+    (kept, pending, delivered) = compact_requests(reqs)
+    assert [r.marshal() for r in kept] == ["mark@@create", "ream@@send@@mark@@bye"]
+    assert (pending, delivered) == ({"mark": 1}, {})
+
+    reqs = reqs[:6]
+    (kept, pending, delivered) = compact_requests(reqs)
+    assert [r.type for r in kept] == ["create", "create", "send", "send", "send"]
+    assert [r.delivered for r in kept if r.type == "send"] == [True, False, False]
+    assert (pending, delivered) == ({"ream": 1, "mark": 1}, {"ream": 1})
+
+
+def test_compact_requests_carried():
+    """
+    Deliveries of sends in the already compacted part are kept, as one
+    watermark, and so are deletes of users created there
+    """
+    reqs = [
+        conn_schema.SendRequest("mark", "ream", "three"),
+        conn_schema.NotifRequest("ream"),
+        conn_schema.NotifRequest("ream"),
+        conn_schema.DeleteRequest("joe"),
+    ]
+    (kept, pending, delivered) = compact_requests(reqs, {"ream": 1, "joe": 2}, {"ream": 4})
+    # The first notif delivers the old send, the second one "three"
+    assert [r.type for r in kept] == ["send", "watermark", "delete"]
+    assert kept[0].delivered
+    assert (kept[1].user_id, kept[1].watermark) == ("ream", 6)
+    assert (pending, delivered) == ({}, {"ream": 6})
+
+
+def test_compact_batched_notifs():
+    """
+    Notifs delivering several chats and watermarks fold into all of their
+    sends, and a user's last delivery is kept as a watermark if any of them
+    reached the compacted part
+    """
+    reqs = [
+        conn_schema.SendRequest("mark", "ream", "three"),
+        conn_schema.SendRequest("mark", "ream", "four"),
+        conn_schema.SendRequest("ream", "mark", "five"),
+        conn_schema.WatermarkRequest("ream", 2),
+        conn_schema.NotifRequest("ream", 2),
+        conn_schema.NotifRequest("mark", 2),
+        conn_schema.SendRequest("ream", "joe", "six"),
+        conn_schema.WatermarkRequest("joe", 1),
+    ]
+    (kept, pending, delivered) = compact_requests(reqs, {"ream": 1, "mark": 1}, {"ream": 1})
+    assert [r.type for r in kept] == ["send", "send", "send", "watermark", "watermark", "send"]
+    assert [r.delivered for r in kept[:3]] == [True, True, True]
+    assert [(r.user_id, r.watermark) for r in kept[3:5]] == [("ream", 4), ("mark", 2)]
+    assert kept[5].delivered
+    assert (pending, delivered) == ({}, {"ream": 4, "mark": 2, "joe": 1})
+
+
+def test_compact(tmp_path):
+    """
+    Old segments get rewritten as one compacted segment that keeps its
+    place in the progress numbering
+    """
+    filename = str(tmp_path / "A_log.out")
+    reqs = [conn_schema.CreateRequest("mark")]
+    for ix in range(30):
+        reqs.append(conn_schema.SendRequest("ream", "mark", f"msg{ix}"))
+        reqs.append(conn_schema.NotifRequest("mark"))
+    log = fill(filename, reqs, segment_size=128)
+    count = log.count()
+    assert log.compact(count)
+    assert log.horizon() > 0
+    assert log.count() == count
+    assert len(log.sealed) == 1 + consts.SEGMENT_RETAIN
+
+    # Replays from scratch get the compacted records
+    replay = log.read(0, count, allow_compacted=True)
+    assert len(replay) < count
+    assert replay[0].type == "create"
+    assert replay[1].type == "send" and replay[1].delivered
+    assert len([r for r in replay if r.type == "notif"]) < 30
+    # Reads from inside the compacted part are refused
+    with pytest.raises(CompactedRangeException):
+        log.read(1, count)
+    # Reads after it are fine
+    assert log.read(log.horizon(), count)[0].type in ["send", "notif"]
+    log.close()
+
+    reopened = SegmentedLog(filename, segment_size=128)
+    assert reopened.horizon() == log.horizon()
+    reopened.close()
+
+
+def test_compact_incrementally(tmp_path):
+    """
+    Later compactions only read the newly eligible segments, and the
+    compacted part replays to the same state as the original records
+    """
+    filename = str(tmp_path / "A_log.out")
+    reqs = [conn_schema.CreateRequest("mark"), conn_schema.CreateRequest("ream")]
+    for ix in range(40):
+        reqs.append(conn_schema.SendRequest("ream", "mark", f"msg{ix}"))
+        if ix % 3 == 0:
+            reqs.append(conn_schema.NotifRequest("mark"))
+    reqs.append(conn_schema.DeleteRequest("ream"))
+    log = fill(filename, reqs[:30], segment_size=128)
+    assert log.compact(log.count())
+    writer = LogWriter(filename, durability=consts.DURABILITY_BUFFERED, index=log)
+    for req in reqs[30:]:
+        writer.append(records.encode(req), wait=True)
+    writer.close()
+    count = log.count()
+    assert log.compact(count)
+    assert count == len(reqs)
+
+    # Same messages, same undelivered count as replaying everything
+    replay = log.read(0, count, allow_compacted=True)
+    assert len(replay) < len(reqs)
+    sends = [r for r in replay if r.type == "send" and r.recipient_id == "mark"]
+    assert [r.text for r in sends] == [f"msg{ix}" for ix in range(40)]
+    snapshotter = Snapshotter("A")
+    for req in replay:
+        snapshotter.track(req)
+    assert snapshotter.pending["mark"] == 40 - 14
+    assert snapshotter.delivered["mark"] == 14
+    # The carried watermarks are the ones at the horizon
+    at_horizon = Snapshotter("A")
+    for req in log.read(0, log.horizon(), allow_compacted=True):
+        at_horizon.track(req)
+    assert log.delivered == {user_id: n for (user_id, n) in at_horizon.delivered.items() if n}
+
+    # The prefix can be taken on by an empty log
+    (horizon, data, pending) = log.prefix()
+    assert horizon == log.horizon()
+    other = SegmentedLog(str(tmp_path / "B_log.out"), segment_size=128)
+    other.install_prefix(data, horizon, pending)
+    assert other.count() == horizon
+    assert other.pending == log.pending
+    assert other.delivered == log.delivered
+    assert len(other.read(0, horizon, allow_compacted=True)) == len(log.read(0, horizon, allow_compacted=True))
+    other.close()
+    log.close()
+
+
+def test_reset(tmp_path):
+    """
+    A reset log is empty, and a writer that was open on it keeps appending
+    at the right offsets
+    """
+    filename = str(tmp_path / "A_log.out")
+    log = SegmentedLog(filename, segment_size=64)
+    writer = LogWriter(filename, durability=consts.DURABILITY_BUFFERED, index=log)
+    for ix in range(20):
+        writer.append(records.encode(conn_schema.CreateRequest(f"user{ix}")), wait=True)
+    assert len(log.sealed) > 1
+    writer.flush()
+    log.reset()
+    assert log.count() == 0
+    assert log.sealed == []
+    log.install_prefix(records.encode(conn_schema.CreateRequest("ream")), 5, {})
+    writer.append(records.encode(conn_schema.CreateRequest("mark")), wait=True)
+    writer.close()
+    assert log.count() == 6
+    assert [r.user_id for r in log.read(5, 6)] == ["mark"]
+    log.close()
+    reopened = SegmentedLog(filename, segment_size=64)
+    assert [r.user_id for r in reopened.read(0, 6, allow_compacted=True)] == ["ream", "mark"]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".seg")] == []
+    reopened.close()
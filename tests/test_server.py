@@ -9,13 +9,18 @@ from threading import Lock
 from typing import List, Mapping
 sys.path.insert(0, "..")
 import server
+from persistence.log_writer import LogWriter
+from persistence.snapshot import Snapshotter, SnapshotState
+import persistence.records as records
 import connections.schema 
 import schema
+from history import MessageLog
 import client
 import threading
 import ctypes
 from concurrent import futures
 import os
+import glob
 
 # Make server class start indepedent of connecting to backup servers
 class Server_dummy(server.Server):
@@ -36,17 +41,42 @@ class Server_dummy(server.Server):
         # Bring myself up to date with info I have locally
         self.users = {}  # Users of the system NOTE: Also contains all chats that have ever happened
         # Chats that are undelivered
-        self.msg_cache: "Mapping[str, Queue[Chat]]" = {}
-        self.notif_lock = Lock()  # Make sure only one thread is changing notif_sockets
-        self.notif_sockets: Mapping[str, any] = {}  # Sockets for notif threads
+        self.undelivered = server.Undelivered()
         self.alive = True
+        self.log_lock = Lock()
+        self.applied = threading.Condition()
+        self.progress = 0
+        self.snapshotter = Snapshotter(name)
+        self.log_index = None
+        self.conman = server.ConnectionManager(MACHINE_A)  # Never primary, so never replicates
+        self.commit_latency = {level: server.LatencyHistogram() for level in server.consts.COMMIT_LEVELS}
 
         #ACTIONS
         self.rehydrate()
+        self.log_writer = LogWriter(self.get_logfile(), index=self.log_index)
+        Server_dummy.instances.append(self)
+
+    # Every server made by a test, so tearDown can close their logs
+    instances = []
 
 class Test_server(unittest.TestCase):
     """Test class for our server code"""
 
+    def setUp(self):
+        # The tests write to the real log, keep the checked-in one to put back
+        with open("logs/A_log.out", "rb") as f:
+            self.saved_log = f.read()
+
+    def tearDown(self):
+        for server_a in Server_dummy.instances:
+            server_a.log_writer.close()
+            server_a.log_index.close()
+        Server_dummy.instances.clear()
+        for filename in glob.glob("logs/A_log.out.*") + glob.glob("logs/A_*.snap"):
+            os.remove(filename)
+        with open("logs/A_log.out", "wb") as f:
+            f.write(self.saved_log)
+
     def delete_log(self):
         """Deletes log file"""
         try:
@@ -73,6 +103,11 @@ class Test_server(unittest.TestCase):
         assert not out.success
         assert len(server_a.users) == 1
 
+        # Ids too long to be logged are refused
+        out = server_a.handle_create(connections.schema.CreateRequest(user_id="x" * 70000), True)
+        assert not out.success
+        assert len(server_a.users) == 1
+
     
     def test_Login(self):
         
@@ -128,6 +163,22 @@ class Test_server(unittest.TestCase):
         ret = server_a.handle_list(z_lst_req, True)
         assert len(ret.accounts) == 0
 
+        # Ensure prefixes work, and accounts come in order
+        ret = server_a.handle_list(connections.schema.ListRequest('ream', "^", 0), True)
+        assert [a.user_id for a in ret.accounts] == ["achele", "bob", "joe", "mark"]
+        ret = server_a.handle_list(connections.schema.ListRequest('ream', "^b", 0), True)
+        assert [a.user_id for a in ret.accounts] == ["bob"]
+
+        # Ensure cursors go on where the last page ended, deletes and all
+        ret = server_a.handle_list(connections.schema.ListRequest('ream', "", 0, cursor=""), True)
+        assert ret.cursor
+        server_a.handle_delete(connections.schema.DeleteRequest("ream"), True)
+        server_a.handle_create(connections.schema.CreateRequest("zed"), True)
+        ret = server_a.handle_list(connections.schema.ListRequest('ream', "", 0, cursor=ret.cursor), True)
+        assert [a.user_id for a in ret.accounts] == ["zed"] and ret.cursor == ""
+        ret = server_a.handle_list(connections.schema.ListRequest('ream', "", 0, cursor="nope"), True)
+        assert not ret.success
+
     def test_Delete(self):
         # Create test server
         self.delete_log()
@@ -185,12 +236,10 @@ class Test_server(unittest.TestCase):
 
 
         # Create test users in log file
-        with open("logs/A_log.out", "w") as f:
-            f.write("ream@@create\n")
-            f.write("mark@@create\n")
-            f.write("achele@@create\n")
-            f.write("joe@@create\n")
-            f.write("bob@@create\n")
+        with open("logs/A_log.out", "wb") as f:
+            f.write(records.file_header())
+            for name in ["ream", "mark", "achele", "joe", "bob"]:
+                f.write(records.encode(connections.schema.CreateRequest(name)))
         
         # Test rehydrate
         ret = server_a.rehydrate()
@@ -220,6 +269,29 @@ class Test_server(unittest.TestCase):
         assert ret.success
         assert len(server_a.users["mark"].msg_log) == 1
     
+    def test_handle_watermark(self):
+        """
+        Watermarks empty a user's queue up to them, and delivering on the
+        primary logs the user's new watermark
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        for name in ["ream", "mark"]:
+            server_a.handle_req(connections.schema.CreateRequest(user_id=name), False)
+        for text in ["first", "second", "third"]:
+            server_a.handle_req(connections.schema.SendRequest(user_id="mark", recipient_id="ream", text=text), False)
+
+        assert server_a.handle_req(connections.schema.WatermarkRequest("ream", 2), False).success
+        assert [c.text for c in server_a.undelivered.peek("ream", server_a.users["ream"].msg_log)] == ["third"]
+        # Watermarks that don't move change nothing
+        server_a.handle_req(connections.schema.WatermarkRequest("ream", 1), False)
+        assert [c.text for c in server_a.undelivered.peek("ream", server_a.users["ream"].msg_log)] == ["third"]
+
+        assert [c.text for c in server_a.next_chats("ream", 5)] == ["third"]
+        server_a.mark_delivered([("ream", 1)])
+        logged = server_a.get_reqs_by_progress(server_a.progress - 1, server_a.progress)
+        assert [(r.type, r.user_id, r.watermark) for r in logged] == [("watermark", "ream", 3)]
+
     def test_handle_logs(self):
         """
         Create a test server and test that handle_logs returns the correct progress
@@ -245,4 +317,297 @@ class Test_server(unittest.TestCase):
         req = connections.schema.LogsRequest(user_id="ream", wildcard='', page=0)
         ret = server_a.handle_logs(req, True)
         assert len(ret.msgs) == 1
+
+        # Ensure logs come newest first, filtered by author
+        for (ix, author) in enumerate(["joe", "bob", "joe", "achele", "joe", "joe", "bob"]):
+            req = connections.schema.SendRequest(user_id=author, recipient_id="ream", text=str(ix))
+            server_a.handle_send(req, True)
+        ret = server_a.handle_logs(connections.schema.LogsRequest("ream", "", 0), True)
+        assert [c.text for c in ret.msgs] == ["6", "5", "4", "3"]
+        ret = server_a.handle_logs(connections.schema.LogsRequest("ream", "o", 1), True)
+        assert [c.text for c in ret.msgs] == ["1", "0"]
+
+        # Ensure cursors go on where the last page ended, even with new chats in between
+        ret = server_a.handle_logs(connections.schema.LogsRequest("ream", "o", 0, cursor=""), True)
+        assert [c.text for c in ret.msgs] == ["6", "5", "4", "2"] and ret.cursor
+        server_a.handle_send(connections.schema.SendRequest(user_id="joe", recipient_id="ream", text="7"), True)
+        ret = server_a.handle_logs(connections.schema.LogsRequest("ream", "o", 0, cursor=ret.cursor), True)
+        assert [c.text for c in ret.msgs] == ["1", "0"] and ret.cursor == ""
+        ret = server_a.handle_logs(connections.schema.LogsRequest("ream", "", 0, cursor="nope"), True)
+        assert not ret.success
+
+    def test_handle_search(self):
+        """
+        Search finds messages by their words, best first, and comes back
+        after a restart
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        for req in [connections.schema.CreateRequest(user_id="ream"), connections.schema.CreateRequest(user_id="mark")]:
+            server_a.handle_req(req, False)
+            server_a.update_log(req)
+        texts = ["lunch on friday?", "Friday works", "what about lunch", "lunch friday then!", "ok"]
+        for text in texts:
+            req = connections.schema.SendRequest(user_id="mark", recipient_id="ream", text=text)
+            server_a.handle_req(req, False)
+            server_a.update_log(req)
+        ret = server_a.handle_search(connections.schema.SearchRequest("ream", "Lunch Friday", 0), True)
+        assert [c.text for c in ret.msgs] == ["lunch friday then!", "lunch on friday?", "what about lunch", "Friday works"]
+        ret = server_a.handle_search(connections.schema.SearchRequest("ream", "Lunch Friday", 1), True)
+        assert ret.msgs == []
+        ret = server_a.handle_search(connections.schema.SearchRequest("nobody", "lunch", 0), True)
+        assert not ret.success
+        server_a.log_writer.close()
+        server_a.log_index.close()
+
+        server_a2 = Server_dummy(name='A')
+        ret = server_a2.handle_search(connections.schema.SearchRequest("ream", "works", 0), True)
+        assert [c.text for c in ret.msgs] == ["Friday works"]
         
+
+    def test_responses_wait_for_commit(self):
+        """
+        The request loop doesn't wait for commits, the responder releases
+        responses in order once their requests are committed
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        sent = []
+        server_a.conman = type("conman", (), {
+            "send_response": lambda _, name, resp: sent.append((name, resp)),
+            "broadcast_to_backups": lambda *_: None,
+            "wait_for_replication": lambda *_: True,
+        })()
+        server_a.responses = server.Queue()
+        reqs = [connections.schema.CreateRequest(user_id=name) for name in ["ream", "mark", "joe"]]
+        for req in reqs:
+            resp = server_a.handle_req(req, True)
+            server_a.respond("client", resp, server_a.update_log(req, wait=False))
+        server_a.respond("client", connections.schema.Response("ream", True, "read"))
+        server_a.responses.put(None)
+        server_a.respond_loop()
+        assert [resp.user_id for (_, resp) in sent] == ["ream", "mark", "joe", "ream"]
+        assert server_a.log_writer.committed == 3
+
+    def test_commit_levels(self):
+        """
+        Responses wait for the commit level of their request type, and
+        turn into errors if the backups never ack
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        sent = []
+        waited = []
+        def wait_for_replication(_, position, level):
+            waited.append((position, level))
+            return level != server.consts.COMMIT_ALL
+        server_a.conman = type("conman", (), {
+            "send_response": lambda _, name, resp: sent.append(resp),
+            "broadcast_to_backups": lambda *_: None,
+            "wait_for_replication": wait_for_replication,
+        })()
+        server_a.responses = server.Queue()
+        overrides = dict(server.consts.COMMIT_LEVEL_OVERRIDES)
+        server.consts.COMMIT_LEVEL_OVERRIDES.update({"create": server.consts.COMMIT_QUORUM, "delete": server.consts.COMMIT_ALL})
+        try:
+            for req in [connections.schema.CreateRequest("ream"), connections.schema.DeleteRequest("ream"),
+                        connections.schema.LoginRequest("ream")]:
+                resp = server_a.handle_req(req, True)
+                commit = server_a.update_log(req, wait=False) if resp.success else None
+                server_a.respond("client", resp, commit, server_a.commit_level(req))
+        finally:
+            server.consts.COMMIT_LEVEL_OVERRIDES.clear()
+            server.consts.COMMIT_LEVEL_OVERRIDES.update(overrides)
+        server_a.responses.put(None)
+        server_a.respond_loop()
+        assert waited == [(1, "quorum"), (2, "all")]
+        assert [resp.success for resp in sent] == [True, False, False]
+        assert "replicated" in sent[1].error_message
+        assert server_a.commit_latency["quorum"].summary()["count"] == 1
+        assert server_a.commit_latency["primary"].summary()["count"] == 1
+
+    def test_backup_reads(self):
+        """
+        A backup serves reads with the progress it served them at, once it
+        has applied the progress they ask for, and refuses them otherwise
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        for req in [connections.schema.CreateRequest("ream"), connections.schema.CreateRequest("mark")]:
+            server_a.handle_req(req, False)
+            server_a.update_log(req, wait=False)
+        sent = []
+        server_a.conman.send_response = lambda name, resp: sent.append((name, resp))
+        read_wait = server.consts.READ_WAIT
+        server.consts.READ_WAIT = 0.05
+        try:
+            server_a.conman.read_requests.put(("c1", connections.schema.ListRequest("ream", "", 0, 2)))
+            server_a.conman.read_requests.put(("c2", connections.schema.ListRequest("ream", "", 0, 3)))
+            server_a.conman.read_requests.put(None)
+            server_a.read_loop()
+        finally:
+            server.consts.READ_WAIT = read_wait
+        [(_, served), (_, refused)] = sent
+        assert served.success and served.progress == 2
+        assert sorted(a.user_id for a in served.accounts) == ["mark", "ream"]
+        assert not refused.success and refused.progress == 2
+
+    def test_backup_reads_unknown_user(self):
+        """
+        Logs for a user that doesn't exist are refused by a backup, which
+        goes on serving reads after it
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        req = connections.schema.CreateRequest("ream")
+        server_a.handle_req(req, False)
+        server_a.update_log(req, wait=False)
+        sent = []
+        server_a.conman.send_response = lambda name, resp: sent.append((name, resp))
+        server_a.conman.read_requests.put(("c1", connections.schema.LogsRequest("nobody", "", 0)))
+        server_a.conman.read_requests.put(("c2", connections.schema.LogsRequest("ream", "", 0)))
+        server_a.conman.read_requests.put(None)
+        server_a.read_loop()
+        [(_, refused), (_, served)] = sent
+        assert refused.type == "logs" and not refused.success
+        assert refused.error_message == "User does not exist"
+        assert served.success and served.msgs == []
+
+    def test_backup_reads_survive_errors(self):
+        """
+        A read that fails while it is served is answered with an error, and
+        the backup goes on serving reads
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        sent = []
+        server_a.conman.send_response = lambda name, resp: sent.append((name, resp))
+        handle_req = server_a.handle_req
+        def failing(req, was_primary):
+            if req.wildcard == "boom":
+                raise KeyError(req.user_id)
+            return handle_req(req, was_primary)
+        server_a.handle_req = failing
+        server_a.conman.read_requests.put(("c1", connections.schema.ListRequest("ream", "boom", 0)))
+        server_a.conman.read_requests.put(("c2", connections.schema.ListRequest("ream", "", 0)))
+        server_a.conman.read_requests.put(None)
+        server_a.read_loop()
+        [(_, failed), (_, served)] = sent
+        assert not failed.success and "could not be served" in failed.error_message
+        assert served.success and served.type == "list"
+
+    def test_in_sequence(self):
+        """
+        A backup applies replicated records once and in order, skips
+        duplicates, asks to be caught up again on a gap and refuses records
+        from an older term
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        resyncs = []
+        server_a.conman.resync = resyncs.append
+        def replicated(req, lsn, term=1):
+            (req.lsn, req.term) = (lsn, term)
+            return req
+        for req in [replicated(connections.schema.CreateRequest("ream"), 1),
+                    replicated(connections.schema.CreateRequest("ream"), 1),
+                    replicated(connections.schema.CreateRequest("joe"), 3),
+                    replicated(connections.schema.CreateRequest("mark"), 2)]:
+            if server_a.in_sequence(req):
+                server_a.handle_req(req, False)
+                server_a.update_log(req)
+        assert sorted(server_a.users) == ["mark", "ream"]
+        assert server_a.progress == 2
+        assert resyncs == [1]
+        assert not server_a.in_sequence(replicated(connections.schema.CreateRequest("joe"), 3, 0))
+        assert server_a.in_sequence(connections.schema.FalloverRequest("joe"))
+
+    def test_rehydrate_from_snapshot(self):
+        """
+        Create a test server, snapshot it part way through its log and
+        check that a fresh server rebuilds the same state from the snapshot
+        plus the rest of the log
+        """
+        # Create test server
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+
+        # Log some requests, snapshot, then log some more
+        reqs = [
+            connections.schema.CreateRequest(user_id="ream"),
+            connections.schema.CreateRequest(user_id="mark"),
+            connections.schema.SendRequest(user_id="mark", recipient_id="ream", text="hello"),
+        ]
+        for req in reqs:
+            server_a.handle_req(req, False)
+            server_a.update_log(req)
+        state = server_a.snapshotter.capture(server_a.progress, server_a.users)
+        server_a.snapshotter.write(state)
+        req = connections.schema.SendRequest(user_id="mark", recipient_id="ream", text="again")
+        server_a.handle_req(req, False)
+        server_a.update_log(req)
+        server_a.log_writer.close()
+        server_a.log_index.close()
+
+        # Rehydrate from the snapshot and the suffix
+        server_a2 = Server_dummy(name='A')
+        assert server_a2.snapshotter.last_progress == 3
+        assert server_a2.progress == 4
+        assert [c.text for c in server_a2.users["ream"].msg_log] == ["again", "hello"]
+        assert server_a2.undelivered.count("ream", server_a2.users["ream"].msg_log) == 2
+        assert [c.text for c in server_a2.next_chats("ream", 1)] == ["hello"]
+
+
+    def test_install_catchup_snapshot(self):
+        """
+        A machine that is far behind takes on another machine's snapshot in
+        place of its own log, and comes back the same after a restart
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        for req in [connections.schema.CreateRequest(user_id="stale")]:
+            server_a.handle_req(req, False)
+            server_a.update_log(req)
+
+        # The state of a machine that got much further
+        ream = schema.Account("ream")
+        ream.msg_log = MessageLog("ream", [schema.Chat("mark", "ream", "first"), schema.Chat("mark", "ream", "second")])
+        state = SnapshotState(50, {"ream": ream, "mark": schema.Account("mark")}, {"ream": 1})
+        (progress, data) = (50, server.compress_state(state.marshal()))
+        server_a.install_catchup_snapshot(data, progress)
+        assert server_a.progress == 50
+        assert server_a.get_progress() == 50
+        assert sorted(server_a.users) == ["mark", "ream"]
+        assert [c.text for c in server_a.undelivered.peek("ream", server_a.users["ream"].msg_log)] == ["second"]
+
+        # Requests after it are logged as usual
+        req = connections.schema.SendRequest(user_id="ream", recipient_id="mark", text="hi")
+        server_a.handle_req(req, False)
+        server_a.update_log(req)
+        assert server_a.get_progress() == 51
+        server_a.log_writer.close()
+        server_a.log_index.close()
+
+        server_a2 = Server_dummy(name='A')
+        assert server_a2.progress == 51
+        assert sorted(server_a2.users) == ["mark", "ream"]
+        assert [c.text for c in server_a2.users["ream"].msg_log] == ["second", "first"]
+        assert [c.text for c in server_a2.undelivered.peek("ream", server_a2.users["ream"].msg_log)] == ["second"]
+        assert [c.text for c in server_a2.undelivered.peek("mark", server_a2.users["mark"].msg_log)] == ["hi"]
+
+    def test_install_catchup_snapshot_waits_for_requests(self):
+        """
+        A snapshot taken on while the request loop is applying a request
+        waits for it, so no request sees half of the old state
+        """
+        self.delete_log()
+        server_a = Server_dummy(name='A')
+        state = SnapshotState(50, {"ream": schema.Account("ream")}, {})
+        data = server.compress_state(state.marshal())
+        installer = threading.Thread(target=server_a.install_catchup_snapshot, args=(data, 50))
+        with server_a.applied:
+            installer.start()
+            installer.join(timeout=0.2)
+            assert installer.is_alive() and server_a.progress == 0
+        installer.join(timeout=5)
+        assert server_a.progress == 50 and sorted(server_a.users) == ["ream"]
@@ -0,0 +1,126 @@
+import sys
+sys.path.append("..")
+import connections.schema as conn_schema
+from schema import Account, Chat
+from history import MessageLog
+from persistence.snapshot import Snapshotter, SnapshotState, compress_state, decompress_state
+
+
+def make_users():
+    ream = Account("ream")
+    mark = Account("mark")
+    ream.msg_log = MessageLog("ream", [Chat("mark", "ream", "first"), Chat("mark", "ream", "second")])
+    return {"ream": ream, "mark": mark}
+
+
+def test_track():
+    """
+    Undelivered counts follow the requests in log order
+    """
+    snapshotter = Snapshotter("A")
+    snapshotter.track(conn_schema.CreateRequest("ream"))
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "first"))
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "second"))
+    snapshotter.track(conn_schema.NotifRequest("ream"))
+    assert snapshotter.pending == {"ream": 1}
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "third"))
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "fourth"))
+    snapshotter.track(conn_schema.NotifRequest("ream", 2))
+    assert snapshotter.pending == {"ream": 1}
+    snapshotter.track(conn_schema.DeleteRequest("ream"))
+    assert snapshotter.pending == {}
+
+
+def test_track_watermarks():
+    """
+    Watermarks deliver everything the user received up to them, and pick
+    up from a snapshot that was taken on
+    """
+    snapshotter = Snapshotter("A")
+    snapshotter.take_on(SnapshotState(7, make_users(), {"ream": 1}))
+    assert snapshotter.delivered == {"ream": 1, "mark": 0}
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "third"))
+    snapshotter.track(conn_schema.WatermarkRequest("ream", 2))
+    assert (snapshotter.pending["ream"], snapshotter.delivered["ream"]) == (1, 2)
+    # Watermarks that don't move anything change nothing
+    snapshotter.track(conn_schema.WatermarkRequest("ream", 2))
+    snapshotter.track(conn_schema.WatermarkRequest("ream", 1))
+    assert (snapshotter.pending["ream"], snapshotter.delivered["ream"]) == (1, 2)
+    snapshotter.track(conn_schema.WatermarkRequest("ream", 3))
+    assert (snapshotter.pending["ream"], snapshotter.delivered["ream"]) == (0, 3)
+
+
+def test_marshal():
+    """
+    A snapshot survives a round trip and rebuilds the same state
+    """
+    state = SnapshotState(7, make_users(), {"ream": 2, "mark": 0})
+    copy = SnapshotState.unmarshal(state.marshal())
+    users = copy.users()
+    assert copy.progress == 7
+    assert [c.text for c in users["ream"].msg_log] == ["second", "first"]
+    assert len(users["mark"].msg_log) == 0
+    # The text index is rebuilt along with the messages
+    assert users["ream"].msg_log.search("first", 4) == ([0], False)
+    # Undelivered comes back oldest first
+    assert [c.text for c in copy.undelivered("ream")] == ["first", "second"]
+
+
+def test_requests():
+    """
+    Replaying the requests of a snapshot gives back the same state, and the
+    compressed form survives a round trip
+    """
+    state = SnapshotState(7, make_users(), {"ream": 1, "mark": 0})
+    copy = decompress_state(compress_state(state.marshal()))
+    reqs = copy.requests()
+    assert [(r.type, r.user_id) for r in reqs[:2]] == [("create", "ream"), ("create", "mark")]
+    assert [(r.text, r.delivered) for r in reqs[2:]] == [("first", True), ("second", False)]
+    snapshotter = Snapshotter("A")
+    for req in reqs:
+        snapshotter.track(req)
+    assert snapshotter.pending == {"ream": 1, "mark": 0}
+
+
+def test_capture_copies():
+    """
+    Changes made after a capture don't leak into the snapshot
+    """
+    users = make_users()
+    snapshotter = Snapshotter("A")
+    state = snapshotter.capture(3, users)
+    users["ream"].msg_log.append(Chat("mark", "ream", "third"))
+    snapshotter.track(conn_schema.SendRequest("mark", "ream", "third"))
+    assert len(state.materialize()["ream"]) == 2
+    assert state.pending == {}
+
+
+def test_write_and_load(tmp_path):
+    """
+    The newest snapshot that fits inside the log is the one loaded,
+    and old snapshots get pruned
+    """
+    snapshotter = Snapshotter("A", directory=str(tmp_path))
+    for progress in [10, 20, 30]:
+        snapshotter.write(SnapshotState(progress, make_users(), {"ream": 1}))
+    assert [p for (p, _) in snapshotter.list_snapshots()] == [30, 20]
+
+    fresh = Snapshotter("A", directory=str(tmp_path))
+    assert fresh.load_latest(100).progress == 30
+    assert fresh.pending == {"ream": 1}
+    # A snapshot claiming more than the log holds is ignored
+    assert fresh.load_latest(25).progress == 20
+    assert fresh.load_latest(5) is None
+
+
+def test_write_async(tmp_path):
+    """
+    Background writes land on disk and only one runs at a time
+    """
+    snapshotter = Snapshotter("A", directory=str(tmp_path), interval=5)
+    assert snapshotter.is_due(5)
+    assert snapshotter.write_async(SnapshotState(5, make_users(), {}))
+    while snapshotter.writing:
+        pass
+    assert not snapshotter.is_due(6)
+    assert snapshotter.list_snapshots()[0][0] == 5